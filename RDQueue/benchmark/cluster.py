@@ -0,0 +1,242 @@
+"""
+A local cluster on loopback for the benchmarks: a load balancer and N brokers replicating every partition,
+run as subprocesses or in the event loop of the benchmark itself.
+
+    python -m RDQueue.benchmark.cluster --brokers 3
+
+The settings of the cluster are applied to `RDQueue.common.config.DEFAULTS`, which the server and client
+modules read as they are imported: `apply_settings` has to run before they are.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import shutil
+import signal
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List
+
+from RDQueue.common import config
+
+logger = logging.getLogger(__file__)
+
+SERVER_DIR = Path(__file__).parent.parent / 'server'
+
+
+def cluster_settings(brokers: int = 3, base_port: int = 19090, replicas: int | None = None,
+                     partitions: int = 1) -> Dict:
+    """
+    :param brokers:
+    :param base_port: of the load balancer, the brokers listen at the next ports and replicate 100 ports above
+    :param replicas: of every partition, all the brokers if None
+    :param partitions: of the queues created without a number of partitions
+    :return: the settings of the cluster
+    """
+    return {
+        'LOAD_BALANCER_ADDRESS': f'127.0.0.1:{base_port}',
+        'BROKER_ADDRESSES': [f'127.0.0.1:{base_port + 1 + i}' for i in range(brokers)],
+        'REPLICATION_ADDRESS': [f'127.0.0.1:{base_port + 101 + i}' for i in range(brokers)],
+        'PARTITION_REPLICAS': min(replicas or brokers, brokers),
+        'QUEUE_PARTITIONS': partitions,
+    }
+
+
+def apply_settings(settings: Dict):
+    config.DEFAULTS.update(settings)
+
+
+class LocalCluster:
+    """
+    Starts the servers of a cluster, waits until the load balancer sees every broker, and stops them and wipes
+    their data once done.
+    """
+
+    def __init__(self, settings: Dict, in_process: bool = False, log_dir: Path | None = None):
+        """
+        :param settings: of the cluster, see `cluster_settings`, already applied in this process
+        :param in_process: run the servers in the running event loop instead of subprocesses
+        :param log_dir: where the subprocesses log to, nowhere if None
+        """
+        self._settings: Dict = settings
+        self._in_process: bool = in_process
+        self._log_dir: Path | None = log_dir
+
+        self._processes: List[subprocess.Popen] = list()
+        self._servers: List = list()
+        self._tasks: List[asyncio.Task] = list()
+
+    @property
+    def brokers(self) -> List[str]:
+        return self._settings['BROKER_ADDRESSES']
+
+    @property
+    def servers(self) -> List:
+        """
+        The servers run in process: the load balancer, then the brokers in the order of `brokers`.
+        :return:
+        """
+        return self._servers
+
+    async def start(self, timeout: float = 30):
+        self._wipe()
+
+        if self._in_process:
+            await self._start_in_process()
+        else:
+            self._start_processes()
+
+        await self.wait_until_ready(timeout)
+
+    async def stop(self):
+        for server in self._servers:
+            await server.stop()
+
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+        for process in self._processes:
+            process.send_signal(signal.SIGTERM)
+
+        for process in self._processes:
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, process.wait, 10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+        self._servers, self._tasks, self._processes = list(), list(), list()
+        self._wipe()
+
+    async def wait_until_ready(self, timeout: float):
+        """
+        Wait until the load balancer sees every broker alive and a queue can be created, which takes the brokers
+        to have elected the leader of the catalog.
+        :param timeout:
+        :return:
+        """
+        from RDQueue.common.address import address_factory
+        from RDQueue.common.message import message_factory
+
+        load_balancer = address_factory.from_str(self._settings['LOAD_BALANCER_ADDRESS'])
+        broker = address_factory.from_str(self.brokers[0])
+        deadline = time.monotonic() + timeout
+
+        def alive(response) -> bool:
+            return len(response.body['brokers']['alive']) == len(self.brokers)
+
+        await self._wait_for(load_balancer, message_factory.broker_info_req, None, alive, deadline)
+        await self._wait_for(broker, message_factory.queue_create_req, {'name': 'benchmark-warmup', 'partitions': 1},
+                             lambda _: True, deadline)
+
+    @staticmethod
+    async def _wait_for(address, request, body, is_ready, deadline: float):
+        from RDQueue.common.connection import Connection
+
+        connection = Connection(address)
+
+        try:
+            while time.monotonic() < deadline:
+                try:
+                    response = await connection.request(request(sender_addr=address.connection_str,
+                                                                 receiver_addr=address.connection_str, body=body))
+
+                    if response.is_ok and is_ready(response):
+                        return
+                except Exception as e:
+                    logger.debug(f'Cluster not ready yet: {e!r}')
+
+                await asyncio.sleep(0.2)
+        finally:
+            await connection.close()
+
+        raise TimeoutError(f'The cluster at {address} is not ready')
+
+    def _start_processes(self):
+        roles = ['loadbalancer'] + [f'broker:{i}' for i in range(len(self.brokers))]
+
+        for role in roles:
+            output = subprocess.DEVNULL
+
+            if self._log_dir is not None:
+                self._log_dir.mkdir(parents=True, exist_ok=True)
+                output = open(self._log_dir / f'{role.replace(":", "-")}.log', 'w')
+
+            self._processes.append(subprocess.Popen(
+                [sys.executable, '-m', 'RDQueue.benchmark.cluster', '--serve', role,
+                 '--settings', json.dumps(self._settings)],
+                stdout=output, stderr=subprocess.STDOUT
+            ))
+
+    async def _start_in_process(self):
+        from RDQueue.common.address import address_factory
+        from RDQueue.common.config import settings
+        from RDQueue.server.broker import Broker
+        from RDQueue.server.loadbalancer import LoadBalancer
+
+        self._servers.append(LoadBalancer(
+            connection_address=settings.LOAD_BALANCER_ADDRESS,
+            brokers=set(settings.BROKER_ADDRESSES)
+        ))
+        self._servers.extend(Broker(address_factory.from_str(address)) for address in self.brokers)
+        self._tasks = [asyncio.create_task(server.start()) for server in self._servers]
+
+    def _wipe(self):
+        for broker in self.brokers:
+            for directory in ('snapshots', 'data'):
+                shutil.rmtree(SERVER_DIR / directory / broker, ignore_errors=True)
+
+
+def serve(role: str):
+    """
+    Run one server of the cluster, with the settings already applied.
+    :param role: `loadbalancer` or `broker:<index>`
+    :return:
+    """
+    from RDQueue.common.config import settings
+
+    if role == 'loadbalancer':
+        from RDQueue.server.loadbalancer import main as run_load_balancer
+
+        asyncio.run(run_load_balancer())
+        return
+
+    from RDQueue.server.broker import serve as run_brokers
+
+    asyncio.run(run_brokers([settings.BROKER_ADDRESSES[int(role.split(':')[1])]]))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Run a local cluster on loopback')
+    arg_parser.add_argument('--brokers', type=int, default=3)
+    arg_parser.add_argument('--base-port', type=int, default=19090)
+    arg_parser.add_argument('--replicas', type=int, help='Replicas of every partition, all the brokers by default')
+    arg_parser.add_argument('--serve', type=str, help=argparse.SUPPRESS)
+    arg_parser.add_argument('--settings', type=str, help=argparse.SUPPRESS)
+    args = arg_parser.parse_args()
+
+    if args.serve:
+        apply_settings(json.loads(args.settings))
+        serve(args.serve)
+        return
+
+    settings = cluster_settings(args.brokers, args.base_port, args.replicas)
+    apply_settings(settings)
+
+    async def run():
+        cluster = LocalCluster(settings)
+        await cluster.start()
+        print(json.dumps(settings, indent=2))
+
+        stopped = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            asyncio.get_running_loop().add_signal_handler(sig, stopped.set)
+
+        await stopped.wait()
+        await cluster.stop()
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
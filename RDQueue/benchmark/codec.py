@@ -0,0 +1,66 @@
+"""
+Microbenchmark of the message wire encoding: the original dict encoding with uuid ids against the array encoding.
+
+    python -m RDQueue.benchmark.codec --iterations 100000
+"""
+import argparse
+import timeit
+import uuid
+
+from RDQueue.common.message import WIRE_FORMAT_ARRAY, WIRE_FORMAT_LEGACY, Message, message_factory
+
+SENDER_ADDR = '127.0.0.1:5000'
+RECEIVER_ADDR = '127.0.0.1:9091'
+
+
+def legacy_message(body, sender_id: str) -> Message:
+    # what every message used to cost: a fresh uuid4 hex id
+    return message_factory.queue_push_req(SENDER_ADDR, RECEIVER_ADDR, sender_id=sender_id, _id=uuid.uuid4().hex,
+                                          body=body)
+
+
+def array_message(body, sender_id: str) -> Message:
+    return message_factory.queue_push_req(SENDER_ADDR, RECEIVER_ADDR, sender_id=sender_id, body=body)
+
+
+def bench(name: str, statement, iterations: int) -> float:
+    seconds = min(timeit.repeat(statement, number=iterations, repeat=5))
+    ns_per_op = seconds / iterations * 1e9
+    print(f'{name:<28} {ns_per_op:>10.0f} ns/op')
+    return ns_per_op
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Benchmark the message wire encodings')
+    arg_parser.add_argument('--iterations', type=int, default=100_000)
+    arg_parser.add_argument('--payload', type=int, default=64, help='Size of the pushed payload in bytes')
+    args = arg_parser.parse_args()
+
+    body = {'queue_name': 'bench', 'message': 'x' * args.payload}
+    sender_id = uuid.uuid4().hex
+
+    legacy = legacy_message(body, sender_id)
+    legacy_bytes = legacy.to_bytes(WIRE_FORMAT_LEGACY)
+    array = array_message(body, sender_id)
+    array_bytes = array.to_bytes(WIRE_FORMAT_ARRAY)
+
+    print(f'{"frame size (legacy)":<28} {len(legacy_bytes):>10} bytes')
+    print(f'{"frame size (array)":<28} {len(array_bytes):>10} bytes')
+
+    results = {
+        'create (legacy)': bench('create (legacy)', lambda: legacy_message(body, sender_id), args.iterations),
+        'create (array)': bench('create (array)', lambda: array_message(body, sender_id), args.iterations),
+        'encode (legacy)': bench('encode (legacy)', lambda: legacy.to_bytes(WIRE_FORMAT_LEGACY), args.iterations),
+        'encode (array)': bench('encode (array)', lambda: array.to_bytes(WIRE_FORMAT_ARRAY), args.iterations),
+        'decode (legacy)': bench('decode (legacy)', lambda: Message.from_bytes(legacy_bytes), args.iterations),
+        'decode (array)': bench('decode (array)', lambda: Message.from_bytes(array_bytes), args.iterations),
+    }
+
+    legacy_total = results['create (legacy)'] + results['encode (legacy)'] + results['decode (legacy)']
+    array_total = results['create (array)'] + results['encode (array)'] + results['decode (array)']
+    print(f'{"round trip speedup":<28} {legacy_total / array_total:>10.2f}x')
+    print(f'{"wire bytes saved":<28} {1 - len(array_bytes) / len(legacy_bytes):>10.0%}')
+
+
+if __name__ == '__main__':
+    main()
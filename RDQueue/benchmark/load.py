@@ -0,0 +1,268 @@
+"""
+Load and latency benchmark of a cluster: producers push to and consumers pop from a set of queues,
+and the throughput and latency percentiles of every operation are reported as JSON.
+
+    python -m RDQueue.benchmark.load --brokers 3 --producers 4 --consumers 2 --messages 10000 --size 100
+    python -m RDQueue.benchmark.load --external --output results.json
+
+A local cluster is started on loopback unless `--external` is given, which uses the configured cluster.
+Every consumer reads every message pushed to its queue, from its own position.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import platform
+import subprocess
+import time
+from pathlib import Path
+from typing import Dict, List
+
+from RDQueue.benchmark.cluster import LocalCluster, apply_settings, cluster_settings
+
+# consumers push one to every partition of their queue, which registers them before the producers start
+MARKER = {'benchmark': 'consumer'}
+
+
+def percentile(values: List[float], q: float) -> float:
+    """
+    :param values: sorted
+    :param q: between 0 and 1
+    :return:
+    """
+    if not values:
+        return 0.0
+
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Recorder:
+    """
+    The latencies of the requests of one operation, and the messages they carried.
+    """
+
+    def __init__(self):
+        self._latencies: List[float] = list()
+        self._messages: int = 0
+        self._errors: int = 0
+        self._started: float | None = None
+        self._finished: float | None = None
+
+    def record(self, started: float, messages: int = 1):
+        now = time.perf_counter()
+        self._latencies.append(now - started)
+        self._messages += messages
+        self._started = started if self._started is None else min(self._started, started)
+        self._finished = now if self._finished is None else max(self._finished, now)
+
+    def error(self):
+        self._errors += 1
+
+    def report(self) -> Dict:
+        latencies = sorted(self._latencies)
+        elapsed = (self._finished - self._started) if latencies else 0.0
+
+        return {
+            'requests': len(latencies),
+            'messages': self._messages,
+            'errors': self._errors,
+            'seconds': round(elapsed, 6),
+            'messages_per_second': round(self._messages / elapsed, 1) if elapsed else 0.0,
+            'latency_ms': {
+                'mean': round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0,
+                'p50': round(percentile(latencies, 0.5) * 1000, 3),
+                'p99': round(percentile(latencies, 0.99) * 1000, 3),
+                'p999': round(percentile(latencies, 0.999) * 1000, 3),
+                'max': round(latencies[-1] * 1000, 3) if latencies else 0.0,
+            },
+        }
+
+
+class LoadBenchmark:
+    def __init__(self, args: argparse.Namespace):
+        self._args: argparse.Namespace = args
+        self._register = Recorder()
+        self._push = Recorder()
+        self._pop = Recorder()
+
+    async def run(self) -> Dict:
+        # imported once the settings of the cluster are applied
+        from RDQueue.client.dq import DQueue
+        from RDQueue.common.address import address_factory
+        from RDQueue.common.config import settings
+
+        args = self._args
+        queues = [f'bench-{i}' for i in range(args.queues)]
+        client_addr = address_factory.from_str('127.0.0.1:5000')
+
+        async def register(queue_name: str) -> DQueue:
+            queue = DQueue(connection_addr=client_addr, name=queue_name, partitions=args.partitions)
+            started = time.perf_counter()
+            await queue.async_init()
+            self._register.record(started)
+            return queue
+
+        producers = [await register(queues[i % len(queues)]) for i in range(args.producers)]
+        consumers = [await register(queues[i % len(queues)]) for i in range(args.consumers)]
+
+        for consumer in consumers:
+            await self._register_consumer(consumer)
+
+        # every consumer reads what every producer of its queue pushes
+        expected = {name: args.messages * sum(1 for p in producers if p.name == name) for name in queues}
+        payload = 'x' * args.size
+        deadline = time.monotonic() + args.timeout
+
+        started = time.perf_counter()
+        await asyncio.gather(
+            *(self._produce(producer, payload) for producer in producers),
+            *(self._consume(consumer, expected[consumer.name], deadline) for consumer in consumers)
+        )
+        elapsed = time.perf_counter() - started
+
+        await asyncio.gather(*(queue.close() for queue in producers + consumers))
+
+        return {
+            'benchmark': 'load',
+            'timestamp': time.time(),
+            'version': git_revision(),
+            'python': platform.python_version(),
+            'cluster': {
+                'brokers': len(settings.BROKER_ADDRESSES),
+                'replicas': settings.PARTITION_REPLICAS,
+                'external': args.external,
+                'in_process': args.in_process,
+            },
+            'config': {
+                'producers': args.producers,
+                'consumers': args.consumers,
+                'queues': args.queues,
+                'partitions': args.partitions,
+                'messages': args.messages,
+                'size': args.size,
+                'batch': args.batch,
+                'pop_batch': args.pop_batch,
+                'concurrency': args.concurrency,
+            },
+            'seconds': round(elapsed, 6),
+            'results': {
+                'register': self._register.report(),
+                'push': self._push.report(),
+                'pop': self._pop.report(),
+            },
+        }
+
+    async def _register_consumer(self, queue):
+        from RDQueue.common.partitioning import partition_for_key
+
+        # a client pops from a partition once it pushed to it
+        for partition in range(queue.partitions):
+            key = next(key for key in itertools.count() if partition_for_key(key, queue.partitions) == partition)
+            await queue.push(MARKER, key=key)
+
+    async def _produce(self, queue, payload: str):
+        args = self._args
+        batches = itertools.count()
+        total = -(-args.messages // args.batch)
+
+        async def pusher():
+            while (batch := next(batches)) < total:
+                size = min(args.batch, args.messages - batch * args.batch)
+                started = time.perf_counter()
+
+                try:
+                    if args.batch == 1:
+                        await queue.push(payload)
+                    else:
+                        await queue.push_many([payload] * size, batch_size=size)
+                except Exception:
+                    self._push.error()
+                    continue
+
+                self._push.record(started, size)
+
+        await asyncio.gather(*(pusher() for _ in range(args.concurrency)))
+
+    async def _consume(self, queue, expected: int, deadline: float):
+        args = self._args
+        consumed = 0
+
+        while consumed < expected and time.monotonic() < deadline:
+            started = time.perf_counter()
+
+            try:
+                if args.pop_batch == 1:
+                    item = await queue.pop(wait=1)
+                    items = [] if item is None else [item]
+                else:
+                    items = await queue.pop_many(args.pop_batch, wait=1)
+            except Exception:
+                self._pop.error()
+                continue
+
+            items = [item for item in items if item != MARKER]
+
+            if items:
+                consumed += len(items)
+                self._pop.record(started, len(items))
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=Path(__file__).parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args: argparse.Namespace) -> Dict:
+    cluster = None
+
+    if not args.external:
+        settings = cluster_settings(args.brokers, args.base_port, args.replicas)
+        apply_settings(settings)
+        cluster = LocalCluster(settings, in_process=args.in_process, log_dir=args.log_dir)
+        await cluster.start()
+
+    try:
+        return await LoadBenchmark(args).run()
+    finally:
+        if cluster is not None:
+            await cluster.stop()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Benchmark the throughput and latency of a cluster')
+    arg_parser.add_argument('--external', action='store_true', help='Use the configured cluster instead of a local one')
+    arg_parser.add_argument('--in-process', action='store_true', help='Run the local cluster in this process')
+    arg_parser.add_argument('--brokers', type=int, default=3)
+    arg_parser.add_argument('--replicas', type=int, help='Replicas of every partition, all the brokers by default')
+    arg_parser.add_argument('--base-port', type=int, default=19090)
+    arg_parser.add_argument('--log-dir', type=Path, help='Where the servers of the local cluster log to')
+    arg_parser.add_argument('--producers', type=int, default=4)
+    arg_parser.add_argument('--consumers', type=int, default=2)
+    arg_parser.add_argument('--queues', type=int, default=1)
+    arg_parser.add_argument('--partitions', type=int, default=None, help='Of every queue, the broker default if unset')
+    arg_parser.add_argument('--messages', type=int, default=10_000, help='Messages pushed by every producer')
+    arg_parser.add_argument('--size', type=int, default=100, help='Size of a message in bytes')
+    arg_parser.add_argument('--batch', type=int, default=1, help='Messages per push request')
+    arg_parser.add_argument('--pop-batch', type=int, default=1, help='Messages per pop request')
+    arg_parser.add_argument('--concurrency', type=int, default=1, help='Requests in flight per producer')
+    arg_parser.add_argument('--timeout', type=float, default=300, help='Seconds the consumers wait for the messages')
+    arg_parser.add_argument('--output', type=Path, help='File the JSON results are written to, stdout if unset')
+    args = arg_parser.parse_args()
+
+    # the clients log every request
+    logging.disable(logging.WARNING)
+
+    results = json.dumps(asyncio.run(run(args)), indent=2)
+
+    if args.output is None:
+        print(results)
+    else:
+        args.output.write_text(results + '\n')
+
+
+if __name__ == '__main__':
+    main()
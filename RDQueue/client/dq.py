@@ -1,146 +1,331 @@
 import asyncio
+import itertools
 import logging
+import math
+import random
+import time
 import uuid
-from tenacity import retry, wait_fixed, wait_random, retry_if_exception_type
+from typing import AsyncIterator, Dict, Iterable, Iterator, List, Set, Tuple
 
+from tenacity import retry, wait_random_exponential, retry_if_exception_type
+
+from RDQueue.client.prefetch import Prefetcher
+from RDQueue.client.producer import Producer
 from RDQueue.common.address import Address, address_factory
 from RDQueue.common.config import settings
-from RDQueue.common.decorator import periodic_task
-from RDQueue.common.exceptions import NoBrokerAvailable
+from RDQueue.common.connection import Connection
+from RDQueue.common.exceptions import NoBrokerAvailable, RequestFailed
 from RDQueue.common.message import message_factory
-from RDQueue.common.networking import send_message_to_writer, receive_message
+from RDQueue.common.partitioning import partition_for_key
 
 logger = logging.getLogger(__file__)
 logging.basicConfig(level=logging.INFO)
 
+# error responses for requests the broker could not replicate, forward or make room for, as opposed to invalid requests
+RETRYABLE_ERRORS = {'NoLeaderAvailable', 'ReplicationTimeout', 'ReplicationFailed', 'NoBrokerAvailable', 'Overloaded'}
+
+# every broker known to the client was tried, wait a little longer after each round so that
+# the clients of a failed cluster do not hammer it all at once
+retry_wait = wait_random_exponential(multiplier=settings.CLIENT_RETRY_BACKOFF, max=settings.CLIENT_RETRY_MAX_BACKOFF)
+retry_unavailable = retry(wait=retry_wait, retry=retry_if_exception_type(NoBrokerAvailable))
+
 
 class DQueue:
-    def __init__(self, connection_addr: Address, name: str):
+    def __init__(self, connection_addr: Address, name: str, partitions: int | None = None):
         self._connection_addr: Address = connection_addr
         self._name: str = name
         self.id = str(uuid.uuid4().hex)
 
+        # requested number of partitions, the broker default if None; ignored if the queue already exists
+        self._requested_partitions: int | None = partitions
+        # owners of every partition, the first one is tried first
+        self._partitions: List[List[Address]] = list()
+        self._connections: Dict[Address, Connection] = dict()
+        self._next_partition = itertools.count()
+        self._next_pop = itertools.count()
+
         self._remote_queue_id: str | None = None
         self._remote_queue_name: str | None = None
         self._broker_addr: Address | None = None
         self._broker_id: str | None = None
-        self._broker_writer: asyncio.StreamWriter | None = None
-        self._broker_reader: asyncio.StreamReader | None = None
+
+        # every broker of the cluster, and the ones suspected to be down, as pushed by the load balancer
+        # and as seen failing by this client. The load balancer is only asked when none of them answers
+        self._brokers: List[Address] = list()
+        self._suspected: Set[Address] = set()
+        self._failed_at: Dict[Address, float] = dict()
+        self._lb_conn: Connection = Connection(settings.LOAD_BALANCER_ADDRESS)
+        self._membership_task: asyncio.Task | None = None
+        self._producers: List[Producer] = list()
 
     async def async_init(self):
         await self.get_broker_information()
-        await self.init_broker_writer_reader()
+        await self.init_broker_connection()
         await self.create_queue()
 
-    @retry(wait=wait_fixed(5) + wait_random(0, 2), retry=retry_if_exception_type(NoBrokerAvailable))
-    async def init_broker_writer_reader(self):
+        if self._membership_task is None:
+            self._membership_task = asyncio.create_task(self.watch_membership())
+
+    @retry_unavailable
+    async def init_broker_connection(self):
 
         if self.broker_addr is None:
             await self.get_broker_information()
 
-        if self._broker_writer is None or self._broker_reader is None:
-            reader, writer = await asyncio.open_connection(
-                self.broker_addr.host_str,
-                self.broker_addr.port
-            )
+        await self._get_connection(self.broker_addr).connect()
+
+    def _get_connection(self, address: Address) -> Connection:
+        connection = self._connections.get(address)
+
+        if connection is None:
+            # give the broker the time to replicate a request before giving up on it
+            connection = self._connections[address] = Connection(
+                address, request_timeout=settings.REPLICATION_TIMEOUT + 1)
+
+        return connection
+
+    def _is_suspected(self, address: Address) -> bool:
+        # a broker that just failed a request is avoided for a while, even if the load balancer still sees it
+        failed_for = time.monotonic() - self._failed_at.get(address, -math.inf)
+        return address in self._suspected or failed_for < settings.CLIENT_FAILURE_MEMORY
+
+    def _ordered(self, addresses: Iterable[Address]) -> List[Address]:
+        # brokers suspected to be down are only tried last
+        return sorted(addresses, key=self._is_suspected)
 
-            self._broker_reader = reader
-            self._broker_writer = writer
+    def _mark_failed(self, address: Address):
+        self._failed_at[address] = time.monotonic()
 
-    @periodic_task(interval=5)
-    async def check_broker_connection(self):
+        if address == self._broker_addr:
+            healthy = [broker for broker in self._brokers if not self._is_suspected(broker)]
+            self._broker_addr = healthy[0] if healthy else None
+
+    async def _broker_request(self, message):
+        """
+        Send a request that any broker can serve, to the current broker first and then to the other known
+        brokers in turn, without waiting in between.
+        :param message:
+        :return:
+        """
         if self.broker_addr is None:
             await self.get_broker_information()
 
-        else:
+        candidates = self._ordered(dict.fromkeys([self.broker_addr, *self._brokers]))
+
+        for address in candidates:
             try:
-                # Enforce a timeout for the connection attempt
-                await asyncio.wait_for(
-                    asyncio.open_connection(*self.broker_addr.tuple),
-                    timeout=1  # Timeout duration in seconds
-                )
-            except asyncio.TimeoutError:
-                self._broker_addr = None
-                logger.error(f'Broker {self.broker_addr} is not available (connection timed out).')
-                return
-            except Exception as e:
-                self._broker_addr = None
-                logger.error(f'Broker {self.broker_addr} is not available: {e}.')
-                return
+                response = self._check_response(address, message, await self._get_connection(address).request(message))
+            except NoBrokerAvailable:
+                logger.warning(f'Broker {address} is not available for {message.operation.name}, trying the next one')
+                self._mark_failed(address)
+                continue
+
+            self._broker_addr = address
+            return response
+
+        # none of the known brokers answered, the next attempt asks the load balancer again
+        self._broker_addr = None
+        self._brokers = list()
+        raise NoBrokerAvailable()
+
+    async def _partition_request(self, partition: int, request, body: dict, timeout: float | None = None):
+        """
+        Send a request to the first available owner of a partition.
+        :param partition:
+        :param request: the message factory method building the request
+        :param body:
+        :param timeout: of the request, the one of the connection if None
+        :return: the response
+        """
+        if not self._partitions:
+            await self.get_partition_map()
+
+        for address in self._ordered(self._partitions[partition]):
+            message = request(
+                sender_addr=self.connection_addr.connection_str,
+                receiver_addr=address.connection_str,
+                sender_id=self.id,
+                body={'queue_name': self.name, 'partition': partition, **body}
+            )
+
+            try:
+                response = await self._get_connection(address).request(message, timeout=timeout)
+                return self._check_response(address, message, response)
+            except NoBrokerAvailable:
+                logger.warning(f'Owner {address} of partition {partition} of queue {self.name} is not available')
+
+                # the partitions moved, the request is retried once they are looked up again
+                if not self._partitions:
+                    break
+
+                self._mark_failed(address)
+
+        raise NoBrokerAvailable()
+
+    def _check_response(self, address: Address, message, response):
+        if response.is_ok or not isinstance(response.body, dict):
+            return response
+
+        error = response.body.get('error')
+
+        # the broker could not replicate the request, it may be retried once the cluster has a leader again
+        if error in RETRYABLE_ERRORS:
+            logger.error(f'Broker {address} failed {message.operation.name}: {response.body["message"]}')
+            raise NoBrokerAvailable()
+
+        # the partitions moved, they are looked up again on the next request
+        if error == 'NotPartitionOwner':
+            logger.warning(f'{response.body["message"]}, refreshing the partition map of queue {self.name}')
+            self._partitions = list()
+            raise NoBrokerAvailable()
+
+        return response
+
+    async def close(self):
+        await asyncio.gather(*(producer.close() for producer in self._producers))
+
+        if self._membership_task is not None:
+            self._membership_task.cancel()
+            self._membership_task = None
+
+        connections, self._connections = self._connections, dict()
+        await asyncio.gather(*(connection.close() for connection in connections.values()))
+        await self._lb_conn.close()
+
+    async def watch_membership(self):
+        """
+        Follow the brokers of the cluster and the ones suspected to be down, as the load balancer pushes every
+        change over a single long-lived connection. The client moves off its broker as soon as it is suspected.
+        :return:
+        """
+        while True:
+            try:
+                updates = await self._lb_conn.subscribe(message_factory.membership_req(
+                    sender_addr=self.connection_addr.connection_str,
+                    receiver_addr=settings.LOAD_BALANCER_ADDRESS.connection_str,
+                    sender_id=self.id
+                ))
+
+                while not isinstance(update := await updates.get(), Exception):
+                    self._set_membership(update.body)
+            except NoBrokerAvailable:
+                pass
+
+            logger.warning(f'{self.name} lost the membership updates of the load balancer, subscribing again')
+            await asyncio.sleep(settings.HEARTBEAT_RECONNECT_INTERVAL)
+
+    def _set_membership(self, membership: dict):
+        alive = [address_factory.from_str(address) for address in membership['alive']]
+        suspected = [address_factory.from_str(address) for address in membership['suspected']]
+
+        self._brokers = alive + suspected
+        self._suspected = set(suspected)
+
+        if self._broker_addr in self._suspected:
+            logger.warning(f'Broker {self._broker_addr} of {self.name} is suspected to be down, moving to {alive[:1]}')
+            self._broker_addr = alive[0] if alive else None
 
     async def get_broker_information(self):
 
         if self.broker_addr is not None:
             return
 
-        reader, writer = await asyncio.open_connection(
-            settings.LOAD_BALANCER_ADDRESS.host_str,
-            settings.LOAD_BALANCER_ADDRESS.port
-        )
-
         logger.info(
             f'{self.name}({self.connection_addr}) is getting broker information from load balancer: {settings.LOAD_BALANCER_ADDRESS}')
 
-        await send_message_to_writer(writer, message_factory.broker_info_req(
+        response = await self._lb_conn.request(message_factory.broker_info_req(
             sender_addr=self.connection_addr.connection_str,
             receiver_addr=settings.LOAD_BALANCER_ADDRESS.connection_str
         ))
 
-        logger.info(
-            f'{self.name}({self.connection_addr}) sent broker information request to load balancer: {settings.LOAD_BALANCER_ADDRESS}')
-        response = await receive_message(reader)
+        if not response.is_ok:
+            logger.error(f'{self.name} could not get a broker from load balancer: {response.body}')
+            raise NoBrokerAvailable()
+
         logger.info(f'{self.name} received broker information from load balancer: {response.body}')
+
+        # load balancers from before the membership only name the chosen broker
+        if response.body.get('brokers'):
+            self._set_membership(response.body['brokers'])
+
         self._broker_id = response.body['id']
         self._broker_addr = address_factory.from_str(response.body['address'])
 
+        if self._broker_addr not in self._brokers:
+            self._brokers.append(self._broker_addr)
+
         logger.info(f'{self.name} is connected to broker: {self.broker_addr}')
 
-    @retry(wait=wait_fixed(5) + wait_random(0, 2), retry=retry_if_exception_type((NoBrokerAvailable, AttributeError)))
+    @retry(wait=retry_wait, retry=retry_if_exception_type((NoBrokerAvailable, AttributeError)))
     async def create_queue(self):
 
         if self.broker_addr is None:
             await self.get_broker_information()
 
-        reader, writer = await asyncio.open_connection(
-            self.broker_addr.host_str,
-            self.broker_addr.port
-        )
-
         logger.info(f'Creating queue: {self.name}')
 
-        try:
-            await asyncio.wait_for(
-                send_message_to_writer(
-                    writer=writer,
-                    message=message_factory.queue_create_req(
-                        sender_addr=self.connection_addr.connection_str,
-                        receiver_addr=self.broker_addr.connection_str,
-                        sender_id=self.id,
-                        body=self.name
-                    )
-                ), timeout=3)
-        except asyncio.TimeoutError:
-            logger.error(f'Broker {self.broker_addr} is not available (connection timed out).')
-            raise NoBrokerAvailable()
-
-        logger.info(f'Queue creation request sent to broker: {self.broker_addr}')
+        message = await self._broker_request(message_factory.queue_create_req(
+            sender_addr=self.connection_addr.connection_str,
+            receiver_addr=self.broker_addr.connection_str,
+            sender_id=self.id,
+            body={
+                'name': self.name,
+                'partitions': self._requested_partitions
+            }
+        ))
 
-        try:
-            message = await asyncio.wait_for(
-                receive_message(reader=reader),
-                timeout=3
-            )
-        except asyncio.TimeoutError:
-            logger.error(f'Broker {self.broker_addr} is not available to receive message (connection timed out).')
-            raise NoBrokerAvailable()
+        if not message.is_ok:
+            raise RequestFailed(message.body['error'], message.body['message'])
 
         logger.info(f'Queue created: {message.body}')
 
         self._remote_queue_id = message.body['id']
         self._remote_queue_name = message.body['name']
+        self._set_partition_map(message.body.get('partitions'))
+
+    @retry_unavailable
+    async def get_partition_map(self):
+        """
+        Fetch the owners of every partition of the queue.
+        :return:
+        """
+        if self.broker_addr is None:
+            await self.get_broker_information()
+
+        message = await self._broker_request(message_factory.partition_map_req(
+            sender_addr=self.connection_addr.connection_str,
+            receiver_addr=self.broker_addr.connection_str,
+            sender_id=self.id,
+            body=self.name
+        ))
+
+        if not message.is_ok:
+            logger.error(f'Could not get the partition map of queue {self.name}: {message.body}')
+            raise NoBrokerAvailable()
+
+        self._set_partition_map(message.body['partitions'])
+
+    def _set_partition_map(self, partitions: List[List[str]] | None):
+        if not partitions:
+            # brokers that do not partition queues serve the whole queue themselves
+            self._partitions = [[self.broker_addr]]
+            return
+
+        self._partitions = [[address_factory.from_str(address) for address in owners] for owners in partitions]
+        logger.info(f'Queue {self.name} has {len(self._partitions)} partitions: {self._partitions}')
+
+    def _choose_partition(self, key=None) -> int:
+        """
+        Messages with a key always go to the same partition, the others are spread over the partitions in turn.
+        :param key:
+        :return:
+        """
+        partitions = max(len(self._partitions), 1)
+
+        if key is not None:
+            return partition_for_key(key, partitions)
 
-        writer.close()
-        await writer.wait_closed()
+        return next(self._next_partition) % partitions
 
     @property
     def connection_addr(self):
@@ -158,66 +343,361 @@ class DQueue:
     def broker_addr(self):
         return self._broker_addr
 
-    @retry(wait=wait_fixed(5) + wait_random(0, 2), retry=retry_if_exception_type(NoBrokerAvailable))
-    async def push(self, data):
-        if self.broker_addr is None:
-            raise NoBrokerAvailable()
-
-        logger.info(f'Pushing data = {data} to queue: {self.name} to broker: {self.broker_addr}')
+    @property
+    def partitions(self) -> int:
+        return len(self._partitions)
+
+    @retry_unavailable
+    async def push(self, data, key=None):
+        """
+        Push an item to the partition chosen by `key`, or to the next partition if it has no key.
+        :param data:
+        :param key:
+        :return:
+        """
+        if not self._partitions:
+            await self.get_partition_map()
+
+        partition = self._choose_partition(key)
+
+        message = await self._partition_request(partition, message_factory.queue_push_req, {'message': data})
+
+        logger.debug('Pushed to partition %d of queue %s: %s', partition, self.name, message.body,
+                     extra={'operation': 'QUEUE_PUSH'})
+
+    @retry_unavailable
+    async def pop(self, wait: float = 0):
+        """
+        Pop the next item of the first partition, starting from a different one on every call, that has one.
+        A broker failing the pop for a reason that retrying would not fix raises `RequestFailed`.
+        :param wait: seconds to wait for an item to be pushed if the client has caught up on every partition
+        :return: the item, None if the client has caught up on every partition
+        """
+        if not self._partitions:
+            await self.get_partition_map()
+
+        if wait and len(self._partitions) == 1:
+            # the broker waits and pops in one go
+            message = await self._partition_request(0, message_factory.queue_pop_req, {'wait': wait},
+                                                    timeout=self._wait_timeout(wait))
+            return self._popped(message)
+
+        deadline = time.monotonic() + wait
+
+        while True:
+            first = next(self._next_pop)
+
+            for i in range(len(self._partitions)):
+                partition = (first + i) % len(self._partitions)
+                message = await self._partition_request(partition, message_factory.queue_pop_req, {})
+                item = self._popped(message)
+
+                # None is the answer of a partition the client has caught up on
+                if item is not None:
+                    logger.debug('Popped from partition %d of queue %s', partition, self.name,
+                                 extra={'operation': 'QUEUE_POP'})
+                    return item
+
+            if not await self._wait_for_items(deadline - time.monotonic()):
+                break
+
+        logger.debug('Nothing popped from queue %s', self.name, extra={'operation': 'QUEUE_POP'})
+        return None
+
+    @staticmethod
+    def _popped(message):
+        """
+        The errors the client retries on, e.g. of a partition without a leader or that moved, were raised already by
+        `_check_response`.
+        :param message: the response to a pop
+        :return: what the broker popped, None or an empty list if the client has caught up on the partition
+        """
+        if not message.is_ok:
+            raise RequestFailed(message.body['error'], message.body['message'])
 
-        reader, writer = await asyncio.open_connection(
-            self.broker_addr.host_str,
-            self.broker_addr.port
-        )
+        return message.body
 
-        await send_message_to_writer(
-            writer=writer,
-            message=message_factory.queue_push_req(
-                sender_addr=self.connection_addr.connection_str,
-                receiver_addr=self.broker_addr.connection_str,
-                sender_id=self.id,
-                body={
-                    'queue_name': self.name,
-                    'message': data
-                }
-            )
-        )
+    async def _wait_for_items(self, wait: float) -> bool:
+        """
+        Wait until an item is pushed to any partition, without popping it.
+        :param wait:
+        :return: whether there are items to pop
+        """
+        if wait <= 0:
+            return False
+
+        waits = [
+            asyncio.create_task(self._partition_request(partition, message_factory.queue_pop_req,
+                                                        {'max_n': 0, 'wait': wait}, timeout=self._wait_timeout(wait)))
+            for partition in range(len(self._partitions))
+        ]
 
-        message = await receive_message(reader)
+        try:
+            for next_wait in asyncio.as_completed(waits):
+                try:
+                    message = await next_wait
+                except NoBrokerAvailable:
+                    continue
+
+                if message.is_ok and message.body:
+                    return True
+
+            return False
+        finally:
+            for pending in waits:
+                pending.cancel()
+
+    @staticmethod
+    def _wait_timeout(wait: float) -> float:
+        # the broker answers a waiting pop after the wait, plus the time to replicate it
+        return min(wait, settings.MAX_POP_WAIT) + settings.REPLICATION_TIMEOUT + 1
+
+    async def push_many(self, data: Iterable, batch_size: int = settings.MAX_BATCH_SIZE, key=None) -> int:
+        """
+        Push every item of `data`, sending up to `batch_size` items per request.
+        Every batch goes to the next partition, or all of them to the partition of `key`.
+        :param data:
+        :param batch_size:
+        :param key:
+        :return: the number of pushed items
+        """
+        pushed = 0
+
+        for batch in batched(data, batch_size):
+            pushed += await self._push_batch(batch, key)
+
+        return pushed
+
+    async def _push_batch(self, batch: List, key=None) -> int:
+        if not self._partitions:
+            await self.get_partition_map()
+
+        partition = self._choose_partition(key)
+
+        logger.debug('Pushing %d items to partition %d of queue %s', len(batch), partition, self.name,
+                     extra={'operation': 'QUEUE_PUSH_BATCH'})
+
+        return await self._send_batch(partition, batch)
+
+    @retry_unavailable
+    async def _send_batch(self, partition: int, batch: List) -> int:
+        """
+        Push a batch of items to a given partition.
+        :param partition:
+        :param batch:
+        :return: the number of pushed items
+        """
+        message = await self._partition_request(partition, message_factory.queue_push_batch_req, {'messages': batch})
+
+        if not message.is_ok:
+            raise RequestFailed(message.body['error'], message.body['message'])
 
-        logger.info(
-            f'Data = {data} pushed to queue: {self.name} to broker: {self.broker_addr} with status: {message.body}')
+        return message.body
 
-        writer.close()
-        await writer.wait_closed()
+    def producer(self, linger: float = settings.PRODUCER_LINGER, batch_bytes: int = settings.PRODUCER_BATCH_BYTES,
+                 buffer_bytes: int = settings.PRODUCER_BUFFER_BYTES, block: bool = True) -> Producer:
+        """
+        A producer pushing to this queue in batches, whose `push` returns a future instead of waiting for the broker:
+        `await (await producer.push(item))` waits for the acknowledgement, `await producer.flush()` for all of them.
+        It is flushed when the queue is closed.
+        :param linger: seconds the first item of a batch waits for more before the batch is sent
+        :param batch_bytes: a batch is sent as soon as its items take this many bytes
+        :param buffer_bytes: most bytes of items pushed and not acknowledged yet
+        :param block: whether a push waits for room in the buffer, or raises `ProducerBufferFull`
+        :return:
+        """
+        producer = Producer(self, linger=linger, batch_bytes=batch_bytes, buffer_bytes=buffer_bytes, block=block)
+        self._producers.append(producer)
+        return producer
+
+    @retry_unavailable
+    async def pop_many(self, max_n: int = settings.MAX_BATCH_SIZE, wait: float = 0) -> List:
+        """
+        Pop up to `max_n` items, taken from the partitions in turn, an empty list if the client has caught up.
+        A broker failing the pop for a reason that retrying would not fix raises `RequestFailed`.
+        :param max_n:
+        :param wait: seconds to wait for items to be pushed if the client has caught up on every partition
+        :return:
+        """
+        if not self._partitions:
+            await self.get_partition_map()
+
+        if wait and len(self._partitions) == 1:
+            # the broker waits and pops in one go
+            message = await self._partition_request(0, message_factory.queue_pop_req, {'max_n': max_n, 'wait': wait},
+                                                    timeout=self._wait_timeout(wait))
+            return self._popped(message)
+
+        items = []
+        deadline = time.monotonic() + wait
+
+        while True:
+            first = next(self._next_pop)
+
+            for i in range(len(self._partitions)):
+                partition = (first + i) % len(self._partitions)
+                message = await self._partition_request(partition, message_factory.queue_pop_batch_req,
+                                                        {'max_n': max_n - len(items)})
+
+                items.extend(self._popped(message))
+
+                if len(items) >= max_n:
+                    break
+
+            if items or not await self._wait_for_items(deadline - time.monotonic()):
+                break
+
+        logger.debug('%d items popped from queue %s', len(items), self.name, extra={'operation': 'QUEUE_POP_BATCH'})
+
+        return items
+
+    async def subscribe(self, window: int = settings.SUBSCRIBE_WINDOW) -> AsyncIterator:
+        """
+        Stream the items of every partition as they are pushed, without a request per item:
+        `async for item in dqueue.subscribe(): ...`
+        Each partition sends at most `window` items ahead of the ones consumed, the consumed ones are
+        credited back every half window. Items are popped as they are streamed: the ones received but not
+        consumed yet when the iteration stops are lost.
+        :param window:
+        :return:
+        """
+        if not self._partitions:
+            await self.get_partition_map()
+
+        items: asyncio.Queue = asyncio.Queue()
+        # the connection and the id of the current subscription to every partition, to credit it
+        streams: Dict[int, Tuple[Connection, int | str]] = dict()
+        consumed: Dict[int, int] = dict()
+        tasks = [
+            asyncio.create_task(self._stream_partition(partition, window, items, streams))
+            for partition in range(len(self._partitions))
+        ]
 
-    @retry(wait=wait_fixed(5) + wait_random(0, 2), retry=retry_if_exception_type(NoBrokerAvailable))
-    async def pop(self):
-        if self.broker_addr is None:
-            raise NoBrokerAvailable()
-
-        logger.info(f'Popping data from queue: {self.name} from broker: {self.broker_addr}')
+        try:
+            while True:
+                partition, item = await items.get()
+                yield item
+
+                consumed[partition] = consumed.get(partition, 0) + 1
+
+                if consumed[partition] >= max(window // 2, 1) and partition in streams:
+                    await self._grant(*streams[partition], consumed.pop(partition))
+        finally:
+            for task in tasks:
+                task.cancel()
+
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def consume(self, prefetch: int = settings.CONSUMER_PREFETCH, low_water: int | None = None,
+                      max_bytes: int = settings.CONSUMER_PREFETCH_BYTES) -> AsyncIterator:
+        """
+        Iterate over the items of the queue as they are pushed, popped ahead in batches into a bounded local buffer:
+        `async for item in dqueue.consume(): ...`
+        The items left in the buffer when the iteration stops are lost, as they were popped.
+        :param prefetch: most items popped ahead
+        :param low_water: items left in the buffer when it is refilled, a quarter of `prefetch` if None
+        :param max_bytes: the buffer is not refilled while its items take more than this
+        :return:
+        """
+        prefetcher = Prefetcher(self, prefetch=prefetch, low_water=low_water, max_bytes=max_bytes)
 
-        reader, writer = await asyncio.open_connection(
-            self.broker_addr.host_str,
-            self.broker_addr.port
-        )
+        try:
+            while True:
+                yield await prefetcher.get()
+        finally:
+            await prefetcher.close()
+
+    async def _stream_partition(self, partition: int, window: int, items: asyncio.Queue,
+                                streams: Dict[int, Tuple[Connection, int | str]]):
+        """
+        Keep a subscription to a partition open, subscribing again to the first available owner whenever it ends.
+        The broker keeps the position of the client, a new subscription starts where the last one stopped.
+        :param partition:
+        :param window:
+        :param items: where the items are put, with their partition
+        :param streams: where the current subscription is registered
+        :return:
+        """
+        attempt = 0
+
+        while True:
+            if not self._partitions:
+                try:
+                    await self.get_partition_map()
+                except NoBrokerAvailable:
+                    pass
+
+            for address in self._ordered(self._partitions[partition] if self._partitions else ()):
+                connection = self._get_connection(address)
+                request = message_factory.subscribe_req(
+                    sender_addr=self.connection_addr.connection_str,
+                    receiver_addr=address.connection_str,
+                    sender_id=self.id,
+                    body={'queue_name': self.name, 'partition': partition, 'credits': window}
+                )
 
-        await send_message_to_writer(
-            writer=writer,
-            message=message_factory.queue_pop_req(
+                try:
+                    updates = await connection.subscribe(request)
+                except NoBrokerAvailable:
+                    self._mark_failed(address)
+                    continue
+
+                streams[partition] = (connection, request.id)
+                logger.info(f'{self.name} subscribed to partition {partition} at {address}')
+
+                try:
+                    while not isinstance(update := await updates.get(), Exception):
+                        if not update.is_ok:
+                            self._check_response(address, request, update)
+                            logger.error(f'Subscription to partition {partition} ended: {update.body}')
+                            break
+
+                        attempt = 0
+                        for item in update.body:
+                            items.put_nowait((partition, item))
+                except NoBrokerAvailable:
+                    pass
+                finally:
+                    streams.pop(partition, None)
+                    connection.unsubscribe(request.id)
+
+                    if connection.is_connected:
+                        await self._unsubscribe(connection, request.id)
+
+                self._mark_failed(address)
+                break
+
+            # jittered like the retries of the requests
+            backoff = min(settings.CLIENT_RETRY_BACKOFF * 2 ** attempt, settings.CLIENT_RETRY_MAX_BACKOFF)
+            attempt += 1
+            await asyncio.sleep(random.uniform(0, backoff))
+
+    async def _grant(self, connection: Connection, subscription: int | str, credits: int):
+        try:
+            await connection.send(message_factory.credit_req(
                 sender_addr=self.connection_addr.connection_str,
-                receiver_addr=self.broker_addr.connection_str,
+                receiver_addr=connection.address.connection_str,
                 sender_id=self.id,
-                body=self.name
-            )
-        )
+                body={'subscription': subscription, 'credits': credits}
+            ))
+        except NoBrokerAvailable:
+            # the subscription ended with the connection, the next one starts with a full window
+            pass
 
-        message = await receive_message(reader)
+    async def _unsubscribe(self, connection: Connection, subscription: int | str):
+        try:
+            await connection.send(message_factory.unsubscribe_req(
+                sender_addr=self.connection_addr.connection_str,
+                receiver_addr=connection.address.connection_str,
+                sender_id=self.id,
+                body={'subscription': subscription}
+            ))
+        except NoBrokerAvailable:
+            pass
 
-        logger.info(f'Data = {message.body} popped from queue: {self.name} from broker: {self.broker_addr}')
 
-        writer.close()
-        await writer.wait_closed()
+def batched(iterable: Iterable, size: int) -> Iterator[List]:
+    iterator = iter(iterable)
 
-        return message.body
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
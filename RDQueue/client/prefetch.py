@@ -0,0 +1,143 @@
+import asyncio
+import collections
+import logging
+from typing import TYPE_CHECKING, Any, Deque, Tuple
+
+import msgpack
+
+from RDQueue.common.config import settings
+
+if TYPE_CHECKING:
+    from RDQueue.client.dq import DQueue
+
+logger = logging.getLogger(__file__)
+
+
+def item_size(item) -> int:
+    """
+    The size of an item as it was sent, which is about what it holds in memory for strings and bytes.
+    :param item:
+    :return:
+    """
+    if isinstance(item, (bytes, str)):
+        return len(item)
+
+    return len(msgpack.packb(item))
+
+
+class Prefetcher:
+    """
+    Keeps items popped ahead of the consumer in a local buffer, refilled in the background with batched pops
+    whenever it drops to its low-water mark, so that the consumer rarely waits for a round trip to the broker.
+    The buffer is bounded both in items and in bytes.
+    """
+
+    def __init__(self, queue: 'DQueue', prefetch: int = settings.CONSUMER_PREFETCH, low_water: int | None = None,
+                 max_bytes: int = settings.CONSUMER_PREFETCH_BYTES, wait: float = settings.MAX_POP_WAIT):
+        """
+        :param queue:
+        :param prefetch: most items held in the buffer
+        :param low_water: items left in the buffer when it is refilled, a quarter of `prefetch` if None
+        :param max_bytes: the buffer is not refilled while its items take more than this
+        :param wait: seconds a refill waits for items to be pushed once the consumer has caught up, before trying again
+        """
+        self._queue: 'DQueue' = queue
+        self._prefetch: int = max(prefetch, 1)
+        self._low_water: int = self._prefetch // 4 if low_water is None else min(low_water, self._prefetch - 1)
+        self._max_bytes: int = max_bytes
+        self._wait: float = wait
+
+        self._buffer: Deque[Tuple[Any, int]] = collections.deque()
+        self._bytes: int = 0
+        self._popped: int = 0
+        self._popped_bytes: int = 0
+
+        self._needs_refill: asyncio.Event = asyncio.Event()
+        self._needs_refill.set()
+        self._refilled: asyncio.Event = asyncio.Event()
+        self._refill_task: asyncio.Task | None = None
+
+    @property
+    def buffered(self) -> int:
+        return len(self._buffer)
+
+    @property
+    def buffered_bytes(self) -> int:
+        return self._bytes
+
+    async def get(self):
+        """
+        The next item, waiting for one to be pushed if the buffer is empty.
+        :return:
+        """
+        if self._refill_task is None:
+            self._refill_task = asyncio.create_task(self._refill())
+
+        while not self._buffer:
+            if self._refill_task.done():
+                # the refills stopped on an error, which the consumer gets
+                self._refill_task.result()
+
+            self._refilled.clear()
+            refilled = asyncio.create_task(self._refilled.wait())
+
+            try:
+                await asyncio.wait([refilled, self._refill_task], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                refilled.cancel()
+
+        item, size = self._buffer.popleft()
+        self._bytes -= size
+
+        if self._below_low_water():
+            self._needs_refill.set()
+
+        return item
+
+    async def close(self):
+        """
+        Stop refilling the buffer. The items left in it were popped already, and are lost.
+        :return:
+        """
+        if self._refill_task is not None:
+            self._refill_task.cancel()
+            await asyncio.gather(self._refill_task, return_exceptions=True)
+            self._refill_task = None
+
+        if self._buffer:
+            logger.warning(f'Dropping {len(self._buffer)} prefetched items of queue {self._queue.name}')
+            self._buffer.clear()
+            self._bytes = 0
+
+    def _below_low_water(self) -> bool:
+        return len(self._buffer) <= self._low_water and self._bytes < self._max_bytes
+
+    def _room(self) -> int:
+        room = min(self._prefetch - len(self._buffer), settings.MAX_BATCH_SIZE)
+
+        # the next batch is sized after the items seen so far to stay within the memory cap,
+        # until some are seen they may be as large as allowed
+        average = max(self._popped_bytes // self._popped, 1) if self._popped else settings.MAX_MESSAGE_SIZE
+        room = min(room, (self._max_bytes - self._bytes) // average)
+
+        return max(room, 1)
+
+    async def _refill(self):
+        while True:
+            await self._needs_refill.wait()
+
+            items = await self._queue.pop_many(self._room(), wait=self._wait)
+
+            for item in items:
+                size = item_size(item)
+                self._buffer.append((item, size))
+                self._bytes += size
+                self._popped_bytes += size
+
+            self._popped += len(items)
+
+            if items:
+                self._refilled.set()
+
+            if not self._below_low_water():
+                self._needs_refill.clear()
@@ -0,0 +1,172 @@
+import asyncio
+import logging
+from typing import TYPE_CHECKING, Any, Dict, List, Set
+
+from RDQueue.client.prefetch import item_size
+from RDQueue.common.config import settings
+from RDQueue.common.exceptions import ProducerBufferFull
+
+if TYPE_CHECKING:
+    from RDQueue.client.dq import DQueue
+
+logger = logging.getLogger(__file__)
+
+
+class Batch:
+    """
+    Items pushed to one partition, waiting to be sent together.
+    """
+
+    def __init__(self, partition: int):
+        self.partition: int = partition
+        self.items: List[Any] = list()
+        self.futures: List[asyncio.Future] = list()
+        self.bytes: int = 0
+        self.timer: asyncio.TimerHandle | None = None
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, item, size: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.items.append(item)
+        self.futures.append(future)
+        self.bytes += size
+        return future
+
+
+class Producer:
+    """
+    Accumulates the items pushed to each partition and sends them as a single QUEUE_PUSH_BATCH request, once
+    the first of them has lingered for a while or once they are large enough. `push` returns a future
+    resolved when the broker acknowledged the item. The batches of a partition are sent one after the other,
+    so the items of a partition are stored in the order they were pushed.
+    """
+
+    def __init__(self, queue: 'DQueue', linger: float = settings.PRODUCER_LINGER,
+                 batch_bytes: int = settings.PRODUCER_BATCH_BYTES, buffer_bytes: int = settings.PRODUCER_BUFFER_BYTES,
+                 block: bool = True):
+        """
+        :param queue:
+        :param linger: seconds the first item of a batch waits for more before the batch is sent
+        :param batch_bytes: a batch is sent as soon as its items take this many bytes
+        :param buffer_bytes: most bytes of items pushed and not acknowledged yet
+        :param block: whether a push waits for room in the buffer, or raises `ProducerBufferFull`
+        """
+        self._queue: 'DQueue' = queue
+        self._linger: float = linger
+        self._batch_bytes: int = batch_bytes
+        self._buffer_bytes: int = buffer_bytes
+        self._block: bool = block
+
+        self._batches: Dict[int, Batch] = dict()
+        # the partition of the items without a key, until its batch is sent
+        self._sticky_partition: int | None = None
+        self._buffered: int = 0
+        self._released: asyncio.Event = asyncio.Event()
+        self._deliveries: Set[asyncio.Task] = set()
+        self._last_delivery: Dict[int, asyncio.Task] = dict()
+
+    @property
+    def buffered_bytes(self) -> int:
+        return self._buffered
+
+    async def push(self, data, key=None) -> asyncio.Future:
+        """
+        Add an item to the next batch of the partition chosen by `key`. Items without a key go to the same
+        partition until its batch is sent, and then to the next one.
+        :param data:
+        :param key:
+        :return: a future resolved with the partition of the item once the broker acknowledged it
+        """
+        size = item_size(data)
+
+        if size > self._buffer_bytes:
+            raise ProducerBufferFull(size, self._buffer_bytes)
+
+        while self._buffered + size > self._buffer_bytes:
+            if not self._block:
+                raise ProducerBufferFull(size, self._buffer_bytes)
+
+            self._released.clear()
+            await self._released.wait()
+
+        if not self._queue.partitions:
+            await self._queue.get_partition_map()
+
+        if key is not None:
+            partition = self._queue._choose_partition(key)
+        else:
+            if self._sticky_partition is None:
+                self._sticky_partition = self._queue._choose_partition()
+
+            partition = self._sticky_partition
+
+        batch = self._batches.get(partition)
+
+        if batch is None:
+            batch = self._batches[partition] = Batch(partition)
+            batch.timer = asyncio.get_running_loop().call_later(self._linger, self._send, partition)
+
+        future = batch.add(data, size)
+        self._buffered += size
+
+        if batch.bytes >= self._batch_bytes or len(batch) >= settings.MAX_BATCH_SIZE:
+            self._send(partition)
+
+        return future
+
+    async def flush(self):
+        """
+        Send every batch right away, and wait until every item pushed so far is acknowledged or failed.
+        :return:
+        """
+        for partition in list(self._batches):
+            self._send(partition)
+
+        await asyncio.gather(*self._deliveries, return_exceptions=True)
+
+    async def close(self):
+        await self.flush()
+
+    def _send(self, partition: int):
+        batch = self._batches.pop(partition, None)
+
+        if batch is None:
+            return
+
+        batch.timer.cancel()
+
+        if partition == self._sticky_partition:
+            self._sticky_partition = None
+
+        delivery = asyncio.create_task(self._deliver(batch, self._last_delivery.get(partition)))
+        self._last_delivery[partition] = delivery
+        self._deliveries.add(delivery)
+        delivery.add_done_callback(self._deliveries.discard)
+        delivery.add_done_callback(lambda _: self._delivered(partition, delivery))
+
+    def _delivered(self, partition: int, delivery: asyncio.Task):
+        if self._last_delivery.get(partition) is delivery:
+            del self._last_delivery[partition]
+
+    async def _deliver(self, batch: Batch, previous: asyncio.Task | None):
+        try:
+            if previous is not None:
+                await asyncio.gather(previous, return_exceptions=True)
+
+            await self._queue._send_batch(batch.partition, batch.items)
+        except Exception as e:
+            logger.error(f'Batch of {len(batch)} items to partition {batch.partition} of {self._queue.name} failed: '
+                         f'{e!r}')
+
+            for future in batch.futures:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for future in batch.futures:
+                if not future.done():
+                    future.set_result(batch.partition)
+        finally:
+            self._buffered -= batch.bytes
+            self._released.set()
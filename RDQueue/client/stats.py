@@ -0,0 +1,74 @@
+"""
+Ask a broker or the load balancer for its metrics with a STATS request, or have it profile its event loop
+with a PROFILE request.
+
+    python -m RDQueue.client.stats 127.0.0.1:9091
+    python -m RDQueue.client.stats 127.0.0.1:9091 --profile 30
+"""
+import argparse
+import asyncio
+import json
+
+from RDQueue.common.address import Address, address_factory
+from RDQueue.common.connection import Connection
+from RDQueue.common.exceptions import RequestFailed
+from RDQueue.common.message import Message, message_factory
+
+
+async def fetch_stats(address: Address) -> dict:
+    """
+    :param address: of a broker or of the load balancer
+    :return: the name of the server, and every metric of the process that answered, by name
+    """
+    return await _request(address, message_factory.stats_req(
+        sender_addr=address.connection_str,
+        receiver_addr=address.connection_str
+    ))
+
+
+async def capture_profile(address: Address, seconds: float) -> str:
+    """
+    :param address: of a broker or of the load balancer
+    :param seconds: to profile the event loop of the server for
+    :return: the file the server dumped the profile to, on its own host
+    """
+    body = await _request(address, message_factory.profile_req(
+        sender_addr=address.connection_str,
+        receiver_addr=address.connection_str,
+        body={'seconds': seconds}
+    ), timeout=seconds + 10)
+
+    return body['path']
+
+
+async def _request(address: Address, request: Message, timeout: float | None = None):
+    connection = Connection(address)
+
+    try:
+        response = await connection.request(request, timeout=timeout)
+    finally:
+        await connection.close()
+
+    if not response.is_ok:
+        raise RequestFailed(response.body.get('error'), response.body.get('message'))
+
+    return response.body
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Print the metrics of a server as JSON, or profile it')
+    arg_parser.add_argument('address', type=str, help='host:port of a broker or of the load balancer')
+    arg_parser.add_argument('--profile', type=float, metavar='SECONDS',
+                            help='Profile the event loop of the server for this long instead')
+    args = arg_parser.parse_args()
+
+    address = address_factory.from_str(args.address)
+
+    if args.profile is not None:
+        print(asyncio.run(capture_profile(address, args.profile)))
+    else:
+        print(json.dumps(asyncio.run(fetch_stats(address)), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -40,6 +40,10 @@ class Address:
         return f'{self.host}:{self.port}'
 
     def __eq__(self, other):
+        # e.g. the current broker of a client, None once every broker it knew failed
+        if not isinstance(other, Address):
+            return NotImplemented
+
         return self.host == other.host and self.port == other.port
 
     def __ge__(self, other):
@@ -11,7 +11,132 @@ DEFAULTS = {
     ],
 
     'LOAD_BALANCER_ADDRESS': '127.0.0.1:9090',
-    'MAX_MESSAGE_SIZE': 4096,
+    # the load balancer sends a client to the broker with the lowest score, the load it reports weighted per
+    # connection, request in flight, message not consumed yet and second of p99 request latency
+    'LOAD_WEIGHT_CONNECTIONS': 1,
+    'LOAD_WEIGHT_IN_FLIGHT': 1,
+    'LOAD_WEIGHT_QUEUE_DEPTH': 0.001,
+    'LOAD_WEIGHT_P99': 100,
+    # seconds between two heartbeats the load balancer asks every broker for, over a long-lived connection,
+    # and between two attempts to reach a broker that is suspected to be down
+    'HEARTBEAT_INTERVAL': 0.1,
+    'HEARTBEAT_RECONNECT_INTERVAL': 1,
+    # a broker is suspected to be down once the phi of its failure detector crosses the threshold,
+    # phi being estimated from the last FAILURE_DETECTOR_WINDOW intervals between its heartbeats
+    'FAILURE_DETECTOR_THRESHOLD': 8,
+    'FAILURE_DETECTOR_WINDOW': 100,
+    'FAILURE_DETECTOR_MIN_STD': 0.05,
+    # a client tries every broker it knows before waiting, starting with CLIENT_RETRY_BACKOFF seconds and up to
+    # CLIENT_RETRY_MAX_BACKOFF, jittered; a broker that failed a request is tried last for CLIENT_FAILURE_MEMORY seconds
+    'CLIENT_RETRY_BACKOFF': 0.01,
+    'CLIENT_RETRY_MAX_BACKOFF': 2,
+    'CLIENT_FAILURE_MEMORY': 1,
+    'MAX_MESSAGE_SIZE': 1024 * 1024,
+    # 2 encodes messages as positional arrays, 1 as the original dicts for peers that only understand those
+    'MESSAGE_WIRE_FORMAT': 2,
+
+    # bytes held by the requests being handled, 0 for no limit. A connection is not read while its requests hold
+    # CONNECTION_MEMORY_BUDGET, no connection is while the requests of the server hold MEMORY_BACKPRESSURE_LEVEL of
+    # SERVER_MEMORY_BUDGET, and pushes are rejected as Overloaded once it is exhausted. The pushes to a queue that are
+    # not committed yet hold QUEUE_MEMORY_BUDGET at most, and are acknowledged up to MAX_ACK_DELAY seconds later
+    # as they get past MEMORY_BACKPRESSURE_LEVEL of it
+    'CONNECTION_MEMORY_BUDGET': 8 * 1024 * 1024,
+    'SERVER_MEMORY_BUDGET': 256 * 1024 * 1024,
+    'QUEUE_MEMORY_BUDGET': 64 * 1024 * 1024,
+    'MEMORY_BACKPRESSURE_LEVEL': 0.75,
+    'MAX_ACK_DELAY': 0.05,
+    # bytes of responses buffered for a connection before the server waits for the client to read them
+    'CONNECTION_WRITE_BUFFER': 1024 * 1024,
+
+    # the metrics of a server are also served as Prometheus text over HTTP at its port + METRICS_PORT_OFFSET,
+    # and at that port + i * WORKER_PORT_STRIDE for worker i of a broker; 0 serves them through STATS only
+    'METRICS_PORT_OFFSET': 0,
+    # level of the servers' logs, which a background thread formats and writes. LOG_QUEUE_SIZE records at most
+    # wait for it, the ones beyond are dropped. Records logged for an operation, e.g. every request received at
+    # DEBUG, are sampled: one in LOG_SAMPLING[operation] is kept, and at most LOG_RATE_LIMIT per second (0 for all)
+    'LOG_LEVEL': 'INFO',
+    'LOG_QUEUE_SIZE': 10000,
+    'LOG_SAMPLING': {},
+    'LOG_RATE_LIMIT': 100,
+
+    # seconds between two samples of how late the event loop runs; a stall longer than SLOW_CALLBACK_THRESHOLD
+    # seconds is logged with the task and the last SLOW_CALLBACK_STACK_DEPTH frames it was running, 0 logs none
+    'LOOP_MONITOR_INTERVAL': 0.1,
+    'SLOW_CALLBACK_THRESHOLD': 0.25,
+    'SLOW_CALLBACK_STACK_DEPTH': 15,
+    # where the profiles captured on a PROFILE request are dumped, the profiles directory of the server if None,
+    # and the longest a capture may last in seconds
+    'PROFILE_DIR': None,
+    'MAX_PROFILE_SECONDS': 300,
+
+    # seconds a client connection may stay silent before the server closes it
+    'CONNECTION_IDLE_TIMEOUT': 300,
+    # requests read ahead from a single connection while earlier ones are still being handled
+    'MAX_PIPELINED_REQUESTS': 128,
+    # messages sent in a single QUEUE_PUSH_BATCH / QUEUE_POP_BATCH request
+    'MAX_BATCH_SIZE': 1000,
+    # longest a QUEUE_POP may wait for messages to be pushed, in seconds
+    'MAX_POP_WAIT': 30,
+    # credits a subscriber grants each partition: messages streamed to it before it has to acknowledge some
+    'SUBSCRIBE_WINDOW': 1000,
+    # items a consumer pops ahead into its local buffer, and the bytes they may take at most
+    'CONSUMER_PREFETCH': 1000,
+    'CONSUMER_PREFETCH_BYTES': 16 * 1024 * 1024,
+    # a producer sends the items pushed to a partition as one batch PRODUCER_LINGER seconds after the first one,
+    # or once they take PRODUCER_BATCH_BYTES; items not acknowledged yet take at most PRODUCER_BUFFER_BYTES
+    'PRODUCER_LINGER': 0.005,
+    'PRODUCER_BATCH_BYTES': 256 * 1024,
+    'PRODUCER_BUFFER_BYTES': 32 * 1024 * 1024,
+
+    # on-disk queue storage: segment file size, bytes of records between sparse index entries,
+    # and when appended records are fsynced ('always', 'batch' or 'interval' seconds)
+    'LOG_SEGMENT_BYTES': 64 * 1024 * 1024,
+    'LOG_INDEX_INTERVAL_BYTES': 4096,
+    'LOG_FSYNC_POLICY': 'batch',
+    'LOG_FSYNC_INTERVAL': 1.0,
+
+    # queue retention, 0 or None disables a limit: records beyond these are dropped even if not consumed yet,
+    # and clients idle for longer than RETENTION_CLIENT_TTL seconds stop holding records back. Ages are measured
+    # from when a broker received the record or heard from the client, in seconds
+    'RETENTION_MAX_MESSAGES': 0,
+    'RETENTION_MAX_BYTES': 0,
+    'RETENTION_MAX_AGE': None,
+    'RETENTION_CLIENT_TTL': 24 * 60 * 60,
+    'RETENTION_CHECK_INTERVAL': 30,
+
+    # partitions of a queue created without an explicit count, and brokers owning each partition
+    'QUEUE_PARTITIONS': 1,
+    'PARTITION_REPLICAS': 2,
+
+    # seconds to wait for a replicated command to be committed
+    'REPLICATION_TIMEOUT': 5,
+    # seconds between two batches of log entries sent by the leader and between two runs of the replication
+    # thread, together they set the floor of the commit latency
+    'REPLICATION_APPEND_ENTRIES_PERIOD': 0.01,
+    'REPLICATION_TICK_PERIOD': 0.005,
+    # seconds between two attempts to connect to another broker, and of silence before a connection is dropped
+    'REPLICATION_RECONNECT_INTERVAL': 1,
+    'REPLICATION_CONNECTION_TIMEOUT': 3.5,
+    # the replicated state of a queue only refers to its records: a replica restored from a state whose records
+    # it does not hold fetches them from the other replicas, in chunks of this many bytes, before applying commands
+    'REPLICATION_CATCH_UP_BYTES': 1024 * 1024,
+    # seconds between two snapshots of a replication group that applied commands since its last one, which its
+    # replication log is compacted into. A group is also snapshotted every 5000 commands
+    'SNAPSHOT_INTERVAL': 10,
+    # seconds between two checks that every replication group is led by its preferred broker
+    'LEADER_REBALANCE_INTERVAL': 10,
+    # pushes to a replication group arriving within GROUP_COMMIT_LINGER seconds of each other are replicated
+    # as a single command, which is sent earlier once it holds GROUP_COMMIT_MAX_MESSAGES messages
+    'GROUP_COMMIT_LINGER': 0.002,
+    'GROUP_COMMIT_MAX_MESSAGES': 5000,
+
+    # worker processes per broker, all accepting clients on the port of the broker. Every partition is served by
+    # one of them, which the others forward its requests to. Worker i of a broker replicates with worker i of
+    # the other brokers, so every broker must run the same number of workers. Worker i listens for forwarded
+    # requests at the port of its broker + (i + 1) * WORKER_PORT_STRIDE, and replicates at the replication
+    # address of its broker + i * WORKER_PORT_STRIDE
+    'BROKER_WORKERS': 1,
+    'WORKER_PORT_STRIDE': 100,
 
     'REPLICATION_ADDRESS': [
         '127.0.0.1:8081',
@@ -37,9 +162,11 @@ class Settings:
         if isinstance(value, list):
             return [address.address_factory.from_str(addr) for addr in value if address.Address.is_valid_address(addr)]
 
-        if address.Address.is_valid_address(value):
+        if isinstance(value, str) and address.Address.is_valid_address(value):
             return address.address_factory.from_str(value)
 
+        return value
+
     def get_setting(self, setting):
         return DEFAULTS[setting]
 
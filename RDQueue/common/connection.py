@@ -0,0 +1,202 @@
+import asyncio
+import logging
+from typing import Callable, Dict
+
+from RDQueue.common.address import Address
+from RDQueue.common.exceptions import NoBrokerAvailable
+from RDQueue.common.message import Message
+from RDQueue.common.networking import receive_message, send_message_to_writer
+
+logger = logging.getLogger(__file__)
+
+
+class Connection:
+    """
+    A long-lived connection to a single peer that carries many in-flight requests at once.
+    Responses are matched to the waiting callers by `Message.id`, and the connection is
+    re-established transparently on the next request after it drops. A subscription is a request
+    answered by any number of responses, pushed by the peer whenever it has something new.
+    """
+
+    def __init__(self, address: Address, request_timeout: float = 3, connect_timeout: float = 1):
+        self._address: Address = address
+        self._request_timeout: float = request_timeout
+        self._connect_timeout: float = connect_timeout
+
+        self._reader: asyncio.StreamReader | None = None
+        self._writer: asyncio.StreamWriter | None = None
+        self._read_task: asyncio.Task | None = None
+        self._connect_lock: asyncio.Lock = asyncio.Lock()
+        self._pending: Dict[int | str, asyncio.Future] = dict()
+        self._subscriptions: Dict[int | str, asyncio.Queue] = dict()
+
+    @property
+    def address(self) -> Address:
+        return self._address
+
+    @property
+    def is_connected(self) -> bool:
+        return self._writer is not None and not self._writer.is_closing()
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._pending)
+
+    async def connect(self):
+        async with self._connect_lock:
+            if self.is_connected:
+                return
+
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(*self.address.tuple),
+                    timeout=self._connect_timeout
+                )
+            except (OSError, asyncio.TimeoutError) as e:
+                logger.error(f'Could not connect to {self.address}: {e!r}')
+                raise NoBrokerAvailable()
+
+            self._reader = reader
+            self._writer = writer
+            self._read_task = asyncio.create_task(self._read_responses(reader))
+
+            logger.info(f'Connected to {self.address}')
+
+    async def request(self, message: Message, timeout: float | None = None,
+                      on_sent: Callable[[], None] | None = None) -> Message:
+        """
+        :param message:
+        :param timeout: seconds to wait for the response, the request timeout of the connection if None
+        :param on_sent: called once the request is written, before waiting for its response
+        :return: the response
+        """
+        if not self.is_connected:
+            await self.connect()
+
+        writer = self._writer
+        if writer is None:
+            raise NoBrokerAvailable()
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[message.id] = future
+
+        try:
+            await send_message_to_writer(writer, message)
+
+            if on_sent is not None:
+                on_sent()
+
+            return await asyncio.wait_for(future, timeout=timeout or self._request_timeout)
+        except asyncio.TimeoutError:
+            logger.error(f'Request {message} to {self.address} timed out')
+            raise NoBrokerAvailable()
+        except (OSError, EOFError):
+            raise NoBrokerAvailable()
+        finally:
+            self._pending.pop(message.id, None)
+
+    async def subscribe(self, message: Message) -> asyncio.Queue:
+        """
+        Send a request whose responses keep coming. They are put in the returned queue, followed by
+        the exception that ended the subscription if the connection drops.
+        :param message:
+        :return:
+        """
+        if not self.is_connected:
+            await self.connect()
+
+        writer = self._writer
+        if writer is None:
+            raise NoBrokerAvailable()
+
+        updates: asyncio.Queue = asyncio.Queue()
+        self._subscriptions[message.id] = updates
+
+        try:
+            await send_message_to_writer(writer, message)
+        except OSError:
+            self._subscriptions.pop(message.id, None)
+            raise NoBrokerAvailable()
+
+        return updates
+
+    async def send(self, message: Message):
+        """
+        Send a request that is not answered, e.g. the credits of a subscription.
+        :param message:
+        :return:
+        """
+        if not self.is_connected:
+            await self.connect()
+
+        writer = self._writer
+        if writer is None:
+            raise NoBrokerAvailable()
+
+        try:
+            await send_message_to_writer(writer, message)
+        except OSError:
+            raise NoBrokerAvailable()
+
+    def unsubscribe(self, message_id: int | str):
+        self._subscriptions.pop(message_id, None)
+
+    async def close(self):
+        writer = self._writer
+        self._reset(ConnectionAbortedError('Connection closed'))
+
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def _read_responses(self, reader: asyncio.StreamReader):
+        error: Exception = ConnectionResetError('Connection closed by peer')
+
+        try:
+            while True:
+                message = await receive_message(reader)
+                updates = self._subscriptions.get(message.id)
+
+                if updates is not None:
+                    updates.put_nowait(message)
+                    continue
+
+                future = self._pending.get(message.id)
+
+                if future is None or future.done():
+                    # e.g. the answer to a request that timed out or was cancelled
+                    logger.debug(f'Dropping unexpected message from {self.address}: {message}')
+                    continue
+
+                future.set_result(message)
+        except (OSError, EOFError) as e:
+            error = e
+        except Exception as e:
+            logger.error(f'Invalid message from {self.address}: {e!r}')
+            error = e
+        finally:
+            if reader is self._reader:
+                self._reset(error)
+
+    def _reset(self, error: Exception):
+        if self._writer is not None:
+            self._writer.close()
+
+        self._reader = None
+        self._writer = None
+
+        if self._read_task is not None and self._read_task is not asyncio.current_task():
+            self._read_task.cancel()
+        self._read_task = None
+
+        pending, self._pending = self._pending, dict()
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+        subscriptions, self._subscriptions = self._subscriptions, dict()
+        for updates in subscriptions.values():
+            updates.put_nowait(error)
@@ -1,8 +1,6 @@
 import asyncio
 import logging
 
-logging.basicConfig(level=logging.INFO)
-
 logger = logging.getLogger(__file__)
 
 
@@ -10,6 +8,8 @@ def handle_conn_err(function):
     async def wrapper(*args, **kwargs):
         try:
             await function(*args, **kwargs)
+        except asyncio.IncompleteReadError:
+            logger.debug(f'Connection closed by peer')
         except ConnectionResetError:
             logger.error(f'Connection reset by peer')
         except asyncio.TimeoutError:
@@ -6,3 +6,66 @@ class InvalidMessageStructure(Exception):
 class NoBrokerAvailable(Exception):
     def __init__(self):
         self.message = 'No broker is available to handle the request'
+
+
+class InvalidFrame(Exception):
+    def __init__(self):
+        self.message = 'Frame header is invalid'
+
+
+class FrameTooLarge(Exception):
+    def __init__(self, size: int, max_size: int):
+        self.message = f'Frame of {size} bytes exceeds the maximum frame size of {max_size} bytes'
+
+
+class QueueNotFound(Exception):
+    def __init__(self, name: str):
+        self.message = f'Queue {name} does not exist'
+
+
+class NotPartitionOwner(Exception):
+    def __init__(self, name: str, partition: int):
+        self.message = f'Partition {partition} of queue {name} is not owned by this broker'
+
+
+class NoLeaderAvailable(Exception):
+    def __init__(self):
+        self.message = 'The replication group has no leader, try again later'
+
+
+class ReplicationTimeout(Exception):
+    def __init__(self, timeout: float):
+        self.message = f'The replicated command was not committed within {timeout}s'
+
+
+class ReplicationFailed(Exception):
+    def __init__(self, reason: int):
+        self.reason = reason
+        self.message = f'The replicated command failed (pysyncobj FAIL_REASON {reason})'
+
+
+class ProducerBufferFull(Exception):
+    def __init__(self, size: int, max_size: int):
+        self.message = f'An item of {size} bytes does not fit in the producer buffer of {max_size} bytes'
+
+
+class RequestFailed(Exception):
+    def __init__(self, error: str, message: str):
+        self.error = error
+        self.message = f'{error}: {message}'
+
+
+class ProfilingInProgress(Exception):
+    def __init__(self):
+        self.message = 'A profile is already being captured, try again once it is done'
+
+
+class Overloaded(Exception):
+    def __init__(self, budget: str):
+        self.budget = budget
+        self.message = f'The {budget} memory budget is exhausted, try again later'
+
+
+class IncompatibleDependency(Exception):
+    def __init__(self, package: str, version: str, missing: list):
+        self.message = f'{package} {version} lacks {", ".join(missing)}, install the version in requirements.txt'
@@ -0,0 +1,67 @@
+import math
+from collections import deque
+from typing import Deque
+
+
+class PhiAccrualDetector:
+    """
+    Phi accrual failure detector (Hayashibara et al.). Instead of a fixed timeout, it learns the distribution of
+    the intervals between heartbeats and tells how unlikely the current silence is: phi = -log10(P(silence)).
+    A phi of 8 means a heartbeat that late happens about once in 10^8 intervals.
+    """
+
+    def __init__(self, expected_interval: float, window: int = 100, min_std: float = 0.05,
+                 acceptable_pause: float = 0):
+        """
+        :param expected_interval: assumed interval until heartbeats have been measured
+        :param window: intervals the distribution is estimated from
+        :param min_std: floor of the standard deviation, so that a very regular peer is not suspected
+        on the first bit of jitter
+        :param acceptable_pause: silence tolerated on top of the usual interval, e.g. for garbage collection
+        """
+        self._expected_interval: float = expected_interval
+        self._min_std: float = min_std
+        self._acceptable_pause: float = acceptable_pause
+        self._intervals: Deque[float] = deque(maxlen=window)
+        self._last_heartbeat: float | None = None
+
+    @property
+    def last_heartbeat(self) -> float | None:
+        return self._last_heartbeat
+
+    def heartbeat(self, now: float):
+        if self._last_heartbeat is not None:
+            self._intervals.append(now - self._last_heartbeat)
+
+        self._last_heartbeat = now
+
+    def reset(self):
+        self._intervals.clear()
+        self._last_heartbeat = None
+
+    def phi(self, now: float) -> float:
+        """
+        :param now:
+        :return: the suspicion level of the peer, 0 before its first heartbeat
+        """
+        if self._last_heartbeat is None:
+            return 0.0
+
+        if self._intervals:
+            mean = sum(self._intervals) / len(self._intervals)
+            variance = sum((interval - mean) ** 2 for interval in self._intervals) / len(self._intervals)
+        else:
+            mean, variance = self._expected_interval, (self._expected_interval / 4) ** 2
+
+        mean += self._acceptable_pause
+        std = max(math.sqrt(variance), self._min_std)
+        elapsed = now - self._last_heartbeat
+
+        # probability that the next heartbeat comes even later, the intervals being normally distributed
+        later = 0.5 * math.erfc((elapsed - mean) / (std * math.sqrt(2)))
+
+        # it underflows to 0 long after the last heartbeat
+        return -math.log10(later) if later > 0 else math.inf
+
+    def is_available(self, now: float, threshold: float) -> bool:
+        return self.phi(now) < threshold
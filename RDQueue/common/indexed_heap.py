@@ -0,0 +1,100 @@
+from typing import Dict, Generic, Hashable, List, Tuple, TypeVar
+
+T = TypeVar('T', bound=Hashable)
+
+
+class IndexedHeap(Generic[T]):
+    """
+    A binary min-heap of items by priority, which also knows where every item is in the heap. Changing the
+    priority of an item or removing it is O(log n), instead of re-heapifying the whole heap.
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[float, T]] = list()
+        self._positions: Dict[T, int] = dict()
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def __contains__(self, item: T) -> bool:
+        return item in self._positions
+
+    def __iter__(self):
+        return iter([item for _, item in self._heap])
+
+    def priority(self, item: T) -> float:
+        return self._heap[self._positions[item]][0]
+
+    def push(self, item: T, priority: float):
+        """
+        Add an item, or change its priority if it is already in the heap.
+        :param item:
+        :param priority:
+        :return:
+        """
+        if item in self._positions:
+            self.update(item, priority)
+            return
+
+        self._heap.append((priority, item))
+        self._positions[item] = len(self._heap) - 1
+        self._sift_up(len(self._heap) - 1)
+
+    def update(self, item: T, priority: float):
+        position = self._positions[item]
+        previous, _ = self._heap[position]
+        self._heap[position] = (priority, item)
+
+        if priority < previous:
+            self._sift_up(position)
+        else:
+            self._sift_down(position)
+
+    def remove(self, item: T):
+        position = self._positions.pop(item)
+        last = self._heap.pop()
+
+        if position == len(self._heap):
+            return
+
+        self._heap[position] = last
+        self._positions[last[1]] = position
+        self._sift_up(position)
+        self._sift_down(self._positions[last[1]])
+
+    def peek(self) -> T | None:
+        """
+        :return: the item with the lowest priority, None if the heap is empty
+        """
+        return self._heap[0][1] if self._heap else None
+
+    def _swap(self, i: int, j: int):
+        self._heap[i], self._heap[j] = self._heap[j], self._heap[i]
+        self._positions[self._heap[i][1]] = i
+        self._positions[self._heap[j][1]] = j
+
+    def _sift_up(self, position: int):
+        while position > 0:
+            parent = (position - 1) // 2
+
+            if self._heap[parent][0] <= self._heap[position][0]:
+                break
+
+            self._swap(parent, position)
+            position = parent
+
+    def _sift_down(self, position: int):
+        size = len(self._heap)
+
+        while True:
+            smallest = position
+
+            for child in (2 * position + 1, 2 * position + 2):
+                if child < size and self._heap[child][0] < self._heap[smallest][0]:
+                    smallest = child
+
+            if smallest == position:
+                return
+
+            self._swap(position, smallest)
+            position = smallest
@@ -0,0 +1,122 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+from typing import Dict, Tuple
+
+from RDQueue.common.config import settings
+from RDQueue.common.metrics import metrics
+
+_listener: logging.handlers.QueueListener | None = None
+
+
+class OperationSampler(logging.Filter):
+    """
+    Keeps one in every N records logged for an operation, and at most a number of them per second, so that
+    debugging a busy server does not flood its output. Only records logged with an `operation` extra are sampled.
+    """
+
+    def __init__(self, sampling: Dict[str, int], rate_limit: float):
+        """
+        :param sampling: how many records of each operation make for one kept, every record of the ones not in it
+        :param rate_limit: most records kept per operation and second, no limit if 0
+        """
+        super().__init__()
+        self._sampling: Dict[str, int] = sampling
+        self._rate_limit: float = rate_limit
+
+        self._seen: Dict[str, int] = dict()
+        # the records each operation may still log in the current second, and when they were last topped up
+        self._allowances: Dict[str, Tuple[float, float]] = dict()
+        self._lock: threading.Lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        operation = getattr(record, 'operation', None)
+
+        if operation is None:
+            return True
+
+        with self._lock:
+            seen = self._seen[operation] = self._seen.get(operation, 0) + 1
+
+            if (seen - 1) % self._sampling.get(operation, 1):
+                return _dropped('sampled', operation)
+
+            if not self._rate_limit:
+                return True
+
+            now = time.monotonic()
+            allowance, last = self._allowances.get(operation, (self._rate_limit, now))
+            allowance = min(allowance + (now - last) * self._rate_limit, self._rate_limit)
+
+            if allowance < 1:
+                self._allowances[operation] = (allowance, now)
+                return _dropped('rate_limited', operation)
+
+            self._allowances[operation] = (allowance - 1, now)
+            return True
+
+
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands the records over to the thread writing them as they are, formatting included: the thread logging them
+    only pays for building the record. Records are dropped once the queue is full rather than waiting for room.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the queue stays in this process, the record does not have to be made picklable
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _dropped('queue_full', getattr(record, 'operation', ''))
+
+
+def _dropped(reason: str, operation: str) -> bool:
+    metrics.counter('log_records_dropped_total', reason=reason, operation=operation).inc()
+    return False
+
+
+def setup_logging(level: str | int = settings.LOG_LEVEL):
+    """
+    Replace the handlers of the root logger by one queueing the records for a background thread, which formats
+    them and writes them to stderr. The records left in the queue are written when the process exits.
+    :param level:
+    :return:
+    """
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+
+    records: queue.Queue = queue.Queue(maxsize=settings.LOG_QUEUE_SIZE)
+    output = logging.StreamHandler()
+    output.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+
+    handler = AsyncQueueHandler(records)
+    handler.addFilter(OperationSampler(settings.LOG_SAMPLING, settings.LOG_RATE_LIMIT))
+
+    root = logging.getLogger()
+
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+        existing.close()
+
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+    _listener.start()
+
+
+@atexit.register
+def _flush():
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
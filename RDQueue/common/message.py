@@ -1,10 +1,11 @@
 import enum
+import itertools
 import time
-import uuid
 from typing import Any
 
 import msgpack
 
+from RDQueue.common.config import settings
 from RDQueue.common.exceptions import InvalidMessageStructure
 
 
@@ -20,6 +21,15 @@ class Operation(enum.IntEnum):
     QUEUE_POP = 0x3
     BROKER_INFO = 0x4
     REGISTER_CLIENT = 0x5
+    QUEUE_PUSH_BATCH = 0x6
+    QUEUE_POP_BATCH = 0x7
+    PARTITION_MAP = 0x8
+    MEMBERSHIP = 0x9
+    SUBSCRIBE = 0xA
+    CREDIT = 0xB
+    UNSUBSCRIBE = 0xC
+    STATS = 0xD
+    PROFILE = 0xE
 
 
 class Status(enum.IntEnum):
@@ -27,11 +37,30 @@ class Status(enum.IntEnum):
     ERROR = 0x2
 
 
+# Version tag of the wire encoding, sent as the first element of every array-encoded message.
+# Version 1 is the original dict encoding, which is still decoded and can be emitted for old peers.
+WIRE_FORMAT_LEGACY = 0x1
+WIRE_FORMAT_ARRAY = 0x2
+
+WIRE_FORMAT: int = settings.MESSAGE_WIRE_FORMAT
+
+_message_ids = itertools.count(1)
+
+_MESSAGE_TYPES = {member.value: member for member in MessageType}
+_OPERATIONS = {member.value: member for member in Operation}
+_STATUSES = {member.value: member for member in Status}
+
+
 class Message:
+    __slots__ = (
+        '_sender_addr', '_receiver_addr', '_sender_id', '_receiver_id', '_message_type',
+        '_operation', '_status', '_body', '_timestamp', '_id',
+    )
+
     def __init__(
             self,
-            sender_addr: str,
-            receiver_addr: str,
+            sender_addr: str | None = None,
+            receiver_addr: str | None = None,
             sender_id: str | None = None,
             receiver_id: str | None = None,
             message_type: MessageType = MessageType.REQUEST,
@@ -40,10 +69,10 @@ class Message:
             body: Any | None = None,
 
             timestamp: float | None = None,
-            _id: str | None = None
+            _id: int | str | None = None
     ):
-        self._sender_addr: str = sender_addr
-        self._receiver_addr: str = receiver_addr
+        self._sender_addr: str | None = sender_addr
+        self._receiver_addr: str | None = receiver_addr
         self._sender_id: str | None = sender_id
         self._receiver_id: str | None = receiver_id
         self._message_type: MessageType = message_type
@@ -52,10 +81,11 @@ class Message:
         self._body: Any | None = body
 
         self._timestamp: float = time.time() if timestamp is None else timestamp
-        self._id: str = str(uuid.uuid4().hex) if _id is None else _id
+        # ids only have to be unique among the requests in flight on a connection
+        self._id: int | str = next(_message_ids) if _id is None else _id
 
     @property
-    def sender_addr(self) -> str:
+    def sender_addr(self) -> str | None:
         return self._sender_addr
 
     @property
@@ -63,7 +93,7 @@ class Message:
         return self._sender_id
 
     @property
-    def receiver_addr(self) -> str:
+    def receiver_addr(self) -> str | None:
         return self._receiver_addr
 
     @property
@@ -91,14 +121,55 @@ class Message:
         return self._body
 
     @property
-    def id(self) -> str:
+    def id(self) -> int | str:
         return self._id
 
     @property
     def timestamp(self) -> float:
         return self._timestamp
 
-    def to_bytes(self) -> bytes:
+    def copy(self, _id: int | str | None = None) -> 'Message':
+        """
+        The same message under another id, e.g. to relay it over a connection shared with other requests.
+        :param _id: a new id if not given
+        :return:
+        """
+        return Message(
+            sender_addr=self._sender_addr,
+            receiver_addr=self._receiver_addr,
+            sender_id=self._sender_id,
+            receiver_id=self._receiver_id,
+            message_type=self._message_type,
+            operation=self._operation,
+            status=self._status,
+            body=self._body,
+            timestamp=self._timestamp,
+            _id=_id
+        )
+
+    def to_bytes(self, wire_format: int = WIRE_FORMAT) -> bytes:
+        """
+        Encode the message positionally, without key names. The addresses are left out
+        since the peers already know them from the connection.
+        :param wire_format:
+        :return:
+        """
+        if wire_format == WIRE_FORMAT_LEGACY:
+            return self._to_legacy_bytes()
+
+        return msgpack.packb((
+            WIRE_FORMAT_ARRAY,
+            self._message_type,
+            self._operation,
+            self._status,
+            self._id,
+            self._sender_id,
+            self._receiver_id,
+            self._timestamp,
+            self._body,
+        ))
+
+    def _to_legacy_bytes(self) -> bytes:
         return msgpack.packb({
             'sender_addr': self.sender_addr,
             'receiver_addr': self.receiver_addr,
@@ -113,22 +184,47 @@ class Message:
         })
 
     @classmethod
-    def from_bytes(cls, data: bytes) -> 'Message':
+    def from_bytes(cls, data: bytes | memoryview) -> 'Message':
 
         try:
-            message = msgpack.unpackb(data[:-2])
+            message = msgpack.unpackb(data)
 
-            message['message_type'] = MessageType(message['message_type'])
-            message['operation'] = Operation(message['operation'])
-            message['status'] = Status(message['status'])
+            if isinstance(message, dict):
+                return cls._from_legacy(message)
 
-            return cls(**message)
+            version, message_type, operation, status, _id, sender_id, receiver_id, timestamp, body = message
+
+            if version != WIRE_FORMAT_ARRAY:
+                raise ValueError(f'Unsupported wire format version {version}')
+
+            self = cls.__new__(cls)
+            self._sender_addr = None
+            self._receiver_addr = None
+            self._sender_id = sender_id
+            self._receiver_id = receiver_id
+            self._message_type = _MESSAGE_TYPES[message_type]
+            self._operation = _OPERATIONS[operation]
+            self._status = _STATUSES[status]
+            self._body = body
+            self._timestamp = timestamp
+            self._id = _id
+
+            return self
         except:  # noqa
             raise InvalidMessageStructure()
 
+    @classmethod
+    def _from_legacy(cls, message: dict) -> 'Message':
+        message['message_type'] = MessageType(message['message_type'])
+        message['operation'] = Operation(message['operation'])
+        message['status'] = Status(message['status'])
+
+        return cls(**message)
+
     def __str__(self):
         return (
             f'Message('
+            f'id={self.id}, '
             f'sender={self.sender_addr}, '
             f'receiver={self.receiver_addr}, '
             f'type={self.message_type.name}, '
@@ -179,6 +275,86 @@ class MessageFactory:
         return cls.create_response(sender_addr=sender_addr, receiver_addr=receiver_addr,
                                    operation=Operation.QUEUE_POP, **kwargs)
 
+    @classmethod
+    def queue_push_batch_req(cls, sender_addr: str, receiver_addr: str, **kwargs):
+        return cls.create_request(sender_addr=sender_addr, receiver_addr=receiver_addr,
+                                  operation=Operation.QUEUE_PUSH_BATCH, **kwargs)
+
+    @classmethod
+    def queue_push_batch_res(cls, sender_addr: str, receiver_addr: str, **kwargs):
+        return cls.create_response(sender_addr=sender_addr, receiver_addr=receiver_addr,
+                                   operation=Operation.QUEUE_PUSH_BATCH, **kwargs)
+
+    @classmethod
+    def queue_pop_batch_req(cls, sender_addr: str, receiver_addr: str, **kwargs):
+        return cls.create_request(sender_addr=sender_addr, receiver_addr=receiver_addr,
+                                  operation=Operation.QUEUE_POP_BATCH, **kwargs)
+
+    @classmethod
+    def queue_pop_batch_res(cls, sender_addr: str, receiver_addr: str, **kwargs):
+        return cls.create_response(sender_addr=sender_addr, receiver_addr=receiver_addr,
+                                   operation=Operation.QUEUE_POP_BATCH, **kwargs)
+
+    @classmethod
+    def partition_map_req(cls, sender_addr: str, receiver_addr: str, **kwargs):
+        return cls.create_request(sender_addr=sender_addr, receiver_addr=receiver_addr,
+                                  operation=Operation.PARTITION_MAP, **kwargs)
+
+    @classmethod
+    def partition_map_res(cls, sender_addr: str, receiver_addr: str, **kwargs):
+        return cls.create_response(sender_addr=sender_addr, receiver_addr=receiver_addr,
+                                   operation=Operation.PARTITION_MAP, **kwargs)
+
+    @classmethod
+    def membership_req(cls, sender_addr: str, receiver_addr: str, **kwargs):
+        return cls.create_request(sender_addr=sender_addr, receiver_addr=receiver_addr,
+                                  operation=Operation.MEMBERSHIP, **kwargs)
+
+    @classmethod
+    def membership_res(cls, sender_addr: str, receiver_addr: str, **kwargs):
+        return cls.create_response(sender_addr=sender_addr, receiver_addr=receiver_addr,
+                                   operation=Operation.MEMBERSHIP, **kwargs)
+
+    @classmethod
+    def subscribe_req(cls, sender_addr: str, receiver_addr: str, **kwargs):
+        return cls.create_request(sender_addr=sender_addr, receiver_addr=receiver_addr,
+                                  operation=Operation.SUBSCRIBE, **kwargs)
+
+    @classmethod
+    def subscribe_res(cls, sender_addr: str, receiver_addr: str, **kwargs):
+        return cls.create_response(sender_addr=sender_addr, receiver_addr=receiver_addr,
+                                   operation=Operation.SUBSCRIBE, **kwargs)
+
+    @classmethod
+    def credit_req(cls, sender_addr: str, receiver_addr: str, **kwargs):
+        return cls.create_request(sender_addr=sender_addr, receiver_addr=receiver_addr,
+                                  operation=Operation.CREDIT, **kwargs)
+
+    @classmethod
+    def unsubscribe_req(cls, sender_addr: str, receiver_addr: str, **kwargs):
+        return cls.create_request(sender_addr=sender_addr, receiver_addr=receiver_addr,
+                                  operation=Operation.UNSUBSCRIBE, **kwargs)
+
+    @classmethod
+    def stats_req(cls, sender_addr: str, receiver_addr: str, **kwargs):
+        return cls.create_request(sender_addr=sender_addr, receiver_addr=receiver_addr,
+                                  operation=Operation.STATS, **kwargs)
+
+    @classmethod
+    def stats_res(cls, sender_addr: str, receiver_addr: str, **kwargs):
+        return cls.create_response(sender_addr=sender_addr, receiver_addr=receiver_addr,
+                                   operation=Operation.STATS, **kwargs)
+
+    @classmethod
+    def profile_req(cls, sender_addr: str, receiver_addr: str, **kwargs):
+        return cls.create_request(sender_addr=sender_addr, receiver_addr=receiver_addr,
+                                  operation=Operation.PROFILE, **kwargs)
+
+    @classmethod
+    def profile_res(cls, sender_addr: str, receiver_addr: str, **kwargs):
+        return cls.create_response(sender_addr=sender_addr, receiver_addr=receiver_addr,
+                                   operation=Operation.PROFILE, **kwargs)
+
     @classmethod
     def broker_info_req(cls, sender_addr: str, receiver_addr: str, **kwargs):
         return cls.create_request(sender_addr=sender_addr, receiver_addr=receiver_addr,
@@ -205,7 +381,7 @@ class MessageFactory:
                                    status=Status.ERROR, **kwargs)
 
     @classmethod
-    def from_bytes(cls, data: bytes) -> Message:
+    def from_bytes(cls, data: bytes | memoryview) -> Message:
         return Message.from_bytes(data)
 
 
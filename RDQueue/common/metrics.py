@@ -0,0 +1,252 @@
+import bisect
+import math
+import threading
+from collections import deque
+from typing import Callable, Deque, Dict, List, Sequence, Tuple
+
+# seconds, from a fast request served from memory to a replication timeout
+DEFAULT_BUCKETS: Tuple[float, ...] = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Counter:
+    TYPE = 'counter'
+
+    def __init__(self, name: str, labels: Dict[str, str]):
+        self._name: str = name
+        self._labels: Dict[str, str] = labels
+        self._value: float = 0
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def labels(self) -> Dict[str, str]:
+        return self._labels
+
+    @property
+    def value(self) -> float:
+        return self._value
+
+    def inc(self, amount: float = 1):
+        self._value += amount
+
+    def sample(self) -> dict:
+        return {'labels': self._labels, 'value': self._value}
+
+
+class Gauge(Counter):
+    TYPE = 'gauge'
+
+    def set(self, value: float):
+        self._value = value
+
+    def dec(self, amount: float = 1):
+        self._value -= amount
+
+
+class Summary(Counter):
+    """
+    Counts observations and keeps the latest `window` of them to estimate quantiles over the recent past.
+    """
+
+    TYPE = 'summary'
+    QUANTILES = (0.5, 0.99, 0.999)
+
+    def __init__(self, name: str, labels: Dict[str, str], window: int = 1024):
+        super().__init__(name, labels)
+        self._window: Deque[float] = deque(maxlen=window)
+
+    def observe(self, value: float):
+        self._value += 1
+        self._window.append(value)
+
+    def quantile(self, q: float) -> float:
+        """
+        :param q: between 0 and 1
+        :return: the `q` quantile of the recent observations, 0 without any
+        """
+        values = sorted(self._window)
+
+        if not values:
+            return 0.0
+
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def sample(self) -> dict:
+        return {**super().sample(), 'quantiles': {str(q): self.quantile(q) for q in self.QUANTILES}}
+
+
+class Histogram(Counter):
+    """
+    Counts observations into fixed buckets, cheap enough to observe every request.
+    """
+
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, labels: Dict[str, str], buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, labels)
+        self._bounds: List[float] = sorted(buckets)
+        # the last bucket counts the observations above every bound
+        self._counts: List[int] = [0] * (len(self._bounds) + 1)
+        self._sum: float = 0
+
+    @property
+    def sum(self) -> float:
+        return self._sum
+
+    def observe(self, value: float):
+        self._value += 1
+        self._sum += value
+        self._counts[bisect.bisect_left(self._bounds, value)] += 1
+
+    def buckets(self) -> List[Tuple[float, int]]:
+        """
+        :return: every upper bound, up to infinity, with the observations up to it
+        """
+        cumulative, total = list(), 0
+
+        for bound, count in zip([*self._bounds, math.inf], self._counts):
+            total += count
+            cumulative.append((bound, total))
+
+        return cumulative
+
+    def sample(self) -> dict:
+        return {**super().sample(), 'sum': self._sum, 'buckets': self.buckets()}
+
+
+class MetricsRegistry:
+    """
+    In-process registry of named metrics. A metric is created on first use and the same object is
+    returned for the same name and labels afterwards, so hot paths should keep a reference to it.
+    """
+
+    def __init__(self):
+        self._lock: threading.Lock = threading.Lock()
+        self._metrics: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], Counter] = dict()
+        self._collectors: List[Callable[[], None]] = list()
+
+    def counter(self, name: str, **labels) -> Counter:
+        return self._get_or_create(Counter, name, labels)
+
+    def gauge(self, name: str, **labels) -> Gauge:
+        return self._get_or_create(Gauge, name, labels)
+
+    def summary(self, name: str, **labels) -> Summary:
+        return self._get_or_create(Summary, name, labels)
+
+    def histogram(self, name: str, buckets: Sequence[float] = DEFAULT_BUCKETS, **labels) -> Histogram:
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.setdefault(key, Histogram(name, labels, buckets))
+
+        return self._check_kind(metric, Histogram)
+
+    def add_collector(self, collector: Callable[[], None]):
+        """
+        Register a function that updates gauges right before the metrics are collected, for values that are
+        cheaper to read when asked for than to keep up to date, e.g. the depth of every queue.
+        :param collector:
+        :return:
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def remove_collector(self, collector: Callable[[], None]):
+        with self._lock:
+            if collector in self._collectors:
+                self._collectors.remove(collector)
+
+    def collect(self) -> Dict[str, list]:
+        with self._lock:
+            collectors = list(self._collectors)
+
+        for collector in collectors:
+            collector()
+
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        collected: Dict[str, list] = dict()
+
+        for metric in metrics:
+            collected.setdefault(metric.name, []).append(metric.sample())
+
+        return collected
+
+    def to_prometheus(self) -> str:
+        """
+        The metrics in the Prometheus text exposition format.
+        :return:
+        """
+        collected = self.collect()
+
+        with self._lock:
+            types = {metric.name: metric.TYPE for metric in self._metrics.values()}
+
+        lines = list()
+
+        for name, samples in sorted(collected.items()):
+            kind = types[name]
+            lines.append(f'# TYPE {name} {kind}')
+
+            for sample in samples:
+                labels = sample['labels']
+
+                if kind == 'histogram':
+                    for bound, count in sample['buckets']:
+                        lines.append(f'{name}_bucket{_labels(labels, le=_number(bound))} {count}')
+
+                    lines.append(f'{name}_sum{_labels(labels)} {_number(sample["sum"])}')
+                    lines.append(f'{name}_count{_labels(labels)} {_number(sample["value"])}')
+                elif kind == 'summary':
+                    for q, value in sample['quantiles'].items():
+                        lines.append(f'{name}{_labels(labels, quantile=q)} {_number(value)}')
+
+                    lines.append(f'{name}_count{_labels(labels)} {_number(sample["value"])}')
+                else:
+                    lines.append(f'{name}{_labels(labels)} {_number(sample["value"])}')
+
+        return '\n'.join(lines) + '\n'
+
+    def _get_or_create(self, kind, name: str, labels: Dict[str, str]):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.setdefault(key, kind(name, labels))
+
+        return self._check_kind(metric, kind)
+
+    @staticmethod
+    def _check_kind(metric: Counter, kind):
+        if not isinstance(metric, kind):
+            raise TypeError(f'Metric {metric.name} is a {type(metric).__name__}, not a {kind.__name__}')
+
+        return metric
+
+
+def _labels(labels: Dict[str, str], **extra) -> str:
+    labels = {**labels, **extra}
+
+    if not labels:
+        return ''
+
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+metrics = MetricsRegistry()
@@ -1,14 +1,116 @@
+import struct
+from typing import List
+
+from RDQueue.common.config import settings
+from RDQueue.common.exceptions import FrameTooLarge, InvalidFrame
 from RDQueue.common.message import message_factory
+from RDQueue.common.metrics import Counter
+
+# Every frame on the wire is: magic (2 bytes) | version (1 byte) | flags (1 byte) | payload length (4 bytes)
+FRAME_MAGIC = b'RQ'
+FRAME_VERSION = 0x1
+FRAME_HEADER = struct.Struct('!2sBBI')
+
+MAX_FRAME_SIZE: int = settings.MAX_MESSAGE_SIZE
+
+
+def encode_frame_header(payload_size: int, flags: int = 0, max_size: int = MAX_FRAME_SIZE) -> bytes:
+    if payload_size > max_size:
+        raise FrameTooLarge(payload_size, max_size)
+
+    return FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, flags, payload_size)
+
+
+def decode_frame_header(header: bytes | memoryview, max_size: int = MAX_FRAME_SIZE) -> tuple[int, int]:
+    """
+    Validate a frame header and return its flags and payload length.
+    :param header:
+    :param max_size:
+    :return:
+    """
+    magic, version, flags, payload_size = FRAME_HEADER.unpack_from(header)
+
+    if magic != FRAME_MAGIC or version != FRAME_VERSION:
+        raise InvalidFrame()
+
+    if payload_size > max_size:
+        raise FrameTooLarge(payload_size, max_size)
+
+    return flags, payload_size
+
+
+async def receive_frame(reader, max_size: int = MAX_FRAME_SIZE) -> memoryview:
+    header = await reader.readexactly(FRAME_HEADER.size)
+    _, payload_size = decode_frame_header(header, max_size=max_size)
+    return memoryview(await reader.readexactly(payload_size))
+
 
+def write_frame(writer, payload: bytes, flags: int = 0, max_size: int = MAX_FRAME_SIZE):
+    writer.write(encode_frame_header(len(payload), flags=flags, max_size=max_size))
+    writer.write(payload)
 
-async def receive_message(reader):
-    message_data = await reader.readuntil(b'\n\r')
-    return message_factory.from_bytes(message_data)
 
+async def receive_message(reader, max_size: int = MAX_FRAME_SIZE):
+    return message_factory.from_bytes(await receive_frame(reader, max_size=max_size))
 
-async def send_message_to_writer(writer, message):
-    writer.write(message.to_bytes() + b'\n\r')
+
+def write_message(writer, message, max_size: int = MAX_FRAME_SIZE):
+    write_frame(writer, message.to_bytes(), max_size=max_size)
+
+
+async def send_message_to_writer(writer, message, max_size: int = MAX_FRAME_SIZE):
+    write_message(writer, message, max_size=max_size)
     await writer.drain()
 
 
+class FrameWriter:
+    """
+    Buffers outgoing frames so that the responses to a run of pipelined requests leave in a single write.
+    `drain` only flushes once the buffered bytes cross the high-water mark, `flush` always does.
+    """
+
+    def __init__(self, writer, high_water: int = 64 * 1024, sent: Counter | None = None):
+        """
+        :param writer:
+        :param high_water:
+        :param sent: counts the bytes written, if given
+        """
+        self._writer = writer
+        self._high_water: int = high_water
+        self._sent: Counter | None = sent
+        self._buffer: List[bytes] = []
+        self._buffered: int = 0
+
+    @property
+    def buffered(self) -> int:
+        return self._buffered
+
+    def write(self, data: bytes):
+        self._buffer.append(data)
+        self._buffered += len(data)
+
+    async def drain(self):
+        if self._buffered >= self._high_water:
+            await self.flush()
+
+    async def flush(self):
+        if self._buffer:
+            if self._sent is not None:
+                self._sent.inc(self._buffered)
+
+            buffer, self._buffer, self._buffered = self._buffer, [], 0
+            self._writer.writelines(buffer)
+
+        await self._writer.drain()
+
+    def get_extra_info(self, name, default=None):
+        return self._writer.get_extra_info(name, default)
+
+    def is_closing(self) -> bool:
+        return self._writer.is_closing()
+
+    def close(self):
+        self._writer.close()
 
+    async def wait_closed(self):
+        await self._writer.wait_closed()
@@ -0,0 +1,57 @@
+import zlib
+from typing import Any, List
+
+
+def partition_name(name: str, partition: int) -> str:
+    """
+    Name of the queue that stores one partition of a partitioned queue.
+    Partition 0 keeps the name of the queue itself, so a queue created before partitioning is its first partition.
+    :param name:
+    :param partition:
+    :return:
+    """
+    return name if partition == 0 else f'{name}#{partition}'
+
+
+def partition_for_key(key: Any, partitions: int) -> int:
+    """
+    The partition a message with `key` is routed to. The same key always lands on the same partition,
+    whichever client pushes it.
+    :param key:
+    :param partitions:
+    :return:
+    """
+    if not isinstance(key, bytes):
+        key = str(key).encode()
+
+    return zlib.crc32(key) % partitions
+
+
+def assign_owners(name: str, partitions: int, brokers: List[str], replicas: int) -> List[List[str]]:
+    """
+    Spread the partitions of a queue over the brokers, `replicas` brokers per partition.
+    The first owner of a partition is the one clients talk to, and it differs from one partition to the next.
+    :param name:
+    :param partitions:
+    :param brokers:
+    :param replicas:
+    :return: the owners of every partition
+    """
+    replicas = max(1, min(replicas, len(brokers)))
+    # queues do not all start on the first broker
+    start = zlib.crc32(name.encode())
+
+    return [
+        [brokers[(start + partition + i) % len(brokers)] for i in range(replicas)]
+        for partition in range(partitions)
+    ]
+
+
+def worker_for(queue_name: str, workers: int) -> int:
+    """
+    The worker process of a broker that serves a partition, the same one on every broker.
+    :param queue_name: name of the queue storing the partition
+    :param workers:
+    :return:
+    """
+    return zlib.crc32(queue_name.encode()) % workers
@@ -0,0 +1,419 @@
+import asyncio
+import contextlib
+import contextvars
+import logging
+import signal
+import time
+from typing import Dict, Hashable, List, Sequence, Set
+
+from RDQueue.common.address import Address
+from RDQueue.common.config import settings
+from RDQueue.common.decorator import handle_conn_err
+from RDQueue.common.exceptions import Overloaded
+from RDQueue.common.message import Message, Operation, message_factory
+from RDQueue.common.metrics import Histogram, metrics
+from RDQueue.common.networking import FRAME_HEADER, FrameWriter, receive_frame, send_message_to_writer, write_message
+from RDQueue.server.budget import MemoryBudget
+from RDQueue.server.diagnostics import LoopMonitor, Profiler
+from RDQueue.server.prometheus import MetricsEndpoint
+
+logger = logging.getLogger(__file__)
+
+# the size of the request being handled, in bytes, as read from the connection
+request_size: contextvars.ContextVar[int] = contextvars.ContextVar('request_size', default=0)
+# set once the requests read after the one being handled, with the same ordering key, may start
+_turn: contextvars.ContextVar[asyncio.Event | None] = contextvars.ContextVar('turn', default=None)
+# seconds the request being handled spent parked so far, see `BaseServer.parked`
+_parked: contextvars.ContextVar[float] = contextvars.ContextVar('parked', default=0.0)
+
+
+def pass_turn():
+    """
+    Let the requests read after the one being handled on its connection, with the same ordering key, start once it
+    is submitted in order, e.g. to the replication log, while it waits for its outcome. The turn is passed anyway
+    once the request is handled.
+    :return:
+    """
+    turn = _turn.get()
+
+    if turn is not None:
+        turn.set()
+
+
+class BaseServer:
+    """
+    Accepts long-lived client connections and serves the requests pipelined on each of them concurrently.
+    Responses produced while more requests are already waiting are coalesced into a single write.
+    """
+
+    def __init__(self, connection_address: Address, reuse_port: bool = False,
+                 extra_addresses: Sequence[Address] = (), metrics_address: Address | None = None):
+        """
+        :param connection_address:
+        :param reuse_port: share the port with other processes, the kernel spreads the connections between them
+        :param extra_addresses: other addresses to accept connections at, without sharing them
+        :param metrics_address: where the metrics are served as Prometheus text, nowhere if None
+        """
+        self._connection_address: Address = connection_address
+        self._reuse_port: bool = reuse_port
+        self._extra_addresses: List[Address] = list(extra_addresses)
+        self._idle_timeout: float = settings.CONNECTION_IDLE_TIMEOUT
+        self._pipeline_depth: int = settings.MAX_PIPELINED_REQUESTS
+
+        self._in_flight: int = 0
+        server = connection_address.connection_str
+        self._request_duration = metrics.summary('request_duration_seconds', server=server)
+        # the duration of the requests of every operation, created as the operations are first seen
+        self._operation_durations: Dict[Operation, Histogram] = dict()
+        self._received_bytes = metrics.counter('received_bytes_total', server=server)
+        self._sent_bytes = metrics.counter('sent_bytes_total', server=server)
+        self._metrics_endpoint: MetricsEndpoint | None = MetricsEndpoint(metrics_address) if metrics_address else None
+        self._loop_monitor: LoopMonitor = LoopMonitor(server=server)
+        self._profiler: Profiler = Profiler(server)
+        # the bytes of the requests read and not handled yet, over every connection
+        self._memory: MemoryBudget = MemoryBudget(settings.SERVER_MEMORY_BUDGET, budget='server', server=server)
+        self._paused_connections = metrics.gauge('connections_paused', server=server)
+
+        self._servers: List[asyncio.Server] = list()
+        self._stopping: bool = False
+        self._stopped: asyncio.Event = asyncio.Event()
+        self._clients: Set[asyncio.Task] = set()
+
+    @property
+    def connection_address(self) -> Address:
+        return self._connection_address
+
+    @property
+    def active_connections(self) -> int:
+        return len(self._clients)
+
+    @property
+    def in_flight(self) -> int:
+        """
+        Requests being handled, over every connection.
+        :return:
+        """
+        return self._in_flight
+
+    @property
+    def request_duration(self):
+        return self._request_duration
+
+    @property
+    def memory(self) -> MemoryBudget:
+        return self._memory
+
+    async def start(self):
+        self._loop_monitor.start()
+        self._servers.append(await asyncio.start_server(self.handle_client, *self.connection_address.tuple,
+                                                        reuse_port=self._reuse_port or None))
+
+        for address in self._extra_addresses:
+            self._servers.append(await asyncio.start_server(self.handle_client, *address.tuple))
+
+        if self._metrics_endpoint is not None:
+            await self._metrics_endpoint.start()
+
+        await self._stopped.wait()
+
+    async def stop(self):
+        """
+        Stop accepting connections, let every connection finish the requests it has already read and close it.
+        :return:
+        """
+        if self._stopping:
+            return
+
+        self._stopping = True
+        logger.info(f'Shutting down server at {self.connection_address}')
+
+        for server in self._servers:
+            server.close()
+
+        if self._metrics_endpoint is not None:
+            self._metrics_endpoint.stop()
+
+        for client in list(self._clients):
+            client.cancel()
+
+        await asyncio.gather(*self._clients, return_exceptions=True)
+        await self.on_shutdown()
+        self._loop_monitor.stop()
+        self._stopped.set()
+
+    async def on_shutdown(self):
+        """
+        Called once every connection is closed, before `start` returns.
+        :return:
+        """
+        pass
+
+    def connection_closed(self, writer: FrameWriter):
+        """
+        Called once a connection is closed, e.g. to drop what was bound to it.
+        :param writer:
+        :return:
+        """
+        pass
+
+    async def handle_client(self, reader, writer):
+        client = asyncio.current_task()
+        self._clients.add(client)
+
+        # a client not reading its responses holds the requests that produce them back, instead of buffering them
+        writer.transport.set_write_buffer_limits(high=settings.CONNECTION_WRITE_BUFFER)
+
+        try:
+            await self._serve_connection(reader, FrameWriter(writer, sent=self._sent_bytes))
+        finally:
+            self._clients.discard(client)
+
+    @handle_conn_err
+    async def _serve_connection(self, reader, writer: FrameWriter):
+        loop = asyncio.get_running_loop()
+        requests: asyncio.Queue = asyncio.Queue(maxsize=self._pipeline_depth)
+        budget = MemoryBudget(settings.CONNECTION_MEMORY_BUDGET)
+        worker = asyncio.create_task(self._process_requests(requests, writer, budget))
+
+        reading = asyncio.current_task()
+        is_reading = True
+        last_activity = loop.time()
+
+        def stop_reading(*_):
+            if is_reading:
+                reading.cancel()
+
+        def check_idle():
+            nonlocal idle_timer
+            idle_for = loop.time() - last_activity
+
+            if idle_for >= self._idle_timeout:
+                logger.info(f'Closing connection idle for {idle_for:.0f}s: {writer.get_extra_info("peername")}')
+                stop_reading()
+            else:
+                idle_timer = loop.call_later(self._idle_timeout - idle_for, check_idle)
+
+        idle_timer = loop.call_later(self._idle_timeout, check_idle)
+        worker.add_done_callback(stop_reading)
+
+        try:
+            while True:
+                await self._wait_for_memory(budget)
+                frame = await receive_frame(reader)
+                message = message_factory.from_bytes(frame)
+                last_activity = loop.time()
+                self._received_bytes.inc(FRAME_HEADER.size + len(frame))
+
+                await requests.put((message, len(frame)))
+                # only once the request is queued, its handler releases them: a read cancelled while waiting for
+                # room in the queue holds nothing
+                budget.acquire(len(frame))
+                self._memory.acquire(len(frame))
+        except asyncio.CancelledError:
+            # idle timeout, server shutdown or a failed worker: finish what was already read and close
+            pass
+        finally:
+            is_reading = False
+            idle_timer.cancel()
+
+            if not worker.done():
+                await requests.put(None)
+                await asyncio.gather(worker, return_exceptions=True)
+
+            writer.close()
+            self.connection_closed(writer)
+
+    async def _wait_for_memory(self, budget: MemoryBudget):
+        """
+        Stop reading a connection while its requests take up its budget, or the ones of every connection take up
+        most of the budget of the server, until enough of them are handled.
+        :param budget: of the connection
+        :return:
+        """
+        level = settings.MEMORY_BACKPRESSURE_LEVEL
+
+        if not budget.exhausted() and self._memory.pressure <= level:
+            return
+
+        self._paused_connections.inc()
+
+        try:
+            while budget.exhausted() or self._memory.pressure > level:
+                await budget.wait_for_room()
+                await self._memory.wait_for_room(level)
+        finally:
+            self._paused_connections.dec()
+
+    def ordering_key(self, message: Message) -> Hashable | None:
+        """
+        The requests of a connection with the same ordering key start in the order they were read, each one once
+        the previous one passed its turn, see `pass_turn`. Requests without one start right away.
+        :param message:
+        :return:
+        """
+        return None
+
+    async def _process_requests(self, requests: asyncio.Queue, writer: FrameWriter, budget: MemoryBudget):
+        # requests are started in the order they were read, but a slow one (e.g. waiting on replication)
+        # does not hold back the ones behind it, unless they share its ordering key; responses are matched
+        # to requests by id
+        slots = asyncio.Semaphore(self._pipeline_depth)
+        handlers: Set[asyncio.Task] = set()
+        # the turn of the last request read with every ordering key
+        turns: Dict[Hashable, asyncio.Event] = dict()
+
+        def release(size: int):
+            slots.release()
+            budget.release(size)
+            self._memory.release(size)
+
+        def forget(key: Hashable, turn: asyncio.Event):
+            if turns.get(key) is turn:
+                del turns[key]
+
+        while (request := await requests.get()) is not None:
+            message, size = request
+            await slots.acquire()
+            request_size.set(size)
+
+            key = self.ordering_key(message)
+            previous = turn = None
+
+            if key is not None:
+                previous = turns.get(key)
+                turn = turns[key] = asyncio.Event()
+
+            handler = asyncio.create_task(self._process_request(message, writer, requests, previous, turn))
+            handlers.add(handler)
+            handler.add_done_callback(handlers.discard)
+            handler.add_done_callback(lambda _, size=size: release(size))
+
+            if key is not None:
+                handler.add_done_callback(lambda _, key=key, turn=turn: forget(key, turn))
+
+        await asyncio.gather(*handlers, return_exceptions=True)
+        await writer.flush()
+
+    async def _process_request(self, message: Message, writer: FrameWriter, requests: asyncio.Queue,
+                               previous: asyncio.Event | None = None, turn: asyncio.Event | None = None):
+        """
+        :param message:
+        :param writer:
+        :param requests: still to be handled on the connection
+        :param previous: turn of the request read before this one with the same ordering key, which it waits for
+        :param turn: of this request
+        :return:
+        """
+        started = time.perf_counter()
+        self._in_flight += 1
+        _turn.set(turn)
+        _parked.set(0.0)
+
+        try:
+            if previous is not None:
+                await previous.wait()
+
+            await self.handle_message(message, writer)
+        except Exception as e:
+            metrics.counter('request_errors_total', operation=message.operation.name, error=type(e).__name__,
+                            server=self.connection_address.connection_str).inc()
+
+            if isinstance(e, Overloaded):
+                # the client tries again later, a burst of them is expected under load
+                logger.warning(f'Rejected {message}: {e.message}')
+            else:
+                logger.exception(f'Failed to handle {message}')
+
+            write_message(writer, message_factory.error_res(
+                sender_addr=self.connection_address.connection_str,
+                receiver_addr=message.sender_addr,
+                _id=message.id,
+                operation=message.operation,
+                body={
+                    'error': type(e).__name__,
+                    'message': getattr(e, 'message', None) or str(e)
+                }
+            ))
+        finally:
+            if turn is not None:
+                turn.set()
+
+            self._in_flight -= 1
+            duration = time.perf_counter() - started
+            # the load balancer reads the latency of the server from it
+            self._request_duration.observe(duration - _parked.get())
+            self._operation_duration(message.operation).observe(duration)
+
+        if requests.empty():
+            await writer.flush()
+
+    async def handle_message(self, message: Message, writer):
+        raise NotImplementedError
+
+    @contextlib.contextmanager
+    def parked(self):
+        """
+        Leave the time the request being handled spends in the block out of its latency, and the request out of the
+        ones in flight meanwhile, e.g. for a pop waiting for messages to be pushed: a server holding parked requests
+        is not loaded. The duration of its operation still includes that time.
+        :return:
+        """
+        started = time.perf_counter()
+        self._in_flight -= 1
+
+        try:
+            yield
+        finally:
+            self._in_flight += 1
+            _parked.set(_parked.get() + time.perf_counter() - started)
+
+    def stats(self) -> dict:
+        """
+        The answer to a STATS request: every metric of the process, see `MetricsRegistry.collect`.
+        :return:
+        """
+        return {'server': self.connection_address.connection_str, 'metrics': metrics.collect()}
+
+    async def handle_stats(self, message: Message, writer):
+        await send_message_to_writer(writer, message_factory.stats_res(
+            sender_addr=self.connection_address.connection_str,
+            receiver_addr=message.sender_addr,
+            _id=message.id,
+            body=self.stats()
+        ))
+
+    async def handle_profile(self, message: Message, writer):
+        """
+        Profile the event loop for the seconds in the body of the request, and answer with the file the profile
+        was dumped to once done.
+        :param message:
+        :param writer:
+        :return:
+        """
+        body = message.body if isinstance(message.body, dict) else {}
+
+        with self.parked():
+            path = await self._profiler.capture(float(body.get('seconds', 10)))
+
+        await send_message_to_writer(writer, message_factory.profile_res(
+            sender_addr=self.connection_address.connection_str,
+            receiver_addr=message.sender_addr,
+            _id=message.id,
+            body={'path': str(path)}
+        ))
+
+    def _operation_duration(self, operation: Operation) -> Histogram:
+        histogram = self._operation_durations.get(operation)
+
+        if histogram is None:
+            histogram = self._operation_durations[operation] = metrics.histogram(
+                'operation_duration_seconds', operation=operation.name, server=self.connection_address.connection_str)
+
+        return histogram
+
+
+def install_shutdown_handlers(*servers: BaseServer):
+    loop = asyncio.get_running_loop()
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, lambda: [asyncio.ensure_future(s.stop()) for s in servers])
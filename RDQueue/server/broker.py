@@ -1,89 +1,161 @@
 import argparse
 import asyncio
 import logging
+import multiprocessing
+import signal
+import time
 import uuid
 from pathlib import Path
+from typing import Callable, Dict, List, Set
 
 from RDQueue.common.address import Address, address_factory
 from RDQueue.common.config import settings
-from RDQueue.common.decorator import handle_conn_err, periodic_task
+from RDQueue.common.connection import Connection
+from RDQueue.common.decorator import periodic_task
+from RDQueue.common.exceptions import NoLeaderAvailable, NotPartitionOwner, Overloaded, QueueNotFound, \
+    ReplicationFailed, ReplicationTimeout
+from RDQueue.common.logs import setup_logging
 from RDQueue.common.message import Message, MessageType, Operation, message_factory as message_factory
-from RDQueue.common.networking import send_message_to_writer, receive_message
+from RDQueue.common.metrics import metrics
+from RDQueue.common.networking import FrameWriter, send_message_to_writer
+from RDQueue.common.partitioning import assign_owners, partition_name, worker_for
+from RDQueue.server.base import BaseServer, install_shutdown_handlers, pass_turn, request_size
+from RDQueue.server.budget import MemoryBudget
+from RDQueue.server.catalog import Catalog
+from RDQueue.server.group_commit import GroupCommitter
 from RDQueue.server.message_queue import QueueManager
+from RDQueue.server.replication import ReplicationHub
+from RDQueue.server.subscription import BaseSubscription, RelayedSubscription, Subscription
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__file__)
 
-
-class Broker:
-    def __init__(self, connection_address: Address):
-        self._connection_address: Address = connection_address
-        self.snapshot_file = Path(__file__).parent / 'snapshots' / f'{self.connection_address}.pickle'
-        self._q_manager = QueueManager(snapshot_file=self.snapshot_file,
-                                       self_address='127.0.0.1:8081' if self.connection_address.connection_str.endswith(
-                                           '1') else '127.0.0.1:8082',
-                                       other_addresses=[
-                                           '127.0.0.1:8081' if self.connection_address.connection_str.endswith(
-                                               '2') else '127.0.0.1:8082'])
-
+# requests for a single partition, served by the worker the partition is pinned to
+_PARTITION_OPERATIONS = {Operation.QUEUE_PUSH, Operation.QUEUE_POP, Operation.QUEUE_PUSH_BATCH,
+                         Operation.QUEUE_POP_BATCH, Operation.SUBSCRIBE}
+
+
+class Broker(BaseServer):
+    def __init__(self, connection_address: Address, worker: int = 0, workers: int = 1):
+        """
+        :param connection_address:
+        :param worker: index of this worker process among the ones of the broker
+        :param workers: worker processes sharing the address of the broker
+        """
+        broker = connection_address.connection_str
+        # with several workers, each one also listens on its own port for the requests the others forward
+        forwarded = [address_factory.from_str(worker_address(broker, worker))] if workers > 1 else []
+        super().__init__(connection_address, reuse_port=workers > 1, extra_addresses=forwarded,
+                         metrics_address=metrics_address(broker, worker))
+        self.snapshot_dir = Path(__file__).parent / 'snapshots' / f'{self.connection_address}'
+        self.data_dir = Path(__file__).parent / 'data' / f'{self.connection_address}'
         self._id: str = str(uuid.uuid4().hex)
-
-        logger.info(f'Broker ({self.id}) started at {self.connection_address.connection_str}')
-        asyncio.create_task(self.periodic_snapshot())
+        self._brokers: List[str] = [address.connection_str for address in settings.BROKER_ADDRESSES]
+        self._loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        self._worker: int = worker
+        self._workers: int = workers
+        # connections to the other workers of this broker, opened on the first forwarded request
+        self._worker_connections: Dict[int, Connection] = dict()
+        # pop requests parked until messages are pushed to their queue, woken from the replication thread
+        self._pop_waiters: Dict[str, Set[asyncio.Future]] = dict()
+        # the subscriptions streamed over each client connection, by the id of their SUBSCRIBE request
+        self._subscriptions: Dict[FrameWriter, Dict[int | str, BaseSubscription]] = dict()
+        self._closing: bool = False
+
+        # one replication group per partition, with the messages of the partition, named after its queue
+        self._groups: Dict[str, QueueManager] = dict()
+        self._committers: Dict[str, GroupCommitter] = dict()
+        # the bytes of the pushes to every partition that are not committed yet
+        self._queue_budgets: Dict[str, MemoryBudget] = dict()
+
+        # the catalog is replicated by every worker, which all have to connect to each other
+        replicas = [replication_address(peer, peer_worker) for peer in self._brokers for peer_worker in range(workers)]
+        self._hub = ReplicationHub(replication_address(broker, worker), replicas)
+        self._hub.start()
+        self._catalog = Catalog(self._hub, replicas, self.snapshot_dir, on_change=self._on_catalog_change,
+                                filename='.catalog' if worker == 0 else f'.catalog.{worker}')
+        self._catalog.start()
+
+        self._labels = {'broker': broker, 'worker': str(worker)}
+        labels = self._labels
+        self._snapshot_duration = metrics.gauge('snapshot_duration_seconds', **labels)
+        self._snapshot_size = metrics.gauge('snapshot_size_bytes', **labels)
+        self._snapshots = metrics.counter('snapshots_total', **labels)
+        metrics.add_collector(self._collect_metrics)
+
+        logger.info(f'Broker ({self.id}) worker {worker}/{workers} started at {broker}')
+        self._start_legacy_groups()
+        self._start_groups()
+
+        asyncio.create_task(self.periodic_retention())
+        asyncio.create_task(self.periodic_group_check())
 
     @property
     def id(self) -> str:
         return self._id
 
-    @property
-    def connection_address(self) -> Address:
-        return self._connection_address
-
-    async def start(self):
-
-        server = await asyncio.start_server(
-            self.handle_client,
-            self.connection_address.host_str,
-            self.connection_address.port
-        )
-        async with server:
-            await server.serve_forever()
-
-    @handle_conn_err
-    async def handle_client(self, reader, writer):
-        message = await receive_message(reader)
-        await self.handle_message(message, writer)
-
     async def handle_message(self, message, writer):
-
-        if not message.operation == Operation.BROKER_INFO:
-            logger.info(f'Received message: {message}')
+        logger.debug('Received message: %s', message, extra={'operation': message.operation.name})
 
         if message.message_type == MessageType.REQUEST:
             await self.handle_request(message, writer)
 
     async def handle_request(self, message: Message, writer):
+        if message.operation in _PARTITION_OPERATIONS:
+            worker = worker_for(self._requested_queue(message), self._workers)
+
+            if worker != self._worker:
+                await self._forward(worker, message, writer)
+                return
+
         if message.operation == Operation.BROKER_INFO:
             await send_message_to_writer(writer, message=message_factory.broker_info_res(
                 sender_addr=self.connection_address.connection_str,
                 receiver_addr=message.sender_addr,
-                body=self.id
+                _id=message.id,
+                body=self.load_report()
             ))
 
         elif message.operation == Operation.QUEUE_CREATE:
-            q = self._q_manager.create_queue(
+            # a plain name creates a queue with the default number of partitions
+            body = message.body if isinstance(message.body, dict) else {'name': message.body}
+            name = body['name']
+            partitions = body.get('partitions')
+
+            if partitions is None:
+                partitions = settings.QUEUE_PARTITIONS
+
+            if '#' in name:
+                raise ValueError(f'Queue name {name} must not contain "#"')
+
+            if not isinstance(partitions, int) or isinstance(partitions, bool) or partitions < 1:
+                raise ValueError(f'Queue {name} must have a positive integer number of partitions, not {partitions!r}')
+
+            info = await self._catalog.replicate(
+                self._catalog.create_queue,
                 owner=message.sender_id,
-                name=message.body
+                name=name,
+                owners=assign_owners(name, partitions, self._brokers, settings.PARTITION_REPLICAS),
+                queue_id=str(uuid.uuid4().hex)
             )
 
+            # let the partitions replicated here elect their leaders before they are used
+            self._start_groups()
+            for partition in range(len(info['owners'])):
+                group = self._groups.get(partition_name(name, partition))
+
+                if group is not None:
+                    await group.wait_for_leader()
+
             q_info = {
-                'name': q.name,
-                'id': q.id,
+                'name': info['name'],
+                'id': info['id'],
+                'partitions': await self._partition_map(info['name']),
             }
 
             await send_message_to_writer(writer, message=message_factory.queue_create_res(
                 sender_addr=self.connection_address.connection_str,
                 receiver_addr=message.sender_addr,
+                _id=message.id,
                 body=q_info
             ))
 
@@ -91,48 +163,590 @@ class Broker:
 
             body = message.body
 
-            self._q_manager.push(message=message)
+            queue_name = await self._partition(body)
+            await self._push(queue_name, message.sender_id, [body['message']])
 
             await send_message_to_writer(writer, message=message_factory.queue_push_res(
                 sender_addr=self.connection_address.connection_str,
                 receiver_addr=message.sender_addr,
+                _id=message.id,
                 body='OK'
             ))
 
-            logger.info(f'Pushed message to queue: {body["queue_name"]}')
+            logger.debug('Pushed message to queue: %s', body['queue_name'], extra={'operation': 'QUEUE_PUSH'})
 
         elif message.operation == Operation.QUEUE_POP:
-            msg = self._q_manager.pop(message)
+            body = message.body if isinstance(message.body, dict) else {'queue_name': message.body}
+
+            queue_name = await self._partition(body)
+            group = self._groups[queue_name]
+            # without max_n a single message is popped, with max_n = 0 the request only waits for messages
+            max_n = body.get('max_n')
+            wait = self._pop_wait(message)
+
+            with self.parked():
+                available = await self._wait_for_messages(queue_name, message.sender_id, wait)
+
+            if max_n == 0:
+                msg = available or 0
+            elif wait and not available:
+                # still nothing after the wait, no need to replicate an empty pop
+                msg = None if max_n is None else []
+            elif max_n is None:
+                msg = await self._pop(queue_name, group.pop, message.sender_id)
+            else:
+                msg = await self._pop(queue_name, group.pop_batch, message.sender_id, max_n)
 
             await send_message_to_writer(writer, message=message_factory.queue_pop_res(
                 sender_addr=self.connection_address.connection_str,
                 receiver_addr=message.sender_addr,
+                _id=message.id,
                 receiver_id=message.sender_id,
                 body=msg
             ))
 
-    @periodic_task(interval=10)
-    async def periodic_snapshot(self):
-        self._q_manager.create_snapshot()
-        self._q_manager.print_queues_messages(address=self.connection_address.connection_str)
+        elif message.operation == Operation.QUEUE_PUSH_BATCH:
+            body = message.body
+
+            queue_name = await self._partition(body)
+            count = await self._push(queue_name, message.sender_id, body['messages'])
+
+            await send_message_to_writer(writer, message=message_factory.queue_push_batch_res(
+                sender_addr=self.connection_address.connection_str,
+                receiver_addr=message.sender_addr,
+                _id=message.id,
+                body=count
+            ))
+
+            logger.debug('Pushed %d messages to queue: %s', count, body['queue_name'],
+                         extra={'operation': 'QUEUE_PUSH_BATCH'})
+
+        elif message.operation == Operation.QUEUE_POP_BATCH:
+            body = message.body
+
+            queue_name = await self._partition(body)
+            group = self._groups[queue_name]
+            messages = await self._pop(queue_name, group.pop_batch, message.sender_id, body['max_n'])
+
+            await send_message_to_writer(writer, message=message_factory.queue_pop_batch_res(
+                sender_addr=self.connection_address.connection_str,
+                receiver_addr=message.sender_addr,
+                _id=message.id,
+                receiver_id=message.sender_id,
+                body=messages
+            ))
+
+        elif message.operation == Operation.SUBSCRIBE:
+            # answered by the subscription itself, every time it has messages to stream
+            body = message.body
+
+            queue_name = await self._partition(body)
+            group = self._groups[queue_name]
+            client_id = message.sender_id
+
+            subscription = Subscription(
+                message, queue_name, writer, self.connection_address.connection_str,
+                credits=body.get('credits') or settings.SUBSCRIBE_WINDOW,
+                wait_for_messages=lambda: self._wait_for_messages(queue_name, client_id, settings.MAX_POP_WAIT),
+                pop=lambda max_n: group.replicate(group.pop_batch, queue_name, client_id, max_n, time.time())
+            )
+            self._add_subscription(writer, subscription)
+
+        elif message.operation == Operation.CREDIT:
+            subscription = self._subscriptions.get(writer, {}).get(message.body['subscription'])
+
+            # the subscription may have just ended
+            if subscription is not None:
+                subscription.grant(message.body['credits'])
+
+        elif message.operation == Operation.UNSUBSCRIBE:
+            subscription = self._subscriptions.get(writer, {}).get(message.body['subscription'])
+
+            if subscription is not None:
+                subscription.cancel()
+
+        elif message.operation == Operation.STATS:
+            await self.handle_stats(message, writer)
+
+        elif message.operation == Operation.PROFILE:
+            await self.handle_profile(message, writer)
+
+        elif message.operation == Operation.PARTITION_MAP:
+            await send_message_to_writer(writer, message=message_factory.partition_map_res(
+                sender_addr=self.connection_address.connection_str,
+                receiver_addr=message.sender_addr,
+                _id=message.id,
+                body={
+                    'name': message.body,
+                    'partitions': await self._partition_map(message.body)
+                }
+            ))
+
+    def load_report(self) -> dict:
+        """
+        The load of this broker, which the load balancer spreads the clients by.
+        :return:
+        """
+        return {
+            'id': self.id,
+            'connections': self.active_connections,
+            'in_flight': self.in_flight,
+            'queue_depth': sum(group.depth() for group in list(self._groups.values())),
+            'p99': self.request_duration.quantile(0.99),
+        }
+
+    def stats(self) -> dict:
+        return {**super().stats(), 'worker': self._worker}
+
+    def _collect_metrics(self):
+        """
+        Update the gauges of the queues and replication groups of this worker, right before they are collected.
+        :return:
+        """
+        groups = [self._catalog, *self._groups.values()]
+
+        for group in groups:
+            labels = {'group': group.group, **self._labels}
+            metrics.gauge('replication_is_leader', **labels).set(int(group.is_leader))
+            metrics.gauge('replication_lag_entries', **labels).set(group.replication_lag())
+
+        for group in groups[1:]:
+            for name, stats in group.queue_stats().items():
+                labels = {'queue': name, **self._labels}
+                metrics.gauge('queue_messages', **labels).set(stats['messages'])
+                metrics.gauge('queue_consumers', **labels).set(stats['consumers'])
+                metrics.gauge('queue_consumer_lag_max', **labels).set(stats['consumer_lag_max'])
+
+    def ordering_key(self, message: Message) -> str | None:
+        # the requests of a connection to the same partition are applied in the order they were sent
+        return self._requested_queue(message) if message.operation in _PARTITION_OPERATIONS else None
+
+    @staticmethod
+    def _requested_queue(message: Message) -> str:
+        # the queue storing the partition a request is for, requests without a partition go to the first one
+        body = message.body if isinstance(message.body, dict) else {'queue_name': message.body}
+        return partition_name(body['queue_name'], body.get('partition') or 0)
+
+    async def _forward(self, worker: int, message: Message, writer):
+        """
+        Relay a request to the worker of this broker serving its partition, and its response back to the client.
+        :param worker:
+        :param message:
+        :param writer:
+        :return:
+        """
+        connection = self._worker_connections.get(worker)
+
+        if connection is None:
+            address = address_factory.from_str(worker_address(self.connection_address.connection_str, worker))
+            connection = Connection(address, request_timeout=settings.REPLICATION_TIMEOUT + 1)
+            self._worker_connections[worker] = connection
+
+        if message.operation == Operation.SUBSCRIBE:
+            subscription = RelayedSubscription(message, self._requested_queue(message), writer,
+                                               self.connection_address.connection_str, connection)
+            self._add_subscription(writer, subscription)
+            return
+
+        # the connection is shared by the requests of every client, whose ids may collide
+        relayed = message.copy()
+        wait = self._pop_wait(message)
+
+        if wait:
+            # the worker may park the pop for that long before it replicates it
+            with self.parked():
+                response = await connection.request(relayed, timeout=wait + settings.REPLICATION_TIMEOUT + 1,
+                                                    on_sent=pass_turn)
+        else:
+            response = await connection.request(relayed, on_sent=pass_turn)
+
+        await send_message_to_writer(writer, message=response.copy(_id=message.id))
+
+    @staticmethod
+    def _pop_wait(message: Message) -> float:
+        """
+        :param message:
+        :return: the seconds a QUEUE_POP may wait for messages to be pushed, 0 for other requests
+        """
+        if message.operation != Operation.QUEUE_POP or not isinstance(message.body, dict):
+            return 0
+
+        return min(message.body.get('wait') or 0, settings.MAX_POP_WAIT)
+
+    def _add_subscription(self, writer: FrameWriter, subscription: BaseSubscription):
+        subscriptions = self._subscriptions.setdefault(writer, dict())
+        previous = subscriptions.get(subscription.id)
+
+        if previous is not None:
+            previous.cancel()
+
+        subscriptions[subscription.id] = subscription
+        subscription.start(on_done=lambda _: self._remove_subscription(writer, subscription))
+        logger.info(f'Subscription {subscription.id} to {subscription.queue_name} started')
+
+    def _remove_subscription(self, writer: FrameWriter, subscription: BaseSubscription):
+        subscriptions = self._subscriptions.get(writer, {})
+
+        if subscriptions.get(subscription.id) is subscription:
+            del subscriptions[subscription.id]
+
+        if not subscriptions:
+            self._subscriptions.pop(writer, None)
+
+    def connection_closed(self, writer: FrameWriter):
+        for subscription in list(self._subscriptions.get(writer, {}).values()):
+            subscription.cancel()
+
+    async def _push(self, queue_name: str, client_id: str, messages: List) -> int:
+        """
+        Push messages through the group committer of a queue, if the memory budgets of the broker and of the queue
+        have room for them. Past the backpressure level of the queue, the push is acknowledged a little later
+        to slow its producers down. The messages are stamped with the time of this broker, see `_pop`.
+        :param queue_name:
+        :param client_id:
+        :param messages:
+        :return: the number of messages appended
+        """
+        budget = self._queue_budgets[queue_name]
+        size = request_size.get()
+
+        if self.memory.exhausted():
+            self._reject('server')
+
+        # a single push larger than the whole budget is still let through on its own
+        if budget.used and budget.exhausted(size):
+            self._reject('queue')
+
+        budget.acquire(size)
+        pressure = budget.pressure
+
+        try:
+            committed = self._committers[queue_name].submit(queue_name, client_id, messages, time.time())
+            pass_turn()
+            count = await committed
+        finally:
+            budget.release(size)
+
+        level = settings.MEMORY_BACKPRESSURE_LEVEL
+
+        if pressure > level:
+            await asyncio.sleep(settings.MAX_ACK_DELAY * min((pressure - level) / (1 - level), 1))
+
+        return count
+
+    async def _pop(self, queue_name: str, method: Callable, client_id: str, *args):
+        """
+        Replicate a pop from a queue behind the pushes gathered for it so far, which include the ones read before
+        the pop on its connection. The pop is stamped with the time of this broker rather than of the client, as
+        the retention compares the times of the records and clients with the time of the leader.
+        :param queue_name:
+        :param method: `QueueManager.pop` or `QueueManager.pop_batch` of the group of the queue
+        :param client_id:
+        :param args: of the method, between the client id and the timestamp
+        :return: the result of the pop
+        """
+        self._committers[queue_name].flush()
+        popped = self._groups[queue_name].submit(method, queue_name, client_id, *args, time.time())
+        pass_turn()
+        return await popped
+
+    def _reject(self, budget: str):
+        metrics.counter('requests_rejected_total', budget=budget, **self._labels).inc()
+        raise Overloaded(budget)
+
+    async def _wait_for_messages(self, queue_name: str, client_id: str, timeout: float) -> int | None:
+        """
+        Park a pop until messages the client has not popped yet are pushed to the queue, or `timeout` expires.
+        :param queue_name:
+        :param client_id:
+        :param timeout:
+        :return: the messages available to the client, None if it is not known to the queue
+        """
+        group = self._groups[queue_name]
+        available = group.available(queue_name, client_id)
+
+        # a client becomes known to a queue with its first push, which it may be about to make
+        if not timeout or available:
+            return available
+
+        deadline = self._loop.time() + timeout
+        waiters = self._pop_waiters.setdefault(queue_name, set())
+        # the pushes sent after the pop on its connection may be the ones it waits for
+        pass_turn()
+
+        while not available and not self._closing:
+            remaining = deadline - self._loop.time()
+
+            if remaining <= 0:
+                break
+
+            waiter = self._loop.create_future()
+            waiters.add(waiter)
+
+            try:
+                # a push applied after the check above finds the waiter, one applied before it is seen by the check
+                available = group.available(queue_name, client_id)
+
+                if not available:
+                    await asyncio.wait([waiter], timeout=remaining)
+                    available = group.available(queue_name, client_id)
+            finally:
+                waiters.discard(waiter)
+
+        if not waiters:
+            self._pop_waiters.pop(queue_name, None)
+
+        return available
+
+    def _on_push(self, queue_name: str):
+        # called from the replication thread, only bothers the event loop if a pop is waiting
+        if self._pop_waiters.get(queue_name):
+            self._loop.call_soon_threadsafe(self._wake_pops, queue_name)
+
+    def _on_snapshot(self, group: str, duration: float, size: int):
+        # called from the replication thread
+        self._snapshot_duration.set(duration)
+        self._snapshot_size.set(size)
+        self._snapshots.inc()
+
+        logger.info(f'Snapshot of {group} ({size} bytes) took {duration * 1000:.1f}ms')
+
+    def _wake_pops(self, queue_name: str):
+        for waiter in list(self._pop_waiters.get(queue_name, ())):
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def stop(self):
+        # parked pops answer right away instead of holding the shutdown back
+        self._closing = True
+
+        for queue_name in list(self._pop_waiters):
+            self._wake_pops(queue_name)
+
+        for subscriptions in list(self._subscriptions.values()):
+            for subscription in list(subscriptions.values()):
+                subscription.cancel()
+
+        await super().stop()
+
+    def _on_catalog_change(self):
+        # called from the replication thread
+        self._loop.call_soon_threadsafe(self._start_groups)
+
+    def _start_groups(self):
+        """
+        Start the replication group of every partition owned by this broker and pinned to this worker,
+        that is not replicated here yet.
+        :return:
+        """
+        me = self.connection_address.connection_str
+
+        for name, info in self._catalog.queues().items():
+            for partition, owners in enumerate(info['owners']):
+                queue_name = partition_name(name, partition)
+
+                if me in owners and queue_name not in self._groups and self._is_pinned(queue_name):
+                    self._start_group(queue_name, owners, {
+                        'owner': info['owner'],
+                        'id': info['id'],
+                        'partitions': len(info['owners']),
+                        'owners': owners,
+                    })
+
+    def _start_legacy_groups(self):
+        # queues snapshotted before the catalog existed were replicated by every broker, and still are
+        known = {partition_name(name, partition)
+                 for name, info in self._catalog.queues().items() for partition in range(len(info['owners']))}
+
+        for queue_name in QueueManager.snapshot_queue_names(self.snapshot_dir):
+            if queue_name not in known and queue_name not in self._groups and self._is_pinned(queue_name):
+                self._start_group(queue_name, self._brokers,
+                                  {'owner': None, 'id': None, 'partitions': 1, 'owners': []})
+
+    def _is_pinned(self, queue_name: str) -> bool:
+        return worker_for(queue_name, self._workers) == self._worker
+
+    def _start_group(self, queue_name: str, owners: List[str], info: dict):
+        logger.info(f'Starting the replication group of {queue_name} with {owners}')
+
+        group = QueueManager(group=f'queue:{queue_name}',
+                             hub=self._hub,
+                             members=[replication_address(owner, self._worker) for owner in owners],
+                             snapshot_dir=self.snapshot_dir,
+                             data_dir=self.data_dir,
+                             queues={queue_name: info},
+                             preferred_leader=replication_address(owners[0], self._worker),
+                             on_push=self._on_push,
+                             on_snapshot=self._on_snapshot)
+        group.start()
+
+        self._groups[queue_name] = group
+        self._committers[queue_name] = GroupCommitter(group, queue=queue_name, **self._labels)
+        self._queue_budgets[queue_name] = MemoryBudget(settings.QUEUE_MEMORY_BUDGET, budget='queue', queue=queue_name,
+                                                       **self._labels)
+
+    async def _partition_map(self, name: str) -> List[List[str]]:
+        try:
+            return self._catalog.partition_map(name)
+        except QueueNotFound:
+            if name in self._groups:
+                # a queue from before the catalog
+                return [self._brokers]
+
+        # this replica may not have applied the creation of the queue yet,
+        # it has once a command submitted after the creation is applied
+        await self._catalog.replicate(self._catalog.barrier)
+        return self._catalog.partition_map(name)
+
+    async def _partition(self, body: dict) -> str:
+        """
+        The queue storing the partition a request is for, requests without a partition go to the first one.
+        :param body:
+        :return:
+        """
+        name = body['queue_name']
+        partition = body.get('partition') or 0
+        partitions = await self._partition_map(name)
+
+        if not 0 <= partition < len(partitions):
+            raise QueueNotFound(partition_name(name, partition))
+
+        if self.connection_address.connection_str not in partitions[partition]:
+            raise NotPartitionOwner(name, partition)
+
+        queue_name = partition_name(name, partition)
+
+        if queue_name not in self._groups:
+            self._start_groups()
+
+        # the group may have been started by another worker creating the queue a moment ago
+        await self._groups[queue_name].wait_for_leader()
+
+        return queue_name
+
+    async def on_shutdown(self):
+        metrics.remove_collector(self._collect_metrics)
+        await asyncio.gather(*(committer.close() for committer in self._committers.values()))
+        await asyncio.gather(*(connection.close() for connection in self._worker_connections.values()))
+        await asyncio.gather(*(group.snapshot() for group in self._groups.values()))
+        await self._loop.run_in_executor(None, self._hub.stop)
+
+    @periodic_task(interval=settings.RETENTION_CHECK_INTERVAL)
+    async def periodic_retention(self):
+        for group in list(self._groups.values()):
+            # one replica starts the replicated command, the leader is as good as any
+            if not group.is_leader:
+                continue
+
+            try:
+                await group.replicate(group.apply_retention, time.time())
+            except (NoLeaderAvailable, ReplicationTimeout, ReplicationFailed) as e:
+                logger.warning(f'Retention of {group.group} skipped: {e.message}')
+
+    @periodic_task(interval=1)
+    async def periodic_group_check(self):
+        # the catalog may also change through a state transfer from its leader, which does not notify
+        self._start_groups()
+
+
+def replication_address(broker: str, worker: int = 0) -> str:
+    """
+    The address a worker of a broker replicates its groups at, based on the one at the same position in the settings.
+    :param broker:
+    :param worker:
+    :return:
+    """
+    brokers = [address.connection_str for address in settings.BROKER_ADDRESSES]
+    address = settings.REPLICATION_ADDRESS[brokers.index(broker)]
+    return f'{address.host_str}:{address.port + worker * settings.WORKER_PORT_STRIDE}'
+
+
+def worker_address(broker: str, worker: int) -> str:
+    """
+    The address a worker of a broker accepts the requests forwarded by the other workers at.
+    :param broker:
+    :param worker:
+    :return:
+    """
+    address = address_factory.from_str(broker)
+    return f'{address.host_str}:{address.port + (worker + 1) * settings.WORKER_PORT_STRIDE}'
+
+
+def metrics_address(broker: str, worker: int = 0) -> Address | None:
+    """
+    The address a worker of a broker serves its metrics at as Prometheus text, if they are.
+    :param broker:
+    :param worker:
+    :return:
+    """
+    if not settings.METRICS_PORT_OFFSET:
+        return None
+
+    address = address_factory.from_str(broker)
+    return address_factory.from_tuple(address.host_str,
+                                      address.port + settings.METRICS_PORT_OFFSET + worker * settings.WORKER_PORT_STRIDE)
+
+
+async def serve(addresses: List[Address], worker: int = 0, workers: int = 1):
+    setup_logging()
+    brokers = [Broker(address, worker, workers) for address in addresses]
+
+    install_shutdown_handlers(*brokers)
+    await asyncio.gather(*(b.start() for b in brokers))
+
+
+def run_worker(addresses: List[Address], worker: int, workers: int):
+    asyncio.run(serve(addresses, worker, workers))
+
+
+def run_workers(addresses: List[Address], workers: int):
+    """
+    Serve the brokers from several processes, each one replicating and serving its own share of the partitions.
+    :param addresses:
+    :param workers:
+    :return:
+    """
+    # a fresh interpreter per worker, nothing of the parent (e.g. threads) is inherited
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=run_worker, args=(addresses, worker, workers), name=f'broker-worker-{worker}')
+                 for worker in range(workers)]
 
+    for process in processes:
+        process.start()
 
-async def main():
+    def terminate(*_):
+        # the workers shut down gracefully on SIGTERM
+        for p in processes:
+            if p.is_alive():
+                p.terminate()
+
+    signal.signal(signal.SIGINT, terminate)
+    signal.signal(signal.SIGTERM, terminate)
+
+    for process in processes:
+        process.join()
+
+
+def main():
     arg_parser = argparse.ArgumentParser(description='Running the broker server')
     arg_parser.add_argument('--host', type=str, help='The host to bind the broker server')
     arg_parser.add_argument('--port', type=int, help='The port to bind the broker server')
     arg_parser.add_argument('--all', action='store_true', help='Run all the brokers in the cluster')
+    arg_parser.add_argument('--workers', type=int, default=settings.BROKER_WORKERS,
+                            help='The worker processes of every broker, sharing its port')
 
     args = arg_parser.parse_args()
 
     if args.all:
-        brokers = [Broker(addr) for addr in settings.BROKER_ADDRESSES]
-
+        addresses = settings.BROKER_ADDRESSES
     else:
-        brokers = [Broker(address_factory.from_tuple(args.host, args.port))]
+        addresses = [address_factory.from_tuple(args.host, args.port)]
 
-    await asyncio.gather(*(b.start() for b in brokers))
+    if args.workers > 1:
+        run_workers(addresses, args.workers)
+    else:
+        asyncio.run(serve(addresses))
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    main()
@@ -0,0 +1,69 @@
+import asyncio
+
+from RDQueue.common.metrics import metrics
+
+
+class MemoryBudget:
+    """
+    The bytes held by the requests being handled against a limit, e.g. by the requests read from one connection,
+    or by the pushes to one queue that are not committed yet. A limit of 0 leaves the budget unbounded.
+    """
+
+    def __init__(self, limit: int, **labels):
+        """
+        :param limit: in bytes
+        :param labels: of the metrics reporting the level of the budget, none if not given
+        """
+        self._limit: int = limit
+        self._used: int = 0
+        self._released: asyncio.Event = asyncio.Event()
+
+        self._used_gauge = metrics.gauge('memory_budget_used_bytes', **labels) if labels else None
+
+        if labels:
+            metrics.gauge('memory_budget_limit_bytes', **labels).set(limit)
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    @property
+    def used(self) -> int:
+        return self._used
+
+    @property
+    def pressure(self) -> float:
+        """
+        :return: the fraction of the budget in use, 0 if unbounded
+        """
+        return self._used / self._limit if self._limit else 0.0
+
+    def exhausted(self, size: int = 0) -> bool:
+        """
+        :param size: of a request about to be taken
+        :return: whether the budget has no room left for it
+        """
+        return bool(self._limit) and self._used + size > self._limit
+
+    def acquire(self, size: int):
+        self._used += size
+        self._report()
+
+    def release(self, size: int):
+        self._used -= size
+        self._report()
+        self._released.set()
+
+    async def wait_for_room(self, level: float = 1.0):
+        """
+        Wait until the budget is used up to `level` of its limit at most.
+        :param level:
+        :return:
+        """
+        while self._limit and self._used > self._limit * level:
+            self._released.clear()
+            await self._released.wait()
+
+    def _report(self):
+        if self._used_gauge is not None:
+            self._used_gauge.set(self._used)
@@ -0,0 +1,93 @@
+import logging
+import os
+import pickle
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from pysyncobj import replicated
+
+from RDQueue.common.exceptions import QueueNotFound
+from RDQueue.server.replication import AsyncSyncObj, ReplicationHub, returns_errors
+from RDQueue.server.storage import write_atomic
+
+logger = logging.getLogger(__file__)
+
+
+class Catalog(AsyncSyncObj):
+    """
+    The queues of the cluster and the brokers owning each of their partitions. Every worker of every broker
+    replicates it, while the messages of a partition are only replicated by the group of its owners.
+    """
+
+    GROUP = 'catalog'
+
+    def __init__(self, hub: ReplicationHub, members: List[str], snapshot_dir: Path,
+                 on_change: Callable[[], None] | None = None, filename: str = '.catalog'):
+        """
+        :param hub:
+        :param members: replication addresses of every worker of every broker
+        :param snapshot_dir:
+        :param on_change: called from the replication thread when a queue is added
+        :param filename: of the catalog in `snapshot_dir`, for the replicas sharing a directory
+        """
+        # attributes set before SyncObj.__init__ are local to this replica and left out of the replicated state
+        self._path: Path = snapshot_dir / filename
+        self._on_change: Callable[[], None] | None = on_change
+        super().__init__(self.GROUP, hub, members)
+        self._queues: Dict[str, dict] = dict()
+
+        os.makedirs(snapshot_dir, exist_ok=True)
+        if self._path.exists():
+            self._queues = pickle.loads(self._path.read_bytes())
+
+    def queues(self) -> Dict[str, dict]:
+        return dict(self._queues)
+
+    def partition_map(self, name: str) -> List[List[str]]:
+        """
+        The owners of every partition of a queue, as seen by this replica.
+        :param name:
+        :return:
+        """
+        info = self._queues.get(name)
+
+        if info is None:
+            raise QueueNotFound(name)
+
+        return info['owners']
+
+    @replicated
+    @returns_errors
+    def create_queue(self, name: str, owner: str, owners: List[List[str]], queue_id: str) -> dict:
+        """
+        Add a queue with one partition per entry of `owners`, or return the existing queue with that name.
+        :param name:
+        :param owner:
+        :param owners: the brokers owning every partition
+        :param queue_id:
+        :return: the name, owner, id and partition owners of the queue
+        """
+        info = self._queues.get(name)
+
+        if info is not None:
+            return info
+
+        info = {'name': name, 'owner': owner, 'id': queue_id, 'owners': owners}
+        self._queues[name] = info
+
+        # queues are created rarely, the whole catalog is rewritten every time
+        write_atomic(self._path, pickle.dumps(self._queues))
+        logger.info(f'Queue {name} created with partitions owned by {owners}')
+
+        if self._on_change is not None:
+            self._on_change()
+
+        return info
+
+    @replicated
+    def barrier(self):
+        """
+        A command that does nothing. Once it is applied on a replica, every command submitted before it is too.
+        :return:
+        """
+        pass
@@ -0,0 +1,159 @@
+import asyncio
+import cProfile
+import logging
+import sys
+import threading
+import time
+import traceback
+from pathlib import Path
+
+from RDQueue.common.config import settings
+from RDQueue.common.exceptions import ProfilingInProgress
+from RDQueue.common.metrics import metrics
+
+logger = logging.getLogger(__file__)
+
+
+class LoopMonitor:
+    """
+    Measures how late the event loop wakes up a sleeping task, which is how long the loop was held by the callbacks
+    run in the meantime. A watchdog thread notices a stall while it is still going on, and logs what the loop is
+    running at that moment: the task and the stack of the loop thread name the coroutine or handler responsible.
+    """
+
+    def __init__(self, interval: float = settings.LOOP_MONITOR_INTERVAL,
+                 threshold: float = settings.SLOW_CALLBACK_THRESHOLD, **labels):
+        """
+        :param interval: seconds between two samples of the lag
+        :param threshold: stalls longer than this many seconds are reported, none if 0
+        :param labels: of the metrics of the lag
+        """
+        self._interval: float = interval
+        self._threshold: float = threshold
+        self._lag = metrics.histogram('event_loop_lag_seconds', **labels)
+        self._stalls = metrics.counter('event_loop_stalls_total', **labels)
+
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._loop_thread: int | None = None
+        self._last_beat: float = time.monotonic()
+        # what the watchdog caught the loop running during the current stall, if it did
+        self._culprit: str | None = None
+        self._task: asyncio.Task | None = None
+        self._watchdog: threading.Thread | None = None
+        self._stopped: threading.Event = threading.Event()
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._task = asyncio.create_task(self._sample())
+
+        if self._threshold:
+            self._watchdog = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+            self._watchdog.start()
+
+    def stop(self):
+        self._stopped.set()
+
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _sample(self):
+        while True:
+            expected = time.monotonic() + self._interval
+            await asyncio.sleep(self._interval)
+
+            now = time.monotonic()
+            lag = max(now - expected, 0.0)
+            self._last_beat = now
+            self._lag.observe(lag)
+
+            if self._threshold and lag >= self._threshold:
+                self._stalls.inc()
+                logger.warning(f'Event loop stalled for {lag:.3f}s in {self._culprit or "a callback the watchdog missed"}')
+
+            self._culprit = None
+
+    def _watch(self):
+        # checked often enough to catch any stall that lasts at least twice the threshold
+        while not self._stopped.wait(self._threshold / 2):
+            blocked = time.monotonic() - self._last_beat - self._interval
+
+            if blocked >= self._threshold and self._culprit is None:
+                self._culprit, stack = self._running()
+                logger.warning(f'Event loop blocked for {blocked:.3f}s so far in {self._culprit}:\n{stack}')
+
+    def _running(self) -> tuple[str, str]:
+        """
+        Called from the watchdog thread.
+        :return: the task and innermost function the loop is running, and the stack of the loop thread
+        """
+        frame = sys._current_frames().get(self._loop_thread)
+
+        if frame is None:
+            return 'an unknown callback', ''
+
+        stack = traceback.extract_stack(frame)
+        innermost = f'{stack[-1].name} ({Path(stack[-1].filename).name}:{stack[-1].lineno})'
+        task = asyncio.current_task(self._loop)
+
+        if task is None:
+            # a plain callback, e.g. one scheduled from the replication thread
+            culprit = innermost
+        else:
+            culprit = f'task {task.get_name()} running {task.get_coro().__qualname__}, at {innermost}'
+
+        return culprit, ''.join(traceback.format_list(stack[-settings.SLOW_CALLBACK_STACK_DEPTH:]))
+
+
+class Profiler:
+    """
+    Captures a cProfile of the event loop thread for a number of seconds and dumps it to a file, which e.g.
+    `python -m pstats` or snakeviz read. The replication thread is not profiled.
+    """
+
+    # a single profiler can be enabled at a time in a process
+    _active: cProfile.Profile | None = None
+
+    def __init__(self, name: str, directory: Path | None = None):
+        """
+        :param name: of the server, which the files are named after
+        :param directory: where the profiles are dumped, PROFILE_DIR or the `profiles` directory of the server if None
+        """
+        self._name: str = name.replace(':', '-')
+        self._directory: Path = directory or Path(settings.PROFILE_DIR or Path(__file__).parent / 'profiles')
+
+    @property
+    def directory(self) -> Path:
+        return self._directory
+
+    async def capture(self, seconds: float) -> Path:
+        """
+        :param seconds: capped at MAX_PROFILE_SECONDS
+        :return: the file the profile was dumped to
+        """
+        if Profiler._active is not None:
+            raise ProfilingInProgress()
+
+        seconds = min(max(seconds, 0), settings.MAX_PROFILE_SECONDS)
+        profile = Profiler._active = cProfile.Profile()
+        logger.info(f'Profiling {self._name} for {seconds}s')
+
+        profile.enable()
+
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profile.disable()
+            Profiler._active = None
+
+        path = self._directory / f'{self._name}-{time.strftime("%Y%m%d-%H%M%S")}.prof'
+        await asyncio.get_running_loop().run_in_executor(None, self._dump, profile, path)
+        logger.info(f'Profile of {self._name} dumped to {path}')
+
+        return path
+
+    @staticmethod
+    def _dump(profile: cProfile.Profile, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        profile.dump_stats(path)
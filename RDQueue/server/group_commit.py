@@ -0,0 +1,118 @@
+import asyncio
+import logging
+from typing import List, Set, Tuple
+
+from RDQueue.common.config import settings
+from RDQueue.common.metrics import metrics
+from RDQueue.server.message_queue import QueueManager
+from RDQueue.server.replication import CommandError
+
+logger = logging.getLogger(__file__)
+
+
+class GroupCommitter:
+    """
+    Gathers the pushes made within a short linger window to the queues of one replication group, and replicates
+    them as a single `QueueManager.push_group` command. Each caller gets back the result of its own push.
+    """
+
+    def __init__(self, q_manager: QueueManager, linger: float = settings.GROUP_COMMIT_LINGER,
+                 max_messages: int = settings.GROUP_COMMIT_MAX_MESSAGES, **labels):
+        self._q_manager: QueueManager = q_manager
+        self._linger: float = linger
+        self._max_messages: int = max_messages
+
+        self._pushes: List[Tuple[str, str, List, float]] = list()
+        self._waiters: List[asyncio.Future] = list()
+        self._size: int = 0
+        self._flush_timer: asyncio.TimerHandle | None = None
+        self._commits: Set[asyncio.Task] = set()
+
+        self._group_size = metrics.gauge('group_commit_messages', **labels)
+        self._groups = metrics.counter('group_commits_total', **labels)
+
+    @property
+    def pending(self) -> int:
+        return self._size
+
+    def submit(self, queue_name: str, client_id: str, messages: List, timestamp: float) -> asyncio.Future:
+        """
+        Add messages to push to a queue to the next group, groups being replicated in the order they are gathered.
+        :param queue_name:
+        :param client_id:
+        :param messages:
+        :param timestamp:
+        :return: resolved with the number of messages appended
+        """
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+
+        self._pushes.append((queue_name, client_id, messages, timestamp))
+        self._waiters.append(waiter)
+        self._size += len(messages)
+
+        if self._size >= self._max_messages:
+            self.flush()
+        elif self._flush_timer is None:
+            self._flush_timer = loop.call_later(self._linger, self.flush)
+
+        return waiter
+
+    def flush(self):
+        """
+        Submit the pushes gathered so far for replication without waiting for the linger window to end.
+        :return:
+        """
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+
+        if not self._pushes:
+            return
+
+        pushes, waiters = self._pushes, self._waiters
+        self._pushes, self._waiters, self._size = list(), list(), 0
+
+        self._group_size.set(sum(len(messages) for _, _, messages, _ in pushes))
+        self._groups.inc()
+
+        try:
+            replication = self._q_manager.submit(self._q_manager.push_group, pushes)
+        except Exception as e:
+            _fail(pushes, waiters, e)
+            return
+
+        commit = asyncio.create_task(self._commit(replication, pushes, waiters))
+        self._commits.add(commit)
+        commit.add_done_callback(self._commits.discard)
+
+    async def close(self):
+        self.flush()
+        await asyncio.gather(*self._commits, return_exceptions=True)
+
+    @staticmethod
+    async def _commit(replication: asyncio.Future, pushes: List[Tuple[str, str, List, float]],
+                      waiters: List[asyncio.Future]):
+        try:
+            results = await replication
+        except Exception as e:
+            _fail(pushes, waiters, e)
+            return
+
+        for waiter, result in zip(waiters, results):
+            # the request may have been cancelled in the meantime
+            if waiter.done():
+                continue
+
+            if isinstance(result, CommandError):
+                waiter.set_exception(result.error)
+            else:
+                waiter.set_result(result)
+
+
+def _fail(pushes: List[Tuple[str, str, List, float]], waiters: List[asyncio.Future], error: Exception):
+    logger.error(f'Group of {len(pushes)} pushes failed: {error!r}')
+
+    for waiter in waiters:
+        if not waiter.done():
+            waiter.set_exception(error)
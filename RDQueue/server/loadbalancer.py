@@ -1,26 +1,43 @@
 import asyncio
-import heapq
 import logging
-from typing import Set, List
+import math
+from typing import Callable, Dict, Set
 
-from RDQueue.common.address import Address
+from RDQueue.common.address import Address, address_factory
 from RDQueue.common.config import settings
-from RDQueue.common.decorator import handle_conn_err, periodic_task
+from RDQueue.common.connection import Connection
+from RDQueue.common.exceptions import NoBrokerAvailable
+from RDQueue.common.failure_detector import PhiAccrualDetector
+from RDQueue.common.indexed_heap import IndexedHeap
+from RDQueue.common.logs import setup_logging
 from RDQueue.common.message import message_factory, MessageType, Message, Operation
-from RDQueue.common.networking import send_message_to_writer, receive_message
+from RDQueue.common.metrics import metrics
+from RDQueue.common.networking import FrameWriter, send_message_to_writer, write_message
+from RDQueue.server.base import BaseServer, install_shutdown_handlers
 
 logger = logging.getLogger(__file__)
-logging.basicConfig(level=logging.INFO)
 
 
 class Broker:
-    def __init__(self, connect_address: Address):
+    def __init__(self, connect_address: Address, on_change: Callable[['Broker'], None] | None = None):
+        """
+        :param connect_address:
+        :param on_change: called whenever the load of the broker changes
+        """
         self._connect_address: Address = connect_address
-        self._load = 0
+        self._on_change: Callable[['Broker'], None] | None = on_change
         self._is_alive = False
         self._id = None
+        # the last load reported by the broker, and the clients sent to it since
+        self._report: dict = dict()
+        self._assigned: int = 0
 
-        asyncio.create_task(self._get_broker_info())
+        self._connection: Connection = Connection(connect_address, request_timeout=settings.REPLICATION_TIMEOUT)
+        self._detector: PhiAccrualDetector = PhiAccrualDetector(settings.HEARTBEAT_INTERVAL,
+                                                                settings.FAILURE_DETECTOR_WINDOW,
+                                                                settings.FAILURE_DETECTOR_MIN_STD)
+        self._request: asyncio.Task | None = None
+        self._heartbeat_task: asyncio.Task = asyncio.create_task(self._heartbeat())
 
     @property
     def id(self) -> str | None:
@@ -31,136 +48,229 @@ class Broker:
         return self._connect_address
 
     @property
-    def load(self) -> int:
-        return self._load
+    def is_alive(self) -> bool:
+        return self._is_alive
 
-    def increment_load(self):
-        self._load += 1
+    @property
+    def report(self) -> dict:
+        return self._report
 
     @property
-    def is_alive(self) -> bool:
-        return self._is_alive
+    def load(self) -> float:
+        """
+        The weighted load of the broker, infinite while it is not available.
+        :return:
+        """
+        if not self._is_alive:
+            return math.inf
+
+        return (settings.LOAD_WEIGHT_CONNECTIONS * (self._report.get('connections', 0) + self._assigned)
+                + settings.LOAD_WEIGHT_IN_FLIGHT * self._report.get('in_flight', 0)
+                + settings.LOAD_WEIGHT_QUEUE_DEPTH * self._report.get('queue_depth', 0)
+                + settings.LOAD_WEIGHT_P99 * self._report.get('p99', 0))
 
-    @periodic_task(interval=5)
-    async def _get_broker_info(self):
+    def assign_client(self):
+        # counted until the next report, which includes the connection of the client
+        self._assigned += 1
+        self._changed()
+
+    def release_client(self):
+        if self._assigned > 0:
+            self._assigned -= 1
+            self._changed()
+
+    def stop(self):
+        self._heartbeat_task.cancel()
+
+        if self._request is not None:
+            self._request.cancel()
+
+    async def close(self):
+        self.stop()
+        await self._connection.close()
+
+    def _changed(self):
+        if self._on_change is not None:
+            self._on_change(self)
+
+    async def _heartbeat(self):
         """
-        open a connection with the broker and get its information.
+        Ask the broker for its load every HEARTBEAT_INTERVAL over one long-lived connection. Every answer is a
+        heartbeat, and the broker is suspected to be down as soon as the silence is unusually long for it.
         :return:
         """
+        loop = asyncio.get_running_loop()
+        last_attempt = -math.inf
+
+        while True:
+            now = loop.time()
+
+            try:
+                # a slow answer does not hold back the failure detection,
+                # and a broker that is down is only tried again every HEARTBEAT_RECONNECT_INTERVAL
+                if ((self._request is None or self._request.done())
+                        and (self._is_alive or now - last_attempt >= settings.HEARTBEAT_RECONNECT_INTERVAL)):
+                    last_attempt = now
+                    self._request = asyncio.create_task(self._request_report())
+
+                if self._is_alive and not self._detector.is_available(now, settings.FAILURE_DETECTOR_THRESHOLD):
+                    logger.error(f'Broker {self.connect_address} is suspected to be down '
+                                 f'(phi {self._detector.phi(now):.1f}).')
+                    self._detector.reset()
+                    self._is_alive = False
+                    self._changed()
+            except Exception:
+                # the availability of the broker would be stuck where it is if the heartbeats stopped
+                logger.exception(f'Failed to check the heartbeat of broker {self.connect_address}')
+
+            await asyncio.sleep(settings.HEARTBEAT_INTERVAL)
+
+    async def _request_report(self):
         try:
-            # Enforce a timeout for the connection attempt
-            reader, writer = await asyncio.wait_for(
-                asyncio.open_connection(*self.connect_address.tuple),
-                timeout=1  # Timeout duration in seconds
-            )
-        except asyncio.TimeoutError:
-            self._is_alive = False
-            logger.error(f'Broker {self.connect_address} is not available (connection timed out).')
-            return
-        except Exception as e:
-            self._is_alive = False
-            logger.error(f'Broker {self.connect_address} is not available: {e}.')
+            message = await self._connection.request(message_factory.broker_info_req(
+                sender_addr=settings.LOAD_BALANCER_ADDRESS.connection_str,
+                receiver_addr=self.connect_address.connection_str
+            ))
+        except NoBrokerAvailable:
             return
 
-        await send_message_to_writer(writer, message=message_factory.broker_info_req(
-            sender_addr=settings.LOAD_BALANCER_ADDRESS.connection_str,
-            receiver_addr=self.connect_address.connection_str
-        ))
+        self._detector.heartbeat(asyncio.get_running_loop().time())
+
+        # brokers from before load reports only send their id
+        report = message.body if isinstance(message.body, dict) else {'id': message.body}
 
-        message = await receive_message(reader)
+        self._id = report['id']
+        self._report = report
+        self._assigned = 0
 
         if not self._is_alive:
-            self._id = message.body
-            self._is_alive = True
             logger.info(f'Broker {self.connect_address} is alive and ready to serve clients.')
 
-        writer.close()
-        await writer.wait_closed()
-
-    def inc_load(self):
-        self._load += 1
-
-    def dec_load(self):
-        self._load -= 1
+        self._is_alive = True
+        self._changed()
 
     def __hash__(self):
         return hash(self.connect_address)
 
-    def __lt__(self, other: 'Broker'):
-        return self.is_alive < other.is_alive and self.load < other.load
-
     def __str__(self):
-        return f'{self.connect_address}: #({self.load}) clients'
+        return f'{self.connect_address}: load {self.load:.1f}'
 
     def __repr__(self):
         return str(self)
 
 
-class LoadBalancer:
+class LoadBalancer(BaseServer):
+    """
+    Sends every registering client to the least loaded available broker. The brokers are kept in a heap by load,
+    and a broker whose load changes only moves within the heap. Clients subscribed to the membership are told
+    whenever a broker is suspected to be down or comes back.
+    """
+
     def __init__(self, connection_address: Address, brokers: Set[Address]):
-        self._brokers: List = list()
-        self._connection_address: Address = connection_address
+        metrics_address = None
+
+        if settings.METRICS_PORT_OFFSET:
+            metrics_address = address_factory.from_tuple(connection_address.host_str,
+                                                         connection_address.port + settings.METRICS_PORT_OFFSET)
+
+        super().__init__(connection_address, metrics_address=metrics_address)
+        self._brokers: Dict[Address, Broker] = dict()
+        self._by_load: IndexedHeap[Broker] = IndexedHeap()
         self._leader: Address | None = None
 
+        self._alive: Set[Address] = set()
+        self._alive_gauge = metrics.gauge('brokers_alive', server=connection_address.connection_str)
+        # the connections subscribed to the membership, with the request of their subscription
+        self._subscribers: Dict[FrameWriter, Message] = dict()
+        self._pushes: Set[asyncio.Task] = set()
+
         self.register_brokers(brokers)
-        heapq.heapify(self._brokers)
 
     @property
-    def brokers(self):
+    def brokers(self) -> Dict[Address, Broker]:
         return self._brokers
 
-    @property
-    def connection_address(self):
-        return self._connection_address
-
     def register_brokers(self, brokers: Set[Address]):
-        self._brokers = [Broker(broker_addr) for broker_addr in brokers]
+        for broker_addr in brokers:
+            self.add_broker(broker_addr)
 
     def add_broker(self, broker_addr: Address):
-
-        broker = Broker(broker_addr)
-
-        if broker in self.brokers:
+        if broker_addr in self._brokers:
             return
 
-        self.brokers.append(broker)
-        heapq.heapify(self.brokers)
+        broker = Broker(broker_addr, on_change=self._on_broker_change)
+        self._brokers[broker_addr] = broker
+        self._by_load.push(broker, broker.load)
 
-    def remove_broker(self, broker_addr: Broker):
-        self.brokers.remove(broker_addr)
-        heapq.heapify(self.brokers)
+    async def remove_broker(self, broker_addr: Address):
+        broker = self._brokers.pop(broker_addr, None)
+
+        if broker is not None:
+            self._by_load.remove(broker)
+            await broker.close()
 
     def disconnect_client(self, broker_addr: Address):
-        for broker in self.brokers:
-            if broker.address == broker_addr:
-                broker.dec_load()
-                heapq.heapify(self.brokers)
-                break
+        broker = self._brokers.get(broker_addr)
+
+        if broker is not None:
+            broker.release_client()
 
     def get_next_broker(self) -> Broker | None:
-        min_broker = heapq.heappop(self.brokers)
-        min_broker.inc_load()
-        heapq.heappush(self.brokers, min_broker)
+        broker = self._by_load.peek()
 
-        if not min_broker.is_alive:
-            logger.error(f'Broker {min_broker.connect_address} is not available. Trying the next broker.')
+        if broker is None or not broker.is_alive:
+            logger.error('No broker is available.')
             return None
 
-        return min_broker
-
-    async def start(self):
-        server = await asyncio.start_server(self.handle_client, *self.connection_address.tuple)
-        async with server:
-            await server.serve_forever()
-
-    @handle_conn_err
-    async def handle_client(self, reader, writer):
-        message = await receive_message(reader)
-        await self.handle_message(message, writer)
+        broker.assign_client()
+        return broker
+
+    def _on_broker_change(self, broker: Broker):
+        if broker in self._by_load:
+            self._by_load.update(broker, broker.load)
+
+        if broker.is_alive != (broker.connect_address in self._alive):
+            if broker.is_alive:
+                self._alive.add(broker.connect_address)
+            else:
+                self._alive.discard(broker.connect_address)
+
+            self._alive_gauge.set(len(self._alive))
+            push = asyncio.create_task(self._push_membership())
+            self._pushes.add(push)
+            push.add_done_callback(self._pushes.discard)
+
+    def membership(self) -> dict:
+        return {
+            'alive': sorted(address.connection_str for address in self._alive),
+            'suspected': sorted(address.connection_str for address in self._brokers if address not in self._alive),
+        }
+
+    async def _push_membership(self):
+        membership = self.membership()
+        logger.info(f'Pushing the membership to {len(self._subscribers)} clients: {membership}')
+
+        for writer, request in list(self._subscribers.items()):
+            if writer.is_closing():
+                del self._subscribers[writer]
+                continue
+
+            try:
+                write_message(writer, message_factory.membership_res(
+                    sender_addr=self.connection_address.connection_str,
+                    receiver_addr=request.sender_addr,
+                    _id=request.id,
+                    body=membership
+                ))
+                await writer.flush()
+            except OSError:
+                self._subscribers.pop(writer, None)
+
+    async def on_shutdown(self):
+        await asyncio.gather(*(broker.close() for broker in self._brokers.values()))
 
     async def handle_message(self, message, writer):
-
-        logger.info(f'Received message: {message}')
+        logger.debug('Received message: %s', message, extra={'operation': message.operation.name})
 
         if message.message_type == MessageType.REQUEST:
             await self.handle_request(message, writer)
@@ -171,28 +281,58 @@ class LoadBalancer:
 
             if broker is None:
                 logger.error('No broker is available to handle the client registration request.')
+                await send_message_to_writer(writer, message_factory.error_res(
+                    sender_addr=self.connection_address.connection_str,
+                    receiver_addr=message.sender_addr,
+                    _id=message.id,
+                    operation=Operation.REGISTER_CLIENT,
+                    body=NoBrokerAvailable().message
+                ))
                 return
 
-            logger.info(f'Broker {broker} is selected to handle the client registration request.')
+            logger.debug('Broker %s is selected to handle the client registration request.', broker,
+                         extra={'operation': 'BROKER_INFO'})
 
             await send_message_to_writer(writer, message_factory.register_client_res(
                 sender_addr=self.connection_address.connection_str,
                 receiver_addr=message.sender_addr,
-                body={'id': broker.id, 'address': broker.connect_address.connection_str}
+                _id=message.id,
+                body={'id': broker.id, 'address': broker.connect_address.connection_str, 'brokers': self.membership()}
             ))
 
-            logger.info(f'Broker information sent to client: {broker.connect_address}')
+            logger.debug('Broker information sent to client: %s', broker.connect_address,
+                         extra={'operation': 'BROKER_INFO'})
+
+        elif message.operation == Operation.MEMBERSHIP:
+            # answered now, and again on the same connection whenever the membership changes
+            self._subscribers[writer] = message
+
+            await send_message_to_writer(writer, message_factory.membership_res(
+                sender_addr=self.connection_address.connection_str,
+                receiver_addr=message.sender_addr,
+                _id=message.id,
+                body=self.membership()
+            ))
+
+        elif message.operation == Operation.STATS:
+            await self.handle_stats(message, writer)
+
+        elif message.operation == Operation.PROFILE:
+            await self.handle_profile(message, writer)
 
     async def handle_response(self, message: Message, writer):
         pass
 
 
 async def main():
+    setup_logging()
+
     load_balancer = LoadBalancer(
         connection_address=settings.LOAD_BALANCER_ADDRESS,
         brokers={broker_addr for broker_addr in settings.BROKER_ADDRESSES}
     )
 
+    install_shutdown_handlers(load_balancer)
     await load_balancer.start()
 
 
@@ -1,26 +1,47 @@
+import asyncio
+import itertools
+import operator
 import os
 import pickle
+import time
 import uuid
-from collections import defaultdict
-from typing import Dict, List
-import json
+from pathlib import Path
+from typing import Callable, Dict, List, Set, Tuple
+from urllib.parse import quote, unquote
 
-from pysyncobj import SyncObj, replicated_sync
+import msgpack
+from pysyncobj import replicated
 
-from RDQueue.common.message import Message
+from RDQueue.common.config import settings
+from RDQueue.common.exceptions import QueueNotFound
+from RDQueue.common.metrics import Counter, metrics
+from RDQueue.server.replication import AsyncSyncObj, CommandError, ReplicationHub, returns_errors
+from RDQueue.server.storage import SegmentedLog, write_synced
 import logging
 
 logger = logging.getLogger(__file__)
-logging.basicConfig(level=logging.INFO)
 
 
 class Queue:
-    def __init__(self, name: str, owner: str):
+    def __init__(self, name: str, owner: str, data_dir: Path, partitions: int = 1, owners: List[str] | None = None,
+                 queue_id: str | None = None, replay: bool = False):
         self._owner: str = owner
-        self._id: str = str(uuid.uuid4().hex)
+        self._id: str = queue_id or str(uuid.uuid4().hex)
         self._clients_positions: Dict[str, int] = dict()
+        self._clients_last_seen: Dict[str, float] = dict()
         self._name: str = name
-        self._messages: List[str] = []
+        # partitions of the queue this one belongs to, and the brokers serving it (all of them if empty)
+        self._partitions: int = partitions
+        self._owners: List[str] = owners or list()
+        self._log: SegmentedLog | None = None
+        # first offset of the queue, the log can still hold segments before it, see `release_segments`
+        self._start_offset: int = 0
+        # offset up to which the log has to be fetched from the other replicas, see `missing`
+        self._catch_up_end: int = 0
+        # end of the queue while the commands that appended the records after it are applied again, see `open`
+        self._replay_offset: int | None = None
+
+        self.open(data_dir, replay)
 
     @property
     def name(self) -> str:
@@ -34,31 +55,370 @@ class Queue:
     def id(self) -> str:
         return self._id
 
-    def push(self, message: Message):
-        self._messages.append(message.body['message'])
+    @property
+    def partitions(self) -> int:
+        return self._partitions
+
+    @property
+    def owners(self) -> List[str]:
+        return self._owners
+
+    @property
+    def start_offset(self) -> int:
+        return self._start_offset
+
+    @property
+    def end_offset(self) -> int:
+        return self._log.end_offset if self._replay_offset is None else self._replay_offset
+
+    @property
+    def replaying(self) -> bool:
+        return self._replay_offset is not None
+
+    @property
+    def is_open(self) -> bool:
+        return self._log is not None
+
+    @property
+    def consumers(self) -> int:
+        return len(self._clients_positions)
+
+    @property
+    def missing(self) -> Tuple[int, int] | None:
+        """
+        The records the state the queue was restored from refers to and its log does not hold, which have to be
+        fetched from another replica before any command is applied to the queue.
+        :return: their offsets, None if the log holds them all
+        """
+        if self._log is None or self._log.end_offset >= self._catch_up_end:
+            return None
+
+        return self._log.end_offset, self._catch_up_end
+
+    @property
+    def depth(self) -> int:
+        """
+        Messages the client furthest behind has not consumed yet.
+        :return:
+        """
+        if self._log is None:
+            return 0
+
+        end_offset = self.end_offset
+        return end_offset - min(list(self._clients_positions.values()), default=end_offset)
+
+    def available(self, client_id: str) -> int | None:
+        """
+        Messages the client has not popped yet.
+        :param client_id:
+        :return: None if the client is not known to the queue
+        """
+        position = self._clients_positions.get(client_id)
+
+        if position is None or self._log is None:
+            return None
+
+        return self.end_offset - position
+
+    @staticmethod
+    def log_directory(data_dir: Path, name: str, queue_id: str) -> Path:
+        # a queue never continues the log of an earlier queue with the same name
+        return data_dir / quote(name, safe='') / queue_id
+
+    def open(self, data_dir: Path, replay: bool = False):
+        """
+        Open the on-disk log of the queue and bring it in line with the restored queue state, or the state of a new
+        queue. The records on disk after the end of that state are never dropped: with `replay`, the commands that
+        appended them are applied again from the replication log, and move the end of the queue over them instead
+        of appending them twice, otherwise they are adopted right away.
+        :param data_dir:
+        :param replay: whether the replication log is applied again from the state, e.g. from the journal
+        :return:
+        """
+        if self._log is not None:
+            return
+
+        directory = self.log_directory(data_dir, self._name, self._id)
+        restored = '_end_offset' in self.__dict__
+
+        if restored and not directory.exists():
+            self._adopt_legacy_log(directory)
+
+        log = SegmentedLog(directory)
+        records = self.__dict__.pop('_records', None)
+
+        if restored:
+            start_offset = self.__dict__.get('_start_offset', log.start_offset)
+            end_offset = self.__dict__.pop('_end_offset')
+        else:
+            # a new queue replays the replication log from its creation
+            start_offset, end_offset = (0, 0) if replay else (log.start_offset, log.end_offset)
+
+        if records is not None:
+            # the state was sent by another replica together with its records
+            if (log.start_offset, log.end_offset) != (start_offset, end_offset):
+                log.reset(start_offset)
+                log.append(records, time.time())
+
+        elif log.end_offset < end_offset:
+            if log.end_offset < start_offset:
+                # none of the records on disk is part of the queue anymore
+                log.reset(start_offset)
+
+            self._catch_up_end = end_offset
+
+        elif log.end_offset > end_offset:
+            if replay:
+                logger.info(f"Queue {self._name} replays the records [{end_offset}, {log.end_offset}) on disk")
+                self._replay_offset = end_offset
+            else:
+                logger.warning(f"Queue {self._name} adopts the records [{end_offset}, {log.end_offset}) on disk, "
+                               f"appended after the state it was restored from")
+
+        self._log = log
+        # logs written before segments were released with the snapshots may have deleted records of the state
+        self._start_offset = max(start_offset, log.start_offset)
+        self._clamp_positions()
+
+    @staticmethod
+    def _adopt_legacy_log(directory: Path):
+        # logs written before they were kept per queue id are right in the directory named after the queue
+        legacy_files = [path for path in directory.parent.glob('*') if path.suffix in ('.log', '.index')]
+
+        if legacy_files:
+            directory.mkdir(parents=True)
+
+            for path in legacy_files:
+                path.rename(directory / path.name)
+
+    def read_for_catch_up(self, offset: int, end_offset: int, max_bytes: int) -> List[Tuple[bytes, float]]:
+        """
+        The records from `offset` up to `end_offset`, with their timestamp, for a replica catching up.
+        :param offset:
+        :param end_offset:
+        :param max_bytes:
+        :return: an empty list if the log does not hold the record at `offset`
+        """
+        if offset < self._start_offset:
+            return []
+
+        return self._log.read_timestamped(offset, min(end_offset, self.end_offset) - offset, max_bytes)
+
+    def catch_up(self, records: List[Tuple[bytes, float]]):
+        """
+        Append records fetched from another replica, which follow the last record of the log.
+        :param records: with their timestamp
+        :return:
+        """
+        records = records[:self._catch_up_end - self._log.end_offset]
 
-        if message.sender_id not in self._clients_positions:
-            self._clients_positions[message.sender_id] = 0
+        for timestamp, group in itertools.groupby(records, key=operator.itemgetter(1)):
+            self._log.append([payload for payload, _ in group], timestamp)
 
-    def pop(self, client_id: str) -> str:
+    def skip_missing(self, offset: int):
+        """
+        Continue catching up from `offset`, the records before it being deleted by retention on the other replicas.
+        :param offset:
+        :return:
+        """
+        offset = min(offset, self._catch_up_end)
+        logger.warning(f"Queue {self._name} skips the records [{self._log.end_offset}, {offset}) "
+                       f"deleted by retention on the other replicas")
+        self._log.reset(offset)
+        self._start_offset = offset
+        self._clamp_positions()
+
+    def abandon_catch_up(self):
+        logger.error(f"Queue {self._name} lost the records [{self._log.end_offset}, {self._catch_up_end}) on disk, "
+                     f"no other replica holds them")
+        self._catch_up_end = self._log.end_offset
+
+    def sync(self):
+        self._log.sync()
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def push_many(self, client_id: str, messages: List, timestamp: float):
+        payloads = [msgpack.packb(message) for message in messages]
+
+        if self._replay_offset is not None:
+            payloads = self._skip_replayed(payloads)
+
+        if payloads:
+            self._log.append(payloads, timestamp)
+
+        self._register_client(client_id, timestamp)
+
+    def _skip_replayed(self, payloads: List[bytes]) -> List[bytes]:
+        """
+        Move the end of the queue over the payloads the log already holds, when the push that appended them before
+        a restart is applied again.
+        :param payloads:
+        :return: the payloads to append
+        """
+        on_disk = self._log.read_many(self._replay_offset, len(payloads))
+        replayed = next((i for i, (record, payload) in enumerate(zip(on_disk, payloads)) if record != payload),
+                        len(on_disk))
+        self._replay_offset += replayed
+
+        if replayed < len(on_disk):
+            # no command of the replication log appended the rest of the records, e.g. a leader deposed before they
+            # were committed
+            logger.warning(f"Queue {self._name} drops the records [{self._replay_offset}, {self._log.end_offset}) "
+                           f"on disk, which the replication log does not hold")
+            self._log.truncate(self._replay_offset)
+
+        if self._replay_offset >= self._log.end_offset:
+            logger.info(f"Queue {self._name} replayed the records on disk up to {self._replay_offset}")
+            self._replay_offset = None
+
+        return payloads[replayed:]
+
+    def _register_client(self, client_id: str, timestamp: float):
+        if client_id not in self._clients_positions:
+            self._clients_positions[client_id] = self._start_offset
+
+        self._clients_last_seen[client_id] = timestamp
+
+    def pop(self, client_id: str, timestamp: float | None = None) -> str | None:
         """
         Return the next message for the client.
         It does not remove the message from the queue, but it increments the client's position.
         :param client_id:
-        :return:
+        :return: None if the client has caught up, or has not pushed to the queue yet
         """
         position = self._clients_positions.get(client_id)
 
-        if position is None or position < 0:
-            raise ValueError(f"Client {client_id} not pushed any message in the queue {self._name}")
+        if position is None or position < 0 or position >= self.end_offset:
+            return None
 
-        message = self._messages[position]
+        message = msgpack.unpackb(self._log.read(position))
         self._clients_positions[client_id] += 1
+        self._touch_client(client_id, timestamp)
 
         return message
 
+    def pop_many(self, client_id: str, max_n: int, timestamp: float | None = None) -> List[str]:
+        """
+        Return up to `max_n` of the next messages for the client, an empty list if it has caught up or has not
+        pushed to the queue yet.
+        :param client_id:
+        :param max_n:
+        :return:
+        """
+        position = self._clients_positions.get(client_id)
+
+        if position is None or position < 0:
+            return []
+
+        records = self._log.read_many(position, min(max_n, self.end_offset - position))
+        messages = [msgpack.unpackb(record) for record in records]
+        self._clients_positions[client_id] += len(messages)
+        self._touch_client(client_id, timestamp)
+
+        return messages
+
+    def _touch_client(self, client_id: str, timestamp: float | None):
+        if timestamp is not None:
+            self._clients_last_seen[client_id] = timestamp
+
+    def apply_retention(self, now: float, max_messages: int = 0, max_bytes: int = 0, max_age: float | None = None,
+                        client_ttl: float = 0) -> bool:
+        """
+        Evict clients idle for longer than `client_ttl` and drop the segments every remaining client has
+        consumed or that exceed the retention limits, which are deleted by `release_segments`. Clients left
+        behind by the retention limits continue from the new start of the queue.
+        :return: whether the queue changed
+        """
+        changed = False
+
+        if client_ttl:
+            for client_id, last_seen in list(self._clients_last_seen.items()):
+                if last_seen < now - client_ttl:
+                    logger.info(f"Evicting client {client_id} idle since {last_seen} from queue {self._name}")
+                    self._clients_positions.pop(client_id, None)
+                    del self._clients_last_seen[client_id]
+                    changed = True
+
+        # while replaying, the limits apply to the log as it was when the command was first applied
+        end_offset = self.end_offset
+        consumed = min(self._clients_positions.values(), default=end_offset)
+        expired = self._log.retention_offset(max_messages, max_bytes, max_age, now, self._start_offset, end_offset)
+        start_offset = max(self._log.segment_start(max(consumed, expired), end_offset), self._start_offset)
+
+        if start_offset == self._start_offset:
+            return changed
+
+        self._start_offset = start_offset
+        self._clamp_positions()
+        return True
+
+    def _clamp_positions(self):
+        for client_id, position in self._clients_positions.items():
+            if position < self._start_offset:
+                logger.warning(f"Client {client_id} lost the records [{position}, {self._start_offset}) "
+                               f"of queue {self._name} to retention")
+                self._clients_positions[client_id] = self._start_offset
+
+    def release_segments(self, offset: int):
+        """
+        Delete the segments holding only records before `offset`, at most the start of the queue. The records
+        dropped from a queue stay on disk until every snapshot a replica could restart from starts after them.
+        :param offset:
+        :return:
+        """
+        self._log.delete_before(min(offset, self._start_offset))
+
+    def snapshot_state(self) -> dict:
+        """
+        The state needed to restore the queue. The records themselves stay in the on-disk log.
+        :return:
+        """
+        state = {
+            '_owner': self._owner,
+            '_id': self._id,
+            '_name': self._name,
+            '_partitions': self._partitions,
+            '_owners': list(self._owners),
+            '_clients_positions': dict(self._clients_positions),
+            '_clients_last_seen': dict(self._clients_last_seen),
+            '_start_offset': self._start_offset,
+            # records being caught up are part of the queue already
+            '_end_offset': max(self.end_offset, self._catch_up_end),
+        }
+
+        return state
+
+    @classmethod
+    def from_snapshot_state(cls, state: dict, data_dir: Path, replay: bool = False) -> 'Queue':
+        queue = cls.__new__(cls)
+        queue.__setstate__(state)
+        queue.open(data_dir, replay)
+        return queue
+
+    def __setstate__(self, state: dict):
+        # also restores the queues of snapshots that pickled them whole
+        if '_messages' in state:
+            # snapshots taken before queues were backed by a log
+            messages = state.pop('_messages')
+            state.update(_records=[msgpack.packb(message) for message in messages],
+                         _start_offset=0, _end_offset=len(messages))
+
+        state.setdefault('_clients_last_seen', dict())
+        state.setdefault('_partitions', 1)
+        state.setdefault('_owners', list())
+        self.__dict__.update(state)
+        self._log = None
+        self._catch_up_end = 0
+        self._replay_offset = None
+
     def __str__(self):
-        return str(self._messages)
+        return f'Queue({self._name}, offsets=[{self._start_offset}, {self.end_offset}), ' \
+               f'clients={len(self._clients_positions)})'
+
 
     def __repr__(self):
         return self.__str__()
@@ -67,63 +427,399 @@ class Queue:
         return hash(self.name)
 
 
-class QueueManager(SyncObj):
-    def __init__(self, snapshot_file, self_address, other_addresses):
-        super(QueueManager, self).__init__(self_address, other_addresses)
+class QueueManager(AsyncSyncObj):
+    """
+    The queues replicated by one replication group, in practice the single queue of a partition.
+    """
+
+    def __init__(self, group: str, hub: ReplicationHub, members: List[str], snapshot_dir: Path, data_dir: Path,
+                 queues: Dict[str, dict], preferred_leader: str | None = None,
+                 on_push: Callable[[str], None] | None = None,
+                 on_snapshot: Callable[[str, float, int], None] | None = None):
+        """
+        :param group:
+        :param hub:
+        :param members: replication addresses of the brokers replicating the group
+        :param snapshot_dir:
+        :param data_dir:
+        :param queues: name of every queue of the group and the owner, id, partitions and owners to create it with
+        :param preferred_leader:
+        :param on_push: called from the replication thread with the name of a queue messages were appended to
+        :param on_snapshot: called from the replication thread with the group, duration and size of every snapshot
+        """
+        # attributes set before SyncObj.__init__ are local to this replica and left out of the replicated state
+        self._on_push: Callable[[str], None] | None = on_push
+        self._on_snapshot: Callable[[str, float, int], None] | None = on_snapshot
+        self._snapshot_dir: Path = snapshot_dir
+        self._data_dir: Path = data_dir
+        # messages appended to and popped from every queue, as applied on this replica
+        self._pushed_counters: Dict[str, Counter] = dict()
+        self._popped_counters: Dict[str, Counter] = dict()
+        # the records being fetched as (queue name, offset, replica asked, when) with the replicas that could not
+        # provide them
+        self._catch_up_request: Tuple[str, int, str, float] | None = None
+        self._catch_up_tried: Set[str] = set()
+        # index of the last command applied to the state of the latest snapshot, and to the one the queues were
+        # restored from when the group started, which pysyncobj loads again on the first tick
+        self._snapshot_index: int = 0
+        self._restored_index: int | None = None
+        # start offset of every queue in the latest snapshot, the segments before it are deleted by the next one
+        self._snapshot_starts: Dict[str, int] = dict()
+        dump_file = snapshot_dir / f'{quote(group, safe="")}.dump'
+        journal_file = snapshot_dir / f'{quote(group, safe="")}.journal'
+        # the commands applied after the state the queues are restored from are applied again from the journal
+        replay = journal_file.exists()
+        os.makedirs(snapshot_dir, exist_ok=True)
+        os.makedirs(data_dir, exist_ok=True)
+        super(QueueManager, self).__init__(group, hub, members, preferred_leader, dump_file=dump_file,
+                                           journal_file=journal_file)
         self._queues: Dict[str, Queue] = {}
-        self._snapshot_file = snapshot_file
-        os.makedirs(snapshot_file.parent, exist_ok=True)
-        self.restore_from_snapshot()
-
-    def create_snapshot(self):
-        logger.info(f"Creating snapshot at {self._snapshot_file}")
-        with open(self._snapshot_file, 'wb+') as f:
-            pickle.dump(self._queues, f)
-
-    def restore_from_snapshot(self):
-        if os.path.exists(self._snapshot_file):
-            logger.info(f"Restoring snapshot from {self._snapshot_file}")
-            self._queues = pickle.load(open(self._snapshot_file, 'rb'))
-            logger.info(f"Restored queues: {self._queues}")
+
+        if dump_file.exists():
+            self._restored_index = self._snapshot_index = self._restore_dump(dump_file, replay)
         else:
-            logger.info(f"Snapshot file {self._snapshot_file} does not exist")
+            self.restore_from_snapshot(list(queues), replay)
+
+        # every replica creates the queues of a new group the same way, without a replicated command
+        for name, info in queues.items():
+            if name not in self._queues:
+                self._queues[name] = Queue(name, info['owner'], data_dir, info['partitions'], info['owners'],
+                                           queue_id=info['id'], replay=replay)
+
+    def available(self, queue_name: str, client_id: str) -> int | None:
+        """
+        Messages of a queue the client has not popped yet, as applied on this replica.
+        :param queue_name:
+        :param client_id:
+        :return: None if the queue or the client is not known here yet
+        """
+        queue = self._queues.get(queue_name)
+        return None if queue is None else queue.available(client_id)
+
+    def _pushed(self, queue_name: str, count: int = 1):
+        self._counter(self._pushed_counters, 'queue_messages_pushed_total', queue_name).inc(count)
+
+        if self._on_push is not None:
+            self._on_push(queue_name)
+
+    def _popped(self, queue_name: str, count: int):
+        self._counter(self._popped_counters, 'queue_messages_popped_total', queue_name).inc(count)
+
+    def _counter(self, counters: Dict[str, Counter], name: str, queue_name: str) -> Counter:
+        counter = counters.get(queue_name)
+
+        if counter is None:
+            counter = counters[queue_name] = metrics.counter(name, queue=queue_name, replica=self._hub.address)
+
+        return counter
+
+    def depth(self) -> int:
+        """
+        Messages not consumed yet in the queues of the group.
+        :return:
+        """
+        return sum(queue.depth for queue in list(self._queues.values()))
+
+    def queue_stats(self) -> Dict[str, dict]:
+        """
+        The messages stored by every queue of the group, its consumers, and the messages the consumer furthest
+        behind has not popped yet.
+        :return:
+        """
+        return {
+            name: {
+                'messages': queue.end_offset - queue.start_offset if queue.is_open else 0,
+                'consumers': queue.consumers,
+                'consumer_lag_max': queue.depth,
+            }
+            for name, queue in list(self._queues.items())
+        }
+
+    def _snapshot_path(self, name: str) -> Path:
+        return self._snapshot_dir / f'{quote(name, safe="")}.pickle'
+
+    def write_dump(self, path: Path, raft_state):
+        """
+        Snapshot the queues of the group as of the last command applied, which the replication log is compacted up
+        to. pysyncobj calls it from the replication thread, which owns the logs, so the state matches that command
+        and the records it refers to are synced without racing appends. It only copies queue metadata, the records
+        stay in the logs.
+        :param path:
+        :param raft_state:
+        :return:
+        """
+        started = time.perf_counter()
+        states = {}
+
+        for name, queue in self._queues.items():
+            # the snapshot must not get ahead of the records that are on disk
+            queue.sync()
+            # until this snapshot replaces the latest one, a restart still replays the queue from it
+            queue.release_segments(self._snapshot_starts.get(name, 0))
+            states[name] = queue.snapshot_state()
+
+        size = write_synced(path, pickle.dumps({'queues': states, 'raft': raft_state}))
+        self._snapshot_index = _applied_index(raft_state)
+        self._snapshot_starts = {name: state['_start_offset'] for name, state in states.items()}
+
+        if self._on_snapshot is not None:
+            self._on_snapshot(self.group, time.perf_counter() - started, size)
+
+    def read_dump(self, path: Path):
+        dump = pickle.loads(path.read_bytes())
+
+        # the snapshot the group started from is loaded again on its first tick, others are received from the leader
+        if _applied_index(dump['raft']) != self._restored_index:
+            # the leader applies the commands after the snapshot to this replica as well
+            self._restore_queues(dump['queues'], replay=True)
+
+        self._restored_index = None
+        self._snapshot_index = _applied_index(dump['raft'])
+        return dump['raft']
+
+    def _restore_dump(self, path: Path, replay: bool) -> int:
+        dump = pickle.loads(path.read_bytes())
+        self._restore_queues(dump['queues'], replay)
+        logger.info(f"Restored queues of {self.group} from {path}: {self._queues}")
+        return _applied_index(dump['raft'])
+
+    def _restore_queues(self, states: Dict[str, dict], replay: bool):
+        # the queues replaced still have the same files open
+        for queue in self._queues.values():
+            queue.close()
+
+        self._queues = {name: self._restore_queue(state, replay) for name, state in states.items()}
+        self._snapshot_starts = {name: state['_start_offset'] for name, state in states.items()}
+
+    async def snapshot(self, timeout: float = settings.REPLICATION_TIMEOUT) -> bool:
+        """
+        Snapshot the group at its next tick, unless no command was applied since its last snapshot, and wait for
+        it, e.g. before the broker stops.
+        :param timeout:
+        :return: whether the snapshot is up to date
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        self.forceLogCompaction()
+        self._hub.wakeup()
+
+        # pysyncobj never compacts the no-op the log starts with
+        while self.raftLastApplied > max(self._snapshot_index, 1):
+            if loop.time() >= deadline:
+                return False
+
+            await asyncio.sleep(settings.REPLICATION_TICK_PERIOD)
+
+        return True
+
+    def destroy(self):
+        super().destroy()
+
+        for queue in self._queues.values():
+            queue.sync()
+            queue.close()
+
+    def restore_from_snapshot(self, names: List[str], replay: bool = False):
+        legacy_file = self._snapshot_dir.parent / f'{self._snapshot_dir.name}.pickle'
+        restored = False
+
+        for name in names:
+            path = self._snapshot_path(name)
+
+            if path.exists():
+                self._queues[name] = self._restore_queue(pickle.loads(path.read_bytes()), replay)
+                restored = True
+
+        if not restored and legacy_file.exists():
+            logger.info(f"Restoring snapshot from {legacy_file}")
+            states = pickle.loads(legacy_file.read_bytes())
+
+            for name in names:
+                if name in states:
+                    self._queues[name] = self._restore_queue(states[name], replay)
+
+        if self._queues:
+            logger.info(f"Restored queues of {self.group}: {self._queues}")
 
     @staticmethod
-    def _snapshot_decorator(func):
-        def wrapper(self, *args, **kwargs):
-            ret = func(self, *args, **kwargs)
-            self.create_snapshot()
-            return ret
+    def snapshot_queue_names(snapshot_dir: Path) -> List[str]:
+        """
+        Names of the queues with a snapshot in `snapshot_dir`, including the legacy single file snapshot.
+        :param snapshot_dir:
+        :return:
+        """
+        names = [unquote(path.name[:-len('.pickle')]) for path in snapshot_dir.glob('*.pickle')]
+        legacy_file = snapshot_dir.parent / f'{snapshot_dir.name}.pickle'
 
-        return wrapper
+        if not names and legacy_file.exists():
+            names = list(pickle.loads(legacy_file.read_bytes()))
 
-    @replicated_sync
-    def create_queue(self, name: str, owner: str):
+        return names
 
-        if name in self._queues:
-            return self._queues[name]
+    def _restore_queue(self, state: dict | Queue, replay: bool = False) -> Queue:
+        if isinstance(state, Queue):
+            state.open(self._data_dir, replay)
+            return state
 
-        queue = Queue(name, owner)
-        self._queues[name] = queue
+        return Queue.from_snapshot_state(state, self._data_dir, replay)
+
+    def _get_queue(self, name: str) -> Queue:
+        queue = self._queues.get(name)
+
+        if queue is None:
+            raise QueueNotFound(name)
 
         return queue
 
-    @replicated_sync
-    def push(self, message: Message):
-        queue_name = message.body['queue_name']
-        queue = self._queues[queue_name]
-        queue.push(message)
+    def ready_to_apply(self) -> bool:
+        behind = next((queue for queue in self._queues.values() if queue.missing is not None), None)
+
+        if behind is None:
+            return True
+
+        self._request_missing(behind)
+        return False
+
+    def _request_missing(self, queue: Queue):
+        """
+        Ask another replica for the next chunk of the records missing from a queue, unless a request is pending.
+        A replica that does not answer in time or does not hold the records is not asked again for them, the
+        records are given up on once every connected replica was asked.
+        :param queue:
+        :return:
+        """
+        offset, end_offset = queue.missing
+        now = time.monotonic()
+
+        if self._catch_up_request is not None:
+            name, requested, peer, sent = self._catch_up_request
+
+            if (name, requested) == (queue.name, offset):
+                if now - sent < settings.REPLICATION_CONNECTION_TIMEOUT:
+                    return
+
+                self._catch_up_tried.add(peer)
+
+            self._catch_up_request = None
+
+        leader = self.leader
+        peers = sorted(self._members, key=lambda member: (member != leader, member))
+
+        for peer in peers:
+            if peer not in self._catch_up_tried and self.send_catch_up(peer, ('fetch', queue.name, offset, end_offset)):
+                self._catch_up_request = (queue.name, offset, peer, now)
+                return
+
+        connected = {peer for peer in peers if self._hub.is_connected(peer)}
+
+        if connected and self._catch_up_tried >= connected:
+            queue.abandon_catch_up()
+            self._catch_up_tried.clear()
 
-    @replicated_sync
-    def pop(self, message: Message) -> str:
-        queue_name = message.body
-        client_id = message.sender_id
-        queue = self._queues[queue_name]
-        return queue.pop(client_id)
+    def on_catch_up(self, peer: str, message):
+        kind, name, offset, *content = message
+        queue = self._queues.get(name)
+
+        if kind == 'fetch':
+            end_offset, = content
+            records, start_offset = [], 0
+
+            if queue is not None:
+                records = queue.read_for_catch_up(offset, end_offset, settings.REPLICATION_CATCH_UP_BYTES)
+                start_offset = queue.start_offset
+
+            self.send_catch_up(peer, ('records', name, offset, records, start_offset))
+            return
+
+        records, start_offset = content
+
+        if queue is None or self._catch_up_request is None or self._catch_up_request[:3] != (name, offset, peer) or \
+                queue.missing is None or queue.missing[0] != offset:
+            # the answer to a request given up on
+            return
+
+        self._catch_up_request = None
+
+        if records:
+            queue.catch_up(records)
+            self._catch_up_tried.clear()
+        elif start_offset > offset:
+            queue.skip_missing(start_offset)
+            self._catch_up_tried.clear()
+        else:
+            self._catch_up_tried.add(peer)
+
+    @replicated
+    @returns_errors
+    def pop(self, queue_name: str, client_id: str, timestamp: float) -> str | None:
+        queue = self._get_queue(queue_name)
+        message = queue.pop(client_id, timestamp)
+
+        if message is not None:
+            self._popped(queue_name, 1)
+
+        return message
+
+    @replicated
+    @returns_errors
+    def push_group(self, pushes: List[Tuple[str, str, List, float]]) -> List[int | CommandError]:
+        """
+        Apply a group of pushes to possibly different queues as a single replicated command.
+        A push that fails does not prevent the others in the group from being applied.
+        :param pushes: (queue name, client id, messages, timestamp) of every push
+        :return: the number of messages appended, or the error, for every push
+        """
+        results = []
+
+        for queue_name, client_id, messages, timestamp in pushes:
+            try:
+                queue = self._get_queue(queue_name)
+                queue.push_many(client_id, messages, timestamp)
+            except Exception as e:
+                results.append(CommandError(e))
+                continue
+
+            self._pushed(queue_name, len(messages))
+            results.append(len(messages))
+
+        return results
+
+    @replicated
+    @returns_errors
+    def pop_batch(self, queue_name: str, client_id: str, max_n: int, timestamp: float) -> List[str]:
+        queue = self._get_queue(queue_name)
+        messages = queue.pop_many(client_id, max_n, timestamp)
+        self._popped(queue_name, len(messages))
+        return messages
+
+    @replicated
+    @returns_errors
+    def apply_retention(self, now: float):
+        """
+        Trim every queue according to the retention settings. It is replicated, with `now` chosen by the caller,
+        so that every replica evicts the same clients and keeps the same offsets.
+        :param now:
+        :return:
+        """
+        for name in list(self._queues):
+            queue = self._get_queue(name)
+
+            queue.apply_retention(
+                now,
+                max_messages=settings.RETENTION_MAX_MESSAGES,
+                max_bytes=settings.RETENTION_MAX_BYTES,
+                max_age=settings.RETENTION_MAX_AGE,
+                client_ttl=settings.RETENTION_CLIENT_TTL
+            )
 
     def print_queues_messages(self, address: str = None):
         for queue in self._queues.values():
             print(f"Queue {queue.name} -> {address}: {queue}")
 
     def snap(self):
-        self.create_snapshot()
+        self.forceLogCompaction()
+
+
+def _applied_index(raft_state) -> int:
+    # the state pysyncobj dumps starts with the last command applied, as (command, index, term)
+    return raft_state[0][1]
@@ -0,0 +1,53 @@
+import asyncio
+import logging
+
+from RDQueue.common.address import Address
+from RDQueue.common.metrics import metrics
+
+logger = logging.getLogger(__file__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class MetricsEndpoint:
+    """
+    Serves the metrics of the process as Prometheus text to any HTTP GET, one request per connection.
+    """
+
+    def __init__(self, address: Address):
+        self._address: Address = address
+        self._server: asyncio.Server | None = None
+
+    @property
+    def address(self) -> Address:
+        return self._address
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, *self._address.tuple)
+        logger.info(f'Serving metrics at http://{self._address}/metrics')
+
+    def stop(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+
+            # the headers are not needed
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b'\r\n', b'\n', b''):
+                pass
+
+            if request_line.split(b' ')[0] == b'GET':
+                status, content_type, body = '200 OK', CONTENT_TYPE, metrics.to_prometheus().encode()
+            else:
+                status, content_type, body = '405 Method Not Allowed', 'text/plain', b''
+
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n'
+                         f'Connection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, OSError) as e:
+            logger.debug(f'Metrics request failed: {e!r}')
+        finally:
+            writer.close()
@@ -0,0 +1,568 @@
+import asyncio
+import functools
+import inspect
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Set
+
+from pysyncobj import FAIL_REASON, SyncObj, SyncObjConf
+from pysyncobj.monotonic import monotonic
+from pysyncobj.node import TCPNode
+from pysyncobj.pipe_notifier import PipeNotifier
+from pysyncobj.poller import createPoller
+from pysyncobj.tcp_connection import TcpConnection
+from pysyncobj.tcp_server import TcpServer
+from pysyncobj.transport import Transport
+from pysyncobj.version import VERSION as PYSYNCOBJ_VERSION
+
+from RDQueue.common.config import settings
+from RDQueue.common.exceptions import IncompatibleDependency, NoLeaderAvailable, ReplicationFailed, \
+    ReplicationTimeout
+from RDQueue.common.metrics import metrics
+
+logger = logging.getLogger(__file__)
+
+_LEADER_FAILURES = {FAIL_REASON.MISSING_LEADER, FAIL_REASON.NOT_LEADER, FAIL_REASON.LEADER_CHANGED}
+
+# tags the messages a group sends outside of raft, see AsyncSyncObj.send_catch_up
+CATCH_UP = 'catch_up'
+
+# the methods of pysyncobj used besides its public API: the hooks of a custom transport and the raft state of a node
+_PYSYNCOBJ_METHODS = {
+    SyncObj: ('_getLeader', '_isLeader', 'getStatus', 'transferLeadership', 'doTick'),
+    Transport: ('_onNodeConnected', '_onNodeDisconnected', '_onMessageReceived'),
+}
+
+
+def check_pysyncobj():
+    """
+    Fail right away on a version of pysyncobj that does not have the methods the replication relies on, rather than
+    once a group uses them.
+    :return:
+    """
+    missing = [f'{cls.__name__}.{name}' for cls, names in _PYSYNCOBJ_METHODS.items() for name in names
+               if not callable(getattr(cls, name, None))]
+
+    if 'transport' not in inspect.signature(SyncObj.__init__).parameters:
+        missing.append('the transport argument of SyncObj')
+
+    if missing:
+        raise IncompatibleDependency('pysyncobj', PYSYNCOBJ_VERSION, missing)
+
+
+class CommandError:
+    """
+    An exception raised while applying a replicated command, returned as its result instead of raised.
+    """
+
+    def __init__(self, error: Exception):
+        self.error: Exception = error
+
+
+def returns_errors(func):
+    """
+    Return the exceptions raised by a replicated command as a `CommandError` result. pysyncobj retries a log
+    entry whose command raised forever, which would stall every replica. Put it below `@replicated`.
+    :param func:
+    :return:
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            return CommandError(e)
+
+    return wrapper
+
+
+class ReplicationHub:
+    """
+    Hosts every replication group of a broker on a single port and a single thread. The groups share one
+    connection to each other broker, their messages are tagged with the name of the group they belong to.
+    The hub also moves the leadership of a group to its preferred leader, to spread the leaders over the brokers.
+    """
+
+    def __init__(self, address: str, peers: List[str], tick_period: float = settings.REPLICATION_TICK_PERIOD,
+                 rebalance_interval: float = settings.LEADER_REBALANCE_INTERVAL):
+        check_pysyncobj()
+
+        self._address: str = address
+        self._peers: Set[str] = set(peers) - {address}
+        self._tick_period: float = tick_period
+        self._rebalance_interval: float = rebalance_interval
+
+        self._poller = createPoller('auto')
+        self._notifier: PipeNotifier = PipeNotifier(self._poller)
+        host, port = address.rsplit(':', 1)
+        self._server: TcpServer = TcpServer(self._poller, host, port, onNewConnection=self._on_incoming_connection)
+
+        # only touched by the hub thread
+        self._connections: Dict[str, TcpConnection] = dict()
+        self._connected: Set[str] = set()
+        self._last_connect_attempt: Dict[str, float] = dict()
+        self._next_rebalance: float = monotonic() + rebalance_interval
+
+        self._lock: threading.Lock = threading.Lock()
+        self._groups: Dict[str, 'AsyncSyncObj'] = dict()
+        self._added: List['AsyncSyncObj'] = list()
+        self._removed: List['AsyncSyncObj'] = list()
+
+        self._stopping: threading.Event = threading.Event()
+        self._thread: threading.Thread = threading.Thread(target=self._run, name=f'replication-{address}', daemon=True)
+
+    @property
+    def address(self) -> str:
+        return self._address
+
+    @property
+    def groups(self) -> Dict[str, 'AsyncSyncObj']:
+        return self._groups
+
+    def start(self):
+        self._server.bind()
+        self._thread.start()
+        logger.info(f'Replication hub listening at {self._address}')
+
+    def stop(self):
+        self._stopping.set()
+        self.wakeup()
+        self._thread.join()
+
+        for group in list(self._groups.values()):
+            group.destroy()
+
+        for connection in list(self._connections.values()):
+            connection.disconnect()
+
+        self._server.unbind()
+
+    def wakeup(self):
+        """
+        Make the hub thread run a tick now, e.g. to send a command that was just submitted.
+        :return:
+        """
+        try:
+            self._notifier.notify()
+        except BlockingIOError:
+            # the pipe is full, a wakeup is pending anyway
+            pass
+
+    def add_group(self, group: 'AsyncSyncObj'):
+        with self._lock:
+            self._added.append(group)
+
+        self.wakeup()
+
+    def remove_group(self, group: 'AsyncSyncObj'):
+        with self._lock:
+            self._removed.append(group)
+
+        self.wakeup()
+
+    def is_connected(self, peer: str) -> bool:
+        return peer in self._connected
+
+    def send(self, peer: str, group: str, message, catch_up: bool = False) -> bool:
+        connection = self._connections.get(peer)
+
+        if connection is None or peer not in self._connected:
+            return False
+
+        connection.send((group, CATCH_UP, message) if catch_up else (group, message))
+        return True
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                self._apply_group_changes()
+                self._connect_if_necessary()
+                self._poller.poll(self._tick_period)
+
+                for group in list(self._groups.values()):
+                    if group.ready_to_apply():
+                        group.doTick(0)
+
+                self._maybe_rebalance()
+            except Exception:
+                logger.exception('Replication hub tick failed')
+                time.sleep(self._tick_period)
+
+    def _apply_group_changes(self):
+        with self._lock:
+            added, self._added = self._added, list()
+            removed, self._removed = self._removed, list()
+
+        for group in added:
+            self._groups[group.group] = group
+
+            for peer in group.members & self._connected:
+                group.transport.on_peer_connected(peer)
+
+        for group in removed:
+            if self._groups.get(group.group) is group:
+                del self._groups[group.group]
+
+    def _connect_if_necessary(self):
+        now = monotonic()
+
+        for peer in self._peers:
+            # of every pair of brokers, the one with the lower address connects
+            if peer < self._address or peer in self._connections:
+                continue
+
+            if now - self._last_connect_attempt.get(peer, 0) < settings.REPLICATION_RECONNECT_INTERVAL:
+                continue
+
+            self._last_connect_attempt[peer] = now
+            connection = TcpConnection(self._poller, timeout=settings.REPLICATION_CONNECTION_TIMEOUT)
+            connection.setOnConnectedCallback(functools.partial(self._on_outgoing_connected, peer, connection))
+            connection.setOnMessageReceivedCallback(functools.partial(self._on_message, peer))
+            connection.setOnDisconnectedCallback(functools.partial(self._on_disconnected, peer, connection))
+
+            host, port = peer.rsplit(':', 1)
+            if connection.connect(host, int(port)):
+                self._connections[peer] = connection
+
+    def _on_outgoing_connected(self, peer: str, connection: TcpConnection):
+        # the first message tells the other broker who is connecting
+        connection.send(self._address)
+        self._on_peer_connected(peer)
+
+    def _on_incoming_connection(self, connection: TcpConnection):
+        connection.setOnMessageReceivedCallback(functools.partial(self._on_handshake, connection))
+        connection.setOnDisconnectedCallback(lambda: None)
+
+    def _on_handshake(self, connection: TcpConnection, peer):
+        if peer not in self._peers:
+            logger.warning(f'Dropping replication connection from unknown broker {peer!r}')
+            connection.disconnect()
+            return
+
+        previous = self._connections.get(peer)
+        if previous is not None and previous is not connection:
+            previous.disconnect()
+
+        self._connections[peer] = connection
+        connection.setOnMessageReceivedCallback(functools.partial(self._on_message, peer))
+        connection.setOnDisconnectedCallback(functools.partial(self._on_disconnected, peer, connection))
+        self._on_peer_connected(peer)
+
+    def _on_peer_connected(self, peer: str):
+        logger.info(f'Replication hub {self._address} connected to {peer}')
+        self._connected.add(peer)
+
+        for group in self._groups.values():
+            if peer in group.members:
+                group.transport.on_peer_connected(peer)
+
+    def _on_disconnected(self, peer: str, connection: TcpConnection):
+        if self._connections.get(peer) is not connection:
+            return
+
+        del self._connections[peer]
+
+        if peer not in self._connected:
+            return
+
+        logger.info(f'Replication hub {self._address} disconnected from {peer}')
+        self._connected.discard(peer)
+
+        for group in self._groups.values():
+            if peer in group.members:
+                group.transport.on_peer_disconnected(peer)
+
+    def _on_message(self, peer: str, message):
+        group = self._groups.get(message[0])
+
+        # a group that is not started here yet, raft sends the message again
+        if group is None or peer not in group.members:
+            return
+
+        if len(message) == 3:
+            group.on_catch_up(peer, message[2])
+        else:
+            group.transport.on_message(peer, message[1])
+
+    def _maybe_rebalance(self):
+        now = monotonic()
+
+        if now < self._next_rebalance:
+            return
+
+        self._next_rebalance = now + self._rebalance_interval
+
+        for group in self._groups.values():
+            preferred = group.preferred_leader
+
+            if preferred is None or preferred == self._address or preferred not in self._connected:
+                continue
+
+            if group.is_leader:
+                logger.info(f'Moving the leadership of {group.group} to {preferred}')
+                group.transferLeadership(preferred)
+
+
+class HubTransport(Transport):
+    """
+    The pysyncobj transport of one replication group, sending and receiving through the hub of its broker.
+    """
+
+    def __init__(self, syncObj: 'AsyncSyncObj', selfNode, otherNodes):
+        super().__init__(syncObj, selfNode, otherNodes)
+        self._hub: ReplicationHub = syncObj.hub
+        self._group: str = syncObj.group
+        self._nodes: Dict[str, TCPNode] = {node.address: node for node in otherNodes}
+
+    def on_peer_connected(self, peer: str):
+        self._onNodeConnected(self._nodes[peer])
+
+    def on_peer_disconnected(self, peer: str):
+        self._onNodeDisconnected(self._nodes[peer])
+
+    def on_message(self, peer: str, message):
+        self._onMessageReceived(self._nodes[peer], message)
+
+    def addNode(self, node):
+        self._nodes[node.address] = node
+
+    def dropNode(self, node):
+        self._nodes.pop(node.address, None)
+
+    def send(self, node, message) -> bool:
+        return self._hub.send(node.address, self._group, message)
+
+
+class AsyncSyncObj(SyncObj):
+    """
+    A SyncObj replicated by one group of brokers through their `ReplicationHub`, whose replicated commands
+    can be awaited from an asyncio event loop without blocking it.
+    """
+
+    def __init__(self, group: str, hub: ReplicationHub, members: List[str], preferred_leader: str | None = None,
+                 dump_file: Path | None = None, journal_file: Path | None = None):
+        # attributes set before SyncObj.__init__ are local to this replica and left out of the replicated state
+        self._group: str = group
+        self._hub: ReplicationHub = hub
+        self._members: Set[str] = set(members) - {hub.address}
+        self._preferred_leader: str | None = preferred_leader
+        self._commit_latency = metrics.histogram('replication_commit_seconds', group=group, replica=hub.address)
+        self._transport: HubTransport = HubTransport(self, TCPNode(hub.address),
+                                                     [TCPNode(member) for member in self._members])
+
+        options = dict(autoTick=False, appendEntriesPeriod=settings.REPLICATION_APPEND_ENTRIES_PERIOD)
+
+        if dump_file is not None:
+            # the replication log is compacted into a file written by `write_dump`, rather than into a pickle of the
+            # object kept in memory, and the file is what a replica too far behind receives from the leader
+            options.update(fullDumpFile=str(dump_file), serializer=self._serialize, deserializer=self._deserialize,
+                           logCompactionMinTime=settings.SNAPSHOT_INTERVAL)
+
+        if journal_file is not None:
+            # the commands applied since the last dump are kept on disk and applied again on a restart
+            options.update(journalFile=str(journal_file))
+
+        super().__init__(hub.address, list(self._members), conf=SyncObjConf(**options), transport=self._transport)
+
+    @property
+    def group(self) -> str:
+        return self._group
+
+    @property
+    def hub(self) -> ReplicationHub:
+        return self._hub
+
+    @property
+    def members(self) -> Set[str]:
+        return self._members
+
+    @property
+    def preferred_leader(self) -> str | None:
+        return self._preferred_leader
+
+    @property
+    def transport(self) -> HubTransport:
+        return self._transport
+
+    @property
+    def is_leader(self) -> bool:
+        return self._isLeader()
+
+    @property
+    def leader(self) -> str | None:
+        """
+        :return: the replication address of the last known leader of the group, None while there is none
+        """
+        leader = self._getLeader()
+        return None if leader is None else leader.address
+
+    def replication_lag(self) -> int:
+        """
+        Log entries this replica is behind by: on the leader, the committed ones the slowest follower has not
+        acknowledged, on a follower, the ones committed by the leader and not applied here yet. Read from outside
+        of the replication thread, it is an estimate.
+        :return:
+        """
+        status = self.getStatus()
+
+        if self.is_leader:
+            matched = [index for key, index in status.items() if key.startswith('match_idx_server_')]
+            return max((status['commit_idx'] - index for index in matched), default=0)
+
+        return max((status['leader_commit_idx'] or 0) - status['last_applied'], 0)
+
+    def ready_to_apply(self) -> bool:
+        """
+        Called by the replication thread before every tick of the group, which is skipped if it returns False:
+        the replica then neither applies committed commands nor stands for election, e.g. while it fetches what
+        the state it was restored from refers to. Messages from the other replicas are still answered.
+        :return:
+        """
+        return True
+
+    def send_catch_up(self, peer: str, message) -> bool:
+        """
+        Send a message to the same group on another broker outside of raft, which `on_catch_up` receives there.
+        :param peer:
+        :param message:
+        :return: whether the broker is connected
+        """
+        return self._hub.send(peer, self._group, message, catch_up=True)
+
+    def on_catch_up(self, peer: str, message):
+        """
+        Called from the replication thread with a message sent by `send_catch_up`.
+        :param peer:
+        :param message:
+        :return:
+        """
+
+    def write_dump(self, path: Path, raft_state):
+        """
+        Called from the replication thread, between two commands, to write the state of the object to `path`
+        together with `raft_state`, the pysyncobj state the replication log is compacted up to. Only used by a group
+        with a dump file.
+        :param path:
+        :param raft_state:
+        :return:
+        """
+        raise NotImplementedError
+
+    def read_dump(self, path: Path):
+        """
+        Called from the replication thread to restore the state of the object from a file written by `write_dump`,
+        by this replica before it restarted or by the leader.
+        :param path:
+        :return: the `raft_state` written with it
+        """
+        raise NotImplementedError
+
+    def _serialize(self, file_name: str, raft_state):
+        try:
+            self.write_dump(Path(file_name), raft_state)
+        except Exception:
+            # pysyncobj only warns that the dump failed, and compacts the log again later
+            logger.exception(f'Dump of {self._group} failed')
+            raise
+
+    def _deserialize(self, file_name: str):
+        return self.read_dump(Path(file_name))
+
+    def start(self):
+        """
+        Start taking part in the replication of the group, once the object is fully initialised.
+        :return:
+        """
+        self._hub.add_group(self)
+
+    def stop(self):
+        self._hub.remove_group(self)
+
+    async def wait_for_leader(self, timeout: float = settings.REPLICATION_TIMEOUT) -> bool:
+        """
+        Wait until the group has elected a leader, e.g. right after it was started.
+        :param timeout:
+        :return: whether the group has a leader
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+
+        while self.leader is None:
+            if loop.time() >= deadline:
+                return False
+
+            await asyncio.sleep(settings.REPLICATION_TICK_PERIOD)
+
+        return True
+
+    def submit(self, method: Callable, *args, timeout: float = settings.REPLICATION_TIMEOUT, **kwargs) -> asyncio.Future:
+        """
+        Submit a `@replicated` method of this object right away, commands being replicated in the order they are
+        submitted, and return the future of its result.
+        :param method:
+        :param args:
+        :param timeout:
+        :param kwargs:
+        :return: resolved with the result of the command on this replica once it is committed and applied locally
+        """
+        if self.leader is None:
+            raise NoLeaderAvailable()
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        started = time.perf_counter()
+
+        def on_result(result, error):
+            # called from the replication thread
+            loop.call_soon_threadsafe(_resolve, future, result, error)
+
+        def on_done(_):
+            expiry.cancel()
+
+            if not future.cancelled() and future.exception() is None:
+                self._commit_latency.observe(time.perf_counter() - started)
+
+        expiry = loop.call_later(timeout, _expire, future, timeout)
+        future.add_done_callback(on_done)
+
+        try:
+            method(*args, callback=on_result, **kwargs)
+        except BaseException:
+            future.cancel()
+            raise
+
+        self._hub.wakeup()
+        return future
+
+    async def replicate(self, method: Callable, *args, timeout: float = settings.REPLICATION_TIMEOUT, **kwargs) -> Any:
+        """
+        Submit a `@replicated` method of this object and wait for it to be committed and applied locally.
+        :param method:
+        :param args:
+        :param timeout:
+        :param kwargs:
+        :return: the result of the command on this replica
+        """
+        return await self.submit(method, *args, timeout=timeout, **kwargs)
+
+
+def _resolve(future: asyncio.Future, result, error: int):
+    if future.done():
+        return
+
+    if error in _LEADER_FAILURES:
+        future.set_exception(NoLeaderAvailable())
+    elif error != FAIL_REASON.SUCCESS:
+        future.set_exception(ReplicationFailed(error))
+    elif isinstance(result, CommandError):
+        future.set_exception(result.error)
+    else:
+        future.set_result(result)
+
+
+def _expire(future: asyncio.Future, timeout: float):
+    if not future.done():
+        future.set_exception(ReplicationTimeout(timeout))
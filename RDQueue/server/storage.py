@@ -0,0 +1,588 @@
+import bisect
+import enum
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+from array import array
+from pathlib import Path
+from typing import List, Tuple
+
+from RDQueue.common.config import settings
+
+logger = logging.getLogger(__file__)
+
+# payload size, crc32 of the payload, timestamp of the message
+RECORD_HEADER = struct.Struct('!IId')
+# offset relative to the segment base offset, position of the record in the segment file
+INDEX_ENTRY = struct.Struct('!II')
+
+_ZEROS = bytes(1024 * 1024)
+
+
+class FsyncPolicy(str, enum.Enum):
+    ALWAYS = 'always'  # fsync after every record
+    BATCH = 'batch'  # fsync once per appended batch
+    INTERVAL = 'interval'  # fsync at most once every `fsync_interval` seconds
+
+
+class Segment:
+    """
+    One file of a log holding the records from `base_offset` on. The file is preallocated and
+    memory mapped, records are written and read through the map, and a sparse index maps every
+    `index_interval` bytes of records to their offset.
+    """
+
+    def __init__(self, directory: Path, base_offset: int, index_interval: int):
+        self._base_offset: int = base_offset
+        self._log_path: Path = directory / f'{base_offset:020d}.log'
+        self._index_path: Path = directory / f'{base_offset:020d}.index'
+        self._index_interval: int = index_interval
+
+        self._index_offsets: array = array('I')
+        self._index_positions: array = array('I')
+        self._count: int = 0
+        self._size: int = 0
+        self._synced_size: int = 0
+        self._max_timestamp: float = 0
+        # offset and position of the record after the last one read, sequential consumers skip the index lookup
+        self._cursor: tuple[int, int] = (0, 0)
+
+        self._file = open(self._log_path, 'r+b' if self._log_path.exists() else 'w+b')
+        self._index_file = open(self._index_path, 'r+b' if self._index_path.exists() else 'w+b')
+        self._map: mmap.mmap | None = None
+        self._remap()
+        self._recover()
+
+    @property
+    def base_offset(self) -> int:
+        return self._base_offset
+
+    @property
+    def end_offset(self) -> int:
+        return self._base_offset + self._count
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def capacity(self) -> int:
+        return len(self._map) if self._map is not None else 0
+
+    @property
+    def max_timestamp(self) -> float:
+        return self._max_timestamp
+
+    def size_before(self, offset: int) -> int:
+        """
+        Bytes taken by the records of the segment before `offset`.
+        :param offset:
+        :return:
+        """
+        if offset >= self.end_offset:
+            return self._size
+
+        return self._seek(max(offset - self._base_offset, 0))
+
+    def fits(self, payload_size: int) -> bool:
+        return self._size + RECORD_HEADER.size + payload_size <= self.capacity
+
+    def reserve(self, capacity: int):
+        if capacity > self.capacity:
+            self._file.truncate(capacity)
+            self._remap()
+
+    def append(self, payload: bytes, timestamp: float):
+        position = self._size
+
+        if not self._index_positions or position - self._index_positions[-1] >= self._index_interval:
+            self._add_index_entry(self._count, position)
+
+        RECORD_HEADER.pack_into(self._map, position, len(payload), zlib.crc32(payload), timestamp)
+        position += RECORD_HEADER.size
+        self._map[position:position + len(payload)] = payload
+
+        self._size = position + len(payload)
+        self._count += 1
+        self._max_timestamp = max(self._max_timestamp, timestamp)
+
+    def read_many(self, offset: int, max_n: int) -> List[bytes]:
+        relative = offset - self._base_offset
+        count = min(max_n, self._count - relative)
+
+        if count <= 0:
+            return []
+
+        position = self._seek(relative)
+        records = []
+
+        for _ in range(count):
+            size = RECORD_HEADER.unpack_from(self._map, position)[0]
+            position += RECORD_HEADER.size
+            records.append(self._map[position:position + size])
+            position += size
+
+        self._cursor = (relative + count, position)
+        return records
+
+    def read_timestamped(self, offset: int, max_n: int, max_bytes: int) -> List[Tuple[bytes, float]]:
+        """
+        Like `read_many`, with the timestamp of every record, stopping once their payloads reach `max_bytes`.
+        :param offset:
+        :param max_n:
+        :param max_bytes:
+        :return:
+        """
+        relative = offset - self._base_offset
+        count = min(max_n, self._count - relative)
+
+        if count <= 0 or max_bytes <= 0:
+            return []
+
+        position = self._seek(relative)
+        records = []
+        read_bytes = 0
+
+        while len(records) < count and read_bytes < max_bytes:
+            size, _, timestamp = RECORD_HEADER.unpack_from(self._map, position)
+            position += RECORD_HEADER.size
+            records.append((self._map[position:position + size], timestamp))
+            position += size
+            read_bytes += size
+
+        self._cursor = (relative + len(records), position)
+        return records
+
+    def truncate(self, offset: int):
+        """
+        Drop every record from `offset` on.
+        :param offset:
+        :return:
+        """
+        relative = max(offset - self._base_offset, 0)
+
+        if relative >= self._count:
+            return
+
+        position = self._seek(relative)
+        kept = bisect.bisect_left(self._index_offsets, relative)
+
+        del self._index_offsets[kept:]
+        del self._index_positions[kept:]
+        self._index_file.truncate(kept * INDEX_ENTRY.size)
+        self._index_file.seek(0, os.SEEK_END)
+
+        self._clear_from(position)
+        self._count = relative
+        self._size = position
+        self._synced_size = min(self._synced_size, position)
+        self._cursor = (0, 0)
+
+    def seal(self):
+        """
+        Shrink the file to its records once no more records will be appended to it.
+        :return:
+        """
+        self.sync()
+        self._file.truncate(self._size)
+        self._remap()
+
+    def sync(self):
+        if self._size > self._synced_size:
+            start = self._synced_size - self._synced_size % mmap.PAGESIZE
+            self._map.flush(start, self._size - start)
+            self._synced_size = self._size
+
+        self._index_file.flush()
+        os.fsync(self._index_file.fileno())
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+        self._file.close()
+        self._index_file.close()
+
+    def delete(self):
+        self.close()
+        self._log_path.unlink(missing_ok=True)
+        self._index_path.unlink(missing_ok=True)
+
+    def _seek(self, relative: int) -> int:
+        cursor_offset, cursor_position = self._cursor
+
+        if 0 < cursor_offset <= relative:
+            current, position = cursor_offset, cursor_position
+        else:
+            i = bisect.bisect_right(self._index_offsets, relative) - 1
+            current, position = self._index_offsets[i], self._index_positions[i]
+
+        while current < relative:
+            position += RECORD_HEADER.size + RECORD_HEADER.unpack_from(self._map, position)[0]
+            current += 1
+
+        return position
+
+    def _add_index_entry(self, relative: int, position: int):
+        self._index_offsets.append(relative)
+        self._index_positions.append(position)
+        self._index_file.write(INDEX_ENTRY.pack(relative, position))
+
+    def _remap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+        file_size = os.fstat(self._file.fileno()).st_size
+
+        if file_size > 0:
+            self._map = mmap.mmap(self._file.fileno(), file_size)
+
+    def _valid_record_at(self, position: int) -> int | None:
+        """
+        Return the position after the record at `position`, or None if there is no complete record there.
+        :param position:
+        :return:
+        """
+        if position + RECORD_HEADER.size > self.capacity:
+            return None
+
+        size, crc, _ = RECORD_HEADER.unpack_from(self._map, position)
+        end = position + RECORD_HEADER.size + size
+
+        if size == 0 or end > self.capacity or zlib.crc32(self._map[position + RECORD_HEADER.size:end]) != crc:
+            return None
+
+        return end
+
+    def _recover(self):
+        """
+        Rebuild the segment state from its files, dropping a partially written tail left by a crash.
+        :return:
+        """
+        self._index_file.seek(0)
+        entries = self._index_file.read()
+
+        for i in range(len(entries) // INDEX_ENTRY.size):
+            relative, position = INDEX_ENTRY.unpack_from(entries, i * INDEX_ENTRY.size)
+            self._index_offsets.append(relative)
+            self._index_positions.append(position)
+
+        # the last index entries may point past what actually reached the disk
+        while self._index_positions and self._valid_record_at(self._index_positions[-1]) is None:
+            self._index_offsets.pop()
+            self._index_positions.pop()
+
+        self._index_file.truncate(len(self._index_offsets) * INDEX_ENTRY.size)
+        self._index_file.seek(0, os.SEEK_END)
+
+        count, position = (self._index_offsets[-1], self._index_positions[-1]) if self._index_offsets else (0, 0)
+
+        while (end := self._valid_record_at(position)) is not None:
+            self._max_timestamp = max(self._max_timestamp, RECORD_HEADER.unpack_from(self._map, position)[2])
+            position = end
+            count += 1
+
+        self._count = count
+        self._size = self._synced_size = position
+        self._clear_from(position)
+
+    def _clear_from(self, position: int):
+        # zero the stale bytes after the last record so that a later recovery can not resurrect them
+        while position < self.capacity:
+            chunk = min(len(_ZEROS), self.capacity - position)
+
+            if self._map[position:position + chunk] == _ZEROS[:chunk]:
+                break
+
+            self._map[position:position + chunk] = _ZEROS[:chunk]
+            position += chunk
+
+
+class SegmentedLog:
+    """
+    Append-only storage of the messages of one queue, split into segment files named after the
+    offset of their first record. Offsets are contiguous, from `start_offset` up to `end_offset`.
+    """
+
+    def __init__(
+            self,
+            directory: Path,
+            segment_bytes: int = settings.LOG_SEGMENT_BYTES,
+            index_interval: int = settings.LOG_INDEX_INTERVAL_BYTES,
+            fsync_policy: FsyncPolicy | str = settings.LOG_FSYNC_POLICY,
+            fsync_interval: float = settings.LOG_FSYNC_INTERVAL
+    ):
+        self._directory: Path = directory
+        self._segment_bytes: int = segment_bytes
+        self._index_interval: int = index_interval
+        self._fsync_policy: FsyncPolicy = FsyncPolicy(fsync_policy)
+        self._fsync_interval: float = fsync_interval
+        self._last_sync: float = time.monotonic()
+
+        os.makedirs(directory, exist_ok=True)
+
+        base_offsets = sorted(int(path.stem) for path in directory.glob('*.log'))
+        self._segments: List[Segment] = [self._open_segment(base) for base in base_offsets]
+        self._base_offsets: List[int] = base_offsets
+
+        if not self._segments:
+            self._add_segment(0, self._segment_bytes)
+        else:
+            self._segments[-1].reserve(self._segment_bytes)
+
+    @property
+    def directory(self) -> Path:
+        return self._directory
+
+    @property
+    def start_offset(self) -> int:
+        return self._segments[0].base_offset
+
+    @property
+    def end_offset(self) -> int:
+        return self._segments[-1].end_offset
+
+    @property
+    def size(self) -> int:
+        return sum(segment.size for segment in self._segments)
+
+    def append(self, payloads: List[bytes], timestamp: float) -> int:
+        """
+        Append the records and return the offset of the first one.
+        :param payloads:
+        :param timestamp:
+        :return:
+        """
+        first_offset = self.end_offset
+        segment = self._segments[-1]
+
+        for payload in payloads:
+            if not segment.fits(len(payload)):
+                segment = self._roll(len(payload))
+
+            segment.append(payload, timestamp)
+
+            if self._fsync_policy == FsyncPolicy.ALWAYS:
+                segment.sync()
+
+        if self._fsync_policy == FsyncPolicy.BATCH or (
+                self._fsync_policy == FsyncPolicy.INTERVAL and
+                time.monotonic() - self._last_sync >= self._fsync_interval):
+            self.sync()
+
+        return first_offset
+
+    def read(self, offset: int) -> bytes:
+        records = self.read_many(offset, 1)
+
+        if not records:
+            raise IndexError(f'Offset {offset} is out of range [{self.start_offset}, {self.end_offset})')
+
+        return records[0]
+
+    def read_many(self, offset: int, max_n: int) -> List[bytes]:
+        if offset < self.start_offset:
+            raise IndexError(f'Offset {offset} is before the start of the log ({self.start_offset})')
+
+        records = []
+        i = bisect.bisect_right(self._base_offsets, offset) - 1
+
+        while len(records) < max_n and i < len(self._segments):
+            records.extend(self._segments[i].read_many(offset + len(records), max_n - len(records)))
+            i += 1
+
+        return records
+
+    def read_timestamped(self, offset: int, max_n: int, max_bytes: int) -> List[Tuple[bytes, float]]:
+        """
+        Read up to `max_n` records with their timestamp, stopping once their payloads reach `max_bytes`.
+        :param offset:
+        :param max_n:
+        :param max_bytes:
+        :return:
+        """
+        if offset < self.start_offset:
+            raise IndexError(f'Offset {offset} is before the start of the log ({self.start_offset})')
+
+        records = []
+        read_bytes = 0
+        i = bisect.bisect_right(self._base_offsets, offset) - 1
+
+        while len(records) < max_n and read_bytes < max_bytes and i < len(self._segments):
+            read = self._segments[i].read_timestamped(offset + len(records), max_n - len(records),
+                                                      max_bytes - read_bytes)
+            records.extend(read)
+            read_bytes += sum(len(payload) for payload, _ in read)
+            i += 1
+
+        return records
+
+    def retention_offset(self, max_messages: int = 0, max_bytes: int = 0, max_age: float | None = None,
+                         now: float = 0, start_offset: int | None = None, end_offset: int | None = None) -> int:
+        """
+        The offset before which whole segments exceed one of the retention limits (0 or None disables a limit).
+        A segment is only over a limit if the rest of the log still meets it without that segment.
+        The limits apply to the records from `start_offset` up to `end_offset` (the whole log by default), as if
+        the segment of the last of them was the active one.
+        :param max_messages:
+        :param max_bytes:
+        :param max_age:
+        :param now:
+        :param start_offset:
+        :param end_offset:
+        :return:
+        """
+        end_offset = self.end_offset if end_offset is None else end_offset
+        first = 0 if start_offset is None else self._segment_index(start_offset)
+        segments = self._segments[first:max(self._segment_index(end_offset - 1), first) + 1]
+        offset = segments[0].base_offset
+        size = sum(segment.size for segment in segments[:-1]) + segments[-1].size_before(end_offset)
+
+        for segment in segments[:-1]:
+            remaining_size = size - segment.size
+
+            if (max_messages and end_offset - segment.end_offset >= max_messages) or \
+                    (max_bytes and remaining_size >= max_bytes) or \
+                    (max_age and segment.max_timestamp < now - max_age):
+                offset = segment.end_offset
+                size = remaining_size
+            else:
+                break
+
+        return offset
+
+    def segment_start(self, offset: int, end_offset: int | None = None) -> int:
+        """
+        The start offset `delete_before(offset)` would leave the log with, the segment of the record before
+        `end_offset` being kept as if it was the active one.
+        :param offset:
+        :param end_offset:
+        :return:
+        """
+        last = len(self._segments) - 1 if end_offset is None else self._segment_index(end_offset - 1)
+        i = self._segment_index(offset)
+
+        if self._segments[i].end_offset <= offset:
+            i += 1
+
+        return self._segments[min(i, last)].base_offset
+
+    def delete_before(self, offset: int) -> int:
+        """
+        Delete the segments holding only records before `offset`. The active segment is always kept.
+        :param offset:
+        :return: the new start offset of the log
+        """
+        count = 0
+
+        while count < len(self._segments) - 1 and self._segments[count].end_offset <= offset:
+            self._segments[count].delete()
+            count += 1
+
+        del self._segments[:count]
+        del self._base_offsets[:count]
+
+        return self.start_offset
+
+    def truncate(self, end_offset: int):
+        """
+        Drop every record from `end_offset` on.
+        :param end_offset:
+        :return:
+        """
+        if end_offset >= self.end_offset:
+            return
+
+        if end_offset <= self.start_offset:
+            self.reset(end_offset)
+            return
+
+        while self._segments[-1].base_offset >= end_offset:
+            self._segments.pop().delete()
+            self._base_offsets.pop()
+
+        self._segments[-1].truncate(end_offset)
+        self._segments[-1].reserve(self._segment_bytes)
+
+    def reset(self, start_offset: int):
+        """
+        Drop every record and continue the log from `start_offset`.
+        :param start_offset:
+        :return:
+        """
+        for segment in self._segments:
+            segment.delete()
+
+        self._segments.clear()
+        self._base_offsets.clear()
+        self._add_segment(start_offset, self._segment_bytes)
+
+    def sync(self):
+        self._segments[-1].sync()
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        for segment in self._segments:
+            segment.close()
+
+    def _segment_index(self, offset: int) -> int:
+        # the segment holding `offset`, the first one for the offsets before the log
+        return max(bisect.bisect_right(self._base_offsets, offset) - 1, 0)
+
+    def _roll(self, payload_size: int) -> Segment:
+        active = self._segments[-1]
+        active.seal()
+
+        return self._add_segment(active.end_offset, max(self._segment_bytes, RECORD_HEADER.size + payload_size))
+
+    def _open_segment(self, base_offset: int) -> Segment:
+        return Segment(self._directory, base_offset, self._index_interval)
+
+    def _add_segment(self, base_offset: int, capacity: int) -> Segment:
+        segment = self._open_segment(base_offset)
+        segment.reserve(capacity)
+
+        self._segments.append(segment)
+        self._base_offsets.append(base_offset)
+
+        return segment
+
+
+def write_atomic(path: Path, data: bytes) -> int:
+    """
+    Replace the file at `path` with `data`, so that it holds either the old or the new content after a crash.
+    :param path:
+    :param data:
+    :return: the number of bytes written
+    """
+    tmp_path = path.with_name(f'{path.name}.tmp')
+    write_synced(tmp_path, data)
+    os.replace(tmp_path, path)
+
+    dir_fd = os.open(path.parent, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+    return len(data)
+
+
+def write_synced(path: Path, data: bytes) -> int:
+    """
+    Write `data` to the file at `path` and make sure it reached the disk.
+    :param path:
+    :param data:
+    :return: the number of bytes written
+    """
+    with open(path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+    return len(data)
@@ -0,0 +1,187 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, List
+
+from RDQueue.common.config import settings
+from RDQueue.common.connection import Connection
+from RDQueue.common.message import Message, message_factory
+from RDQueue.common.networking import FrameWriter, write_message
+
+logger = logging.getLogger(__file__)
+
+
+class BaseSubscription:
+    """
+    A SUBSCRIBE request, answered by a response carrying a list of messages every time the partition has
+    new messages for the consumer. The consumer grants credits, one per message, and is never sent more messages
+    than it was granted: a slow consumer holds back at most its window of messages in the buffers between them.
+    """
+
+    def __init__(self, request: Message, queue_name: str, writer: FrameWriter, sender_addr: str):
+        self._request: Message = request
+        self._queue_name: str = queue_name
+        self._writer: FrameWriter = writer
+        self._sender_addr: str = sender_addr
+        self._task: asyncio.Task | None = None
+
+    @property
+    def id(self) -> int | str:
+        return self._request.id
+
+    @property
+    def queue_name(self) -> str:
+        return self._queue_name
+
+    def start(self, on_done: Callable[['BaseSubscription'], None]):
+        """
+        :param on_done: called once the subscription has ended, however it ended
+        :return:
+        """
+        self._task = asyncio.create_task(self._run())
+        self._task.add_done_callback(lambda _: on_done(self))
+
+    def grant(self, credits: int):
+        raise NotImplementedError
+
+    def cancel(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        try:
+            await self._stream()
+        except asyncio.CancelledError:
+            raise
+        except OSError:
+            # the consumer is gone
+            pass
+        except Exception as e:
+            # the consumer subscribes again, possibly to another owner of the partition
+            logger.warning(f'Subscription {self.id} to {self._queue_name} ended: {e!r}')
+            await self._end_with_error(e)
+
+    async def _stream(self):
+        raise NotImplementedError
+
+    async def _end_with_error(self, error: Exception):
+        if self._writer.is_closing():
+            return
+
+        write_message(self._writer, message_factory.error_res(
+            sender_addr=self._sender_addr,
+            receiver_addr=self._request.sender_addr,
+            _id=self._request.id,
+            operation=self._request.operation,
+            body={
+                'error': type(error).__name__,
+                'message': getattr(error, 'message', None) or str(error)
+            }
+        ))
+        await self._writer.flush()
+
+
+class Subscription(BaseSubscription):
+    """
+    A subscription to a partition served by this worker. Its messages are popped as soon as they are pushed,
+    as long as the consumer has credits left.
+    """
+
+    def __init__(self, request: Message, queue_name: str, writer: FrameWriter, sender_addr: str, credits: int,
+                 wait_for_messages: Callable[[], Awaitable[int | None]], pop: Callable[[int], Awaitable[List]]):
+        """
+        :param request:
+        :param queue_name:
+        :param writer:
+        :param sender_addr:
+        :param credits: the window of the consumer, how many messages can be sent before it grants more
+        :param wait_for_messages: waits until the partition has messages for the consumer
+        :param pop: pops up to the given number of messages for the consumer
+        """
+        super().__init__(request, queue_name, writer, sender_addr)
+        self._credits: int = credits
+        self._credited: asyncio.Event = asyncio.Event()
+        self._wait_for_messages: Callable[[], Awaitable[int | None]] = wait_for_messages
+        self._pop: Callable[[int], Awaitable[List]] = pop
+
+    @property
+    def credits(self) -> int:
+        return self._credits
+
+    def grant(self, credits: int):
+        self._credits += credits
+        self._credited.set()
+
+    async def _stream(self):
+        while not self._writer.is_closing():
+            if self._credits <= 0:
+                self._credited.clear()
+                await self._credited.wait()
+                continue
+
+            if not await self._wait_for_messages():
+                continue
+
+            messages = await self._pop(min(self._credits, settings.MAX_BATCH_SIZE))
+
+            if not messages:
+                continue
+
+            self._credits -= len(messages)
+            write_message(self._writer, message_factory.subscribe_res(
+                sender_addr=self._sender_addr,
+                receiver_addr=self._request.sender_addr,
+                _id=self._request.id,
+                receiver_id=self._request.sender_id,
+                body=messages
+            ))
+            await self._writer.flush()
+
+
+class RelayedSubscription(BaseSubscription):
+    """
+    A subscription to a partition served by another worker of the broker. The messages and the credits
+    are relayed over the connection to that worker.
+    """
+
+    def __init__(self, request: Message, queue_name: str, writer: FrameWriter, sender_addr: str,
+                 connection: Connection):
+        super().__init__(request, queue_name, writer, sender_addr)
+        self._connection: Connection = connection
+        # the connection is shared by the requests of every client, whose ids may collide
+        self._relayed: Message = request.copy()
+
+    def grant(self, credits: int):
+        asyncio.create_task(self._send(message_factory.credit_req(
+            sender_addr=self._sender_addr,
+            receiver_addr=self._connection.address.connection_str,
+            sender_id=self._request.sender_id,
+            body={'subscription': self._relayed.id, 'credits': credits}
+        )))
+
+    def cancel(self):
+        super().cancel()
+        asyncio.create_task(self._send(message_factory.unsubscribe_req(
+            sender_addr=self._sender_addr,
+            receiver_addr=self._connection.address.connection_str,
+            sender_id=self._request.sender_id,
+            body={'subscription': self._relayed.id}
+        )))
+
+    async def _send(self, message: Message):
+        try:
+            await self._connection.send(message)
+        except Exception as e:
+            logger.warning(f'Could not relay {message} of subscription {self.id}: {e!r}')
+
+    async def _stream(self):
+        try:
+            updates = await self._connection.subscribe(self._relayed)
+
+            while not isinstance(update := await updates.get(), Exception):
+                write_message(self._writer, update.copy(_id=self._request.id))
+                await self._writer.flush()
+
+                if not update.is_ok:
+                    return
+        finally:
+            self._connection.unsubscribe(self._relayed.id)
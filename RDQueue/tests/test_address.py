@@ -0,0 +1,19 @@
+"""
+Brokers are compared with the current broker of a client, which is None once all of them failed.
+
+    python -m pytest RDQueue/tests
+"""
+from RDQueue.common.address import address_factory
+
+
+def test_an_address_equals_the_same_host_and_port():
+    assert address_factory.from_str('localhost:9091') == address_factory.from_str('127.0.0.1:9091')
+    assert address_factory.from_str('127.0.0.1:9091') != address_factory.from_str('127.0.0.1:9092')
+
+
+def test_an_address_differs_from_none():
+    address = address_factory.from_str('127.0.0.1:9091')
+
+    assert address != None  # noqa: E711
+    assert address not in {None}
+    assert None in [None, address]
@@ -0,0 +1,108 @@
+"""
+The phi accrual detector suspects a peer once its silence is unlikely given the intervals between its heartbeats,
+and the load balancer keeps checking the heartbeats of a broker whatever happens in a check.
+
+    python -m pytest RDQueue/tests
+"""
+import asyncio
+import math
+
+from RDQueue.common.address import address_factory
+from RDQueue.common.config import settings
+from RDQueue.common.failure_detector import PhiAccrualDetector
+from RDQueue.server.loadbalancer import Broker
+
+
+def _detector(interval: float, heartbeats: int = 20) -> PhiAccrualDetector:
+    detector = PhiAccrualDetector(0.1, 100, 0.05)
+
+    for n in range(heartbeats + 1):
+        detector.heartbeat(n * interval)
+
+    return detector
+
+
+def test_phi_is_zero_before_the_first_heartbeat():
+    assert PhiAccrualDetector(0.1).phi(100) == 0
+
+
+def test_phi_is_low_right_after_a_heartbeat_much_earlier_than_expected():
+    # the logistic approximation overflowed so far below the mean interval
+    detector = _detector(1.5)
+
+    assert detector.phi(30.001) < 0.01
+    assert detector.is_available(30.001, 8)
+
+
+def test_phi_grows_with_the_silence():
+    detector = _detector(0.1)
+    phis = [detector.phi(2 + silence) for silence in (0.05, 0.1, 0.2, 0.3, 0.5)]
+
+    assert phis == sorted(phis)
+    assert detector.is_available(2.1, 8)
+    assert not detector.is_available(2.5, 8)
+
+
+def test_phi_is_infinite_long_after_the_last_heartbeat():
+    assert _detector(0.1).phi(1000) == math.inf
+
+
+def test_the_expected_interval_is_assumed_until_intervals_are_measured():
+    detector = PhiAccrualDetector(1, min_std=0.01)
+    detector.heartbeat(0)
+
+    assert detector.is_available(1, 8)
+    assert not detector.is_available(5, 8)
+
+
+def test_jitter_raises_the_tolerated_silence():
+    regular = _detector(0.1)
+    jittery = PhiAccrualDetector(0.1, 100, 0.05)
+    now = 0
+
+    for n in range(20):
+        now += 0.05 if n % 2 else 0.35
+        jittery.heartbeat(now)
+
+    assert jittery.phi(now + 0.5) < regular.phi(2 + 0.5)
+
+
+def test_reset_forgets_the_heartbeats():
+    detector = _detector(0.1)
+    detector.reset()
+
+    assert detector.last_heartbeat is None
+    assert detector.phi(1000) == 0
+
+
+class _FailingOnce:
+
+    def __init__(self):
+        self.checks = 0
+
+    def is_available(self, now: float, threshold: float) -> bool:
+        self.checks += 1
+
+        if self.checks == 1:
+            raise OverflowError('math range error')
+
+        return True
+
+
+def test_a_failed_check_does_not_stop_the_heartbeats():
+    asyncio.run(_check_heartbeats())
+
+
+async def _check_heartbeats():
+    # nothing listens there, the reports are never answered
+    broker = Broker(address_factory.from_str('127.0.0.1:19499'))
+    broker._is_alive = True
+    broker._detector = detector = _FailingOnce()
+
+    try:
+        await asyncio.sleep(settings.HEARTBEAT_INTERVAL * 5)
+
+        assert not broker._heartbeat_task.done()
+        assert detector.checks > 1
+    finally:
+        await broker.close()
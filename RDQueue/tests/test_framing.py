@@ -0,0 +1,123 @@
+"""
+Messages travel in length-prefixed frames, so a payload holding any byte sequence is read back whole, and a frame
+with a corrupt or oversized header is rejected before its payload is read.
+
+    python -m pytest RDQueue/tests
+"""
+import asyncio
+
+import pytest
+
+from RDQueue.common.exceptions import FrameTooLarge, InvalidFrame
+from RDQueue.common.message import message_factory
+from RDQueue.common.networking import FRAME_HEADER, FrameWriter, decode_frame_header, encode_frame_header, \
+    receive_frame, receive_message, write_frame, write_message
+
+
+class _Writer:
+    def __init__(self):
+        self.writes = []
+        self.drained = 0
+
+    def write(self, data: bytes):
+        self.writes.append(bytes(data))
+
+    def writelines(self, data):
+        self.writes.extend(bytes(chunk) for chunk in data)
+
+    async def drain(self):
+        self.drained += 1
+
+    @property
+    def data(self) -> bytes:
+        return b''.join(self.writes)
+
+
+def _reader(data: bytes) -> asyncio.StreamReader:
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    reader.feed_eof()
+    return reader
+
+
+def test_header_round_trip():
+    header = encode_frame_header(1234, flags=3)
+
+    assert len(header) == FRAME_HEADER.size
+    assert decode_frame_header(header) == (3, 1234)
+
+
+def test_corrupt_header_is_rejected():
+    header = bytearray(encode_frame_header(10))
+    header[0:2] = b'\n\r'
+
+    with pytest.raises(InvalidFrame):
+        decode_frame_header(bytes(header))
+
+
+def test_oversized_frames_are_rejected_on_both_ends():
+    with pytest.raises(FrameTooLarge):
+        encode_frame_header(101, max_size=100)
+
+    with pytest.raises(FrameTooLarge):
+        decode_frame_header(encode_frame_header(101), max_size=100)
+
+
+def test_frames_are_read_back_whole():
+    async def scenario():
+        writer = _Writer()
+        # payloads holding the former delimiter and nothing at all
+        payloads = [b'a\n\rb', b'', bytes(range(256)) * 10]
+
+        for payload in payloads:
+            write_frame(writer, payload)
+
+        reader = _reader(writer.data)
+        assert [bytes(await receive_frame(reader)) for _ in payloads] == payloads
+
+    asyncio.run(scenario())
+
+
+def test_truncated_frame_is_not_read():
+    async def scenario():
+        writer = _Writer()
+        write_frame(writer, b'x' * 100)
+
+        with pytest.raises(asyncio.IncompleteReadError):
+            await receive_frame(_reader(writer.data[:-1]))
+
+    asyncio.run(scenario())
+
+
+def test_messages_round_trip():
+    async def scenario():
+        writer = _Writer()
+        message = message_factory.queue_push_req(sender_addr='127.0.0.1:1', receiver_addr='127.0.0.1:2',
+                                                 sender_id='client', body={'queue_name': 'q', 'message': 'a\n\rb'})
+        write_message(writer, message)
+        received = await receive_message(_reader(writer.data))
+
+        assert (received.id, received.operation, received.body) == (message.id, message.operation, message.body)
+
+    asyncio.run(scenario())
+
+
+def test_frame_writer_flushes_past_the_high_water_mark():
+    async def scenario():
+        writer = _Writer()
+        frames = FrameWriter(writer, high_water=100)
+
+        write_frame(frames, b'x' * 40)
+        await frames.drain()
+        assert writer.writes == []
+
+        write_frame(frames, b'x' * 60)
+        await frames.drain()
+        assert len(writer.data) == 2 * FRAME_HEADER.size + 100
+        assert frames.buffered == 0
+
+        write_frame(frames, b'y')
+        await frames.flush()
+        assert writer.data.endswith(b'y')
+
+    asyncio.run(scenario())
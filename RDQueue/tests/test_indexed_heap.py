@@ -0,0 +1,68 @@
+"""
+The indexed heap always yields the item with the lowest priority, also after priorities change and items are
+removed from the middle of the heap.
+
+    python -m pytest RDQueue/tests
+"""
+import random
+
+from RDQueue.common.indexed_heap import IndexedHeap
+
+
+def _check(heap: IndexedHeap, reference: dict):
+    assert len(heap) == len(reference)
+    assert set(heap) == set(reference)
+
+    for item, priority in reference.items():
+        assert item in heap
+        assert heap.priority(item) == priority
+
+    if reference:
+        assert heap.priority(heap.peek()) == min(reference.values())
+    else:
+        assert heap.peek() is None
+
+
+def test_lowest_priority_first():
+    heap = IndexedHeap()
+
+    for item, priority in [('a', 3), ('b', 1), ('c', 2)]:
+        heap.push(item, priority)
+
+    assert heap.peek() == 'b'
+
+    heap.update('a', 0)
+    assert heap.peek() == 'a'
+
+    # pushing an item again changes its priority
+    heap.push('a', 5)
+    assert (len(heap), heap.peek()) == (3, 'b')
+
+    heap.remove('b')
+    assert heap.peek() == 'c'
+    assert 'b' not in heap
+
+
+def test_random_operations_match_a_dict():
+    rng = random.Random(7)
+    heap = IndexedHeap()
+    reference = {}
+
+    for _ in range(2000):
+        operation = rng.random()
+        item = rng.randrange(50)
+
+        if operation < 0.5:
+            priority = rng.uniform(0, 100)
+            heap.push(item, priority)
+            reference[item] = priority
+        elif item in reference:
+            heap.remove(item)
+            del reference[item]
+
+        _check(heap, reference)
+
+    for item in list(reference):
+        heap.remove(item)
+        del reference[item]
+        _check(heap, reference)
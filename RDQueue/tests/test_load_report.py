@@ -0,0 +1,55 @@
+"""
+A broker reports its load to the load balancer, which must not mistake the pops parked waiting for messages for
+requests it is slow to handle.
+
+    python -m pytest RDQueue/tests
+"""
+import asyncio
+
+from RDQueue.benchmark.cluster import LocalCluster, apply_settings, cluster_settings
+from RDQueue.common.connection import Connection
+from RDQueue.common.message import Operation, message_factory
+
+QUEUE = 'parked'
+CLIENT = 'parked-client'
+
+
+def test_parked_pops_are_left_out_of_the_load():
+    asyncio.run(_park_pops())
+
+
+async def _park_pops():
+    settings = cluster_settings(brokers=1, base_port=19410)
+    apply_settings(settings)
+    cluster = LocalCluster(settings, in_process=True)
+    await cluster.start()
+    broker = cluster.servers[1]
+    address = broker.connection_address.connection_str
+    connection = Connection(broker.connection_address, request_timeout=10)
+
+    def request(factory, body):
+        return connection.request(factory(sender_addr=address, receiver_addr=address, sender_id=CLIENT, body=body))
+
+    try:
+        assert (await request(message_factory.queue_create_req, {'name': QUEUE, 'partitions': 1})).is_ok
+        assert (await request(message_factory.queue_push_req, {'queue_name': QUEUE, 'message': 'first'})).is_ok
+        assert (await request(message_factory.queue_pop_req, {'queue_name': QUEUE})).body == 'first'
+        # e.g. the creation of the queue, which waits for the election of its leader
+        slowest = broker.load_report()['p99']
+
+        pops = [asyncio.create_task(request(message_factory.queue_pop_req, {'queue_name': QUEUE, 'wait': 2}))
+                for _ in range(5)]
+        await asyncio.sleep(1)
+
+        assert broker.load_report()['in_flight'] == 0
+
+        responses = await asyncio.gather(*pops)
+        report = broker.load_report()
+
+        assert all(response.is_ok and response.body is None for response in responses)
+        assert report['in_flight'] == 0
+        assert report['p99'] <= slowest
+        assert broker._operation_duration(Operation.QUEUE_POP).sum >= 10
+    finally:
+        await connection.close()
+        await cluster.stop()
@@ -0,0 +1,108 @@
+"""
+The requests read from a connection hold a bounded amount of memory: once they take up its budget the server stops
+reading the connection until enough of them are handled.
+
+    python -m pytest RDQueue/tests
+"""
+import asyncio
+from typing import List
+
+from RDQueue.common import config
+from RDQueue.common.address import Address, address_factory
+from RDQueue.common.message import Message, message_factory
+from RDQueue.common.networking import receive_message, send_message_to_writer, write_message
+from RDQueue.server.base import BaseServer
+from RDQueue.server.budget import MemoryBudget
+
+REQUEST_BYTES = 1000
+
+
+def test_budget_accounting():
+    async def scenario():
+        budget = MemoryBudget(100)
+        budget.acquire(80)
+
+        assert (budget.used, budget.pressure) == (80, 0.8)
+        assert not budget.exhausted(20)
+        assert budget.exhausted(21)
+
+        waiting = asyncio.create_task(budget.wait_for_room(level=0.5))
+        await asyncio.sleep(0)
+        budget.release(20)
+        await asyncio.sleep(0)
+        assert not waiting.done()
+
+        budget.release(20)
+        await asyncio.wait_for(waiting, 1)
+        assert budget.used == 40
+
+    asyncio.run(scenario())
+
+
+def test_unbounded_budget():
+    budget = MemoryBudget(0)
+    budget.acquire(10 ** 12)
+
+    assert not budget.exhausted(10 ** 12)
+    assert budget.pressure == 0
+
+
+class HoldingServer(BaseServer):
+    """
+    Holds every request until it is released.
+    """
+
+    def __init__(self, address: Address):
+        super().__init__(address)
+        self.started: List[int] = []
+        self.release: asyncio.Event = asyncio.Event()
+
+    async def handle_message(self, message: Message, writer):
+        self.started.append(message.body['n'])
+        await self.release.wait()
+
+        await send_message_to_writer(writer, message=message_factory.queue_push_res(
+            sender_addr=self.connection_address.connection_str,
+            receiver_addr=message.sender_addr,
+            _id=message.id,
+            body='OK'
+        ))
+
+
+def test_connection_stops_being_read_once_its_requests_take_up_its_budget(monkeypatch):
+    monkeypatch.setitem(config.DEFAULTS, 'CONNECTION_MEMORY_BUDGET', 4 * REQUEST_BYTES)
+    asyncio.run(_overflow_connection_budget())
+
+
+async def _overflow_connection_budget():
+    address = address_factory.from_str('127.0.0.1:19440')
+    server = HoldingServer(address)
+    serving = asyncio.create_task(server.start())
+    await asyncio.sleep(0.1)
+    reader, writer = await asyncio.open_connection(*address.tuple)
+
+    try:
+        for n in range(20):
+            write_message(writer, message_factory.queue_push_req(
+                sender_addr='127.0.0.1:1', receiver_addr=address.connection_str, sender_id='client',
+                body={'n': n, 'message': 'x' * REQUEST_BYTES}))
+
+        await writer.drain()
+        await asyncio.sleep(0.2)
+
+        # the request that took the connection past its budget is the last one read
+        assert server.started == list(range(4))
+        assert server.memory.used > 4 * REQUEST_BYTES
+
+        server.release.set()
+        responses = [await asyncio.wait_for(receive_message(reader), 5) for _ in range(20)]
+
+        assert sorted(server.started) == list(range(20))
+        assert all(response.is_ok for response in responses)
+        assert server.memory.used == 0
+    finally:
+        server.release.set()
+        writer.close()
+        await server.stop()
+        serving.cancel()
+        await asyncio.gather(serving, return_exceptions=True)
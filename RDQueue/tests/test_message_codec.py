@@ -0,0 +1,74 @@
+"""
+Messages are encoded as a versioned positional array, and the dict encoding of older peers is still decoded and
+can still be emitted for them.
+
+    python -m pytest RDQueue/tests
+"""
+import msgpack
+import pytest
+
+from RDQueue.common.exceptions import InvalidMessageStructure
+from RDQueue.common.message import WIRE_FORMAT_ARRAY, WIRE_FORMAT_LEGACY, Message, MessageType, Operation, Status, \
+    message_factory
+
+
+def _message() -> Message:
+    return message_factory.queue_push_req(sender_addr='127.0.0.1:1', receiver_addr='127.0.0.1:2',
+                                          sender_id='client', receiver_id='broker', timestamp=123.5,
+                                          body={'queue_name': 'q', 'message': [1, 'two', None]})
+
+
+def _fields(message: Message) -> tuple:
+    return (message.id, message.sender_id, message.receiver_id, message.message_type, message.operation,
+            message.status, message.body, message.timestamp)
+
+
+def test_array_encoding_round_trip():
+    message = _message()
+    data = message.to_bytes(WIRE_FORMAT_ARRAY)
+    decoded = Message.from_bytes(memoryview(data))
+
+    assert msgpack.unpackb(data)[0] == WIRE_FORMAT_ARRAY
+    assert _fields(decoded) == _fields(message)
+    assert (decoded.operation, decoded.message_type, decoded.status) == \
+           (Operation.QUEUE_PUSH, MessageType.REQUEST, Status.SUCCESS)
+    # the peers know the addresses from the connection
+    assert (decoded.sender_addr, decoded.receiver_addr) == (None, None)
+
+
+def test_legacy_encoding_round_trip():
+    message = _message()
+    decoded = Message.from_bytes(message.to_bytes(WIRE_FORMAT_LEGACY))
+
+    assert _fields(decoded) == _fields(message)
+    assert (decoded.sender_addr, decoded.receiver_addr) == ('127.0.0.1:1', '127.0.0.1:2')
+
+
+def test_array_encoding_is_smaller():
+    message = _message()
+
+    assert len(message.to_bytes(WIRE_FORMAT_ARRAY)) < len(message.to_bytes(WIRE_FORMAT_LEGACY))
+
+
+def test_messages_have_no_instance_dict():
+    with pytest.raises(AttributeError):
+        _message().extra = 1
+
+
+def test_copy_keeps_everything_but_the_id():
+    message = _message()
+    copy = message.copy(_id=42)
+
+    assert copy.id == 42
+    assert _fields(copy)[1:] == _fields(message)[1:]
+
+
+@pytest.mark.parametrize('data', [
+    msgpack.packb((99, 1, 2, 1, 1, None, None, 0.0, None)),
+    msgpack.packb((WIRE_FORMAT_ARRAY, 1, 0xFF, 1, 1, None, None, 0.0, None)),
+    msgpack.packb((WIRE_FORMAT_ARRAY, 1)),
+    b'\xc1',
+])
+def test_invalid_messages_are_rejected(data):
+    with pytest.raises(InvalidMessageStructure):
+        Message.from_bytes(data)
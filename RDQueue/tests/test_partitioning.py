@@ -0,0 +1,74 @@
+"""
+Partitions are spread over the brokers, keys are routed to a stable partition, and a queue is only created with
+a positive number of partitions.
+
+    python -m pytest RDQueue/tests
+"""
+import asyncio
+from collections import Counter
+
+from RDQueue.benchmark.cluster import LocalCluster, apply_settings, cluster_settings
+from RDQueue.common.connection import Connection
+from RDQueue.common.message import message_factory
+from RDQueue.common.partitioning import assign_owners, partition_for_key, partition_name, worker_for
+
+BROKERS = [f'127.0.0.1:{9091 + i}' for i in range(5)]
+
+
+def test_every_partition_has_distinct_owners():
+    owners = assign_owners('orders', 8, BROKERS, 3)
+
+    assert len(owners) == 8
+    assert all(len(set(partition)) == 3 and set(partition) <= set(BROKERS) for partition in owners)
+
+
+def test_the_first_owners_are_spread_over_the_brokers():
+    owners = assign_owners('orders', 10, BROKERS, 2)
+
+    assert set(Counter(partition[0] for partition in owners).values()) == {2}
+
+
+def test_replicas_are_capped_by_the_brokers():
+    assert all(len(partition) == 2 for partition in assign_owners('orders', 3, BROKERS[:2], 5))
+    assert all(len(partition) == 1 for partition in assign_owners('orders', 3, BROKERS, 0))
+
+
+def test_a_key_always_lands_on_the_same_partition():
+    partitions = [partition_for_key(f'user-{n}', 4) for n in range(100)]
+
+    assert partitions == [partition_for_key(f'user-{n}', 4) for n in range(100)]
+    assert set(partitions) == {0, 1, 2, 3}
+    assert partition_for_key(b'user-1', 4) == partition_for_key('user-1', 4)
+
+
+def test_the_first_partition_keeps_the_name_of_the_queue():
+    assert partition_name('orders', 0) == 'orders'
+    assert partition_name('orders', 2) == 'orders#2'
+    assert worker_for('orders#2', 4) == worker_for('orders#2', 4) < 4
+
+
+def test_a_queue_is_not_created_with_an_invalid_number_of_partitions():
+    asyncio.run(_create_queues([0, -1, 1.5, '2', True]))
+
+
+async def _create_queues(invalid_partitions):
+    settings = cluster_settings(brokers=1, base_port=19400)
+    apply_settings(settings)
+    cluster = LocalCluster(settings, in_process=True)
+    await cluster.start()
+    broker = cluster.servers[1].connection_address
+    connection = Connection(broker, request_timeout=10)
+
+    try:
+        for partitions in invalid_partitions:
+            response = await connection.request(message_factory.queue_create_req(
+                sender_addr=broker.connection_str, receiver_addr=broker.connection_str,
+                body={'name': 'invalid', 'partitions': partitions}
+            ))
+
+            assert not response.is_ok, partitions
+            assert response.body['error'] == 'ValueError'
+            assert 'positive integer number of partitions' in response.body['message']
+    finally:
+        await connection.close()
+        await cluster.stop()
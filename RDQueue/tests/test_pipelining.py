@@ -0,0 +1,151 @@
+"""
+Requests pipelined on one connection to the same partition are applied in the order they were sent, even when
+some of them wait longer than others before they are submitted, e.g. for the partition to elect a leader.
+
+    python -m pytest RDQueue/tests
+"""
+import asyncio
+import random
+from collections import defaultdict
+from typing import Dict, List
+
+from RDQueue.benchmark.cluster import LocalCluster, apply_settings, cluster_settings
+from RDQueue.common.address import Address, address_factory
+from RDQueue.common.connection import Connection
+from RDQueue.common.message import Message, message_factory
+from RDQueue.common.networking import send_message_to_writer
+from RDQueue.common.partitioning import partition_name
+from RDQueue.server.base import BaseServer, pass_turn
+
+QUEUE = 'ordered'
+CLIENT = 'pipelining-client'
+
+
+class SubmittingServer(BaseServer):
+    """
+    Handles every request in two steps like the broker handles a push: a wait of random length before it is
+    submitted, then one before it is answered.
+    """
+
+    def __init__(self, address: Address):
+        super().__init__(address)
+        self.submitted: Dict[str, List[int]] = defaultdict(list)
+
+    def ordering_key(self, message: Message) -> str:
+        return message.body['key']
+
+    async def handle_message(self, message: Message, writer):
+        await asyncio.sleep(random.uniform(0, 0.02))
+        self.submitted[message.body['key']].append(message.body['n'])
+        pass_turn()
+        await asyncio.sleep(random.uniform(0, 0.02))
+
+        await send_message_to_writer(writer, message=message_factory.queue_push_res(
+            sender_addr=self.connection_address.connection_str,
+            receiver_addr=message.sender_addr,
+            _id=message.id,
+            body='OK'
+        ))
+
+
+def test_requests_with_the_same_ordering_key_are_submitted_in_order():
+    asyncio.run(_pipeline_to_submitting_server())
+
+
+async def _pipeline_to_submitting_server():
+    address = address_factory.from_str('127.0.0.1:19380')
+    server = SubmittingServer(address)
+    serving = asyncio.create_task(server.start())
+    connection = Connection(address)
+
+    try:
+        await asyncio.sleep(0.1)
+        await connection.connect()
+
+        requests = [
+            connection.request(message_factory.queue_push_req(
+                sender_addr=address.connection_str, receiver_addr=address.connection_str,
+                body={'key': f'partition-{n % 2}', 'n': n}
+            ))
+            for n in range(200)
+        ]
+        responses = await asyncio.gather(*requests)
+
+        assert all(response.is_ok for response in responses)
+        assert server.submitted['partition-0'] == list(range(0, 200, 2))
+        assert server.submitted['partition-1'] == list(range(1, 200, 2))
+    finally:
+        await connection.close()
+        await server.stop()
+        await serving
+
+
+def test_pushes_pipelined_during_a_leader_election_are_applied_in_order():
+    asyncio.run(_pipeline_during_election())
+
+
+async def _pipeline_during_election():
+    settings = cluster_settings(brokers=3, base_port=19390)
+    apply_settings(settings)
+    cluster = LocalCluster(settings, in_process=True)
+    await cluster.start()
+    brokers = cluster.servers[1:]
+    connection = None
+
+    try:
+        created = await _request(brokers[0], message_factory.queue_create_req, {'name': QUEUE, 'partitions': 1})
+        assert created.is_ok
+
+        partition = partition_name(QUEUE, 0)
+        leader = next(broker for broker in brokers if broker._groups[partition].is_leader)
+        follower = next(broker for broker in brokers if broker is not leader)
+
+        # long enough for the pushes to outlast the election of the next leader
+        connection = Connection(follower.connection_address, request_timeout=30)
+        await connection.connect()
+        await leader.stop()
+
+        pushes = []
+
+        for n in range(200):
+            pushes.append(asyncio.create_task(connection.request(message_factory.queue_push_req(
+                sender_addr=follower.connection_address.connection_str,
+                receiver_addr=follower.connection_address.connection_str,
+                sender_id=CLIENT,
+                body={'queue_name': QUEUE, 'message': n}
+            ))))
+
+            if n % 10 == 9:
+                await asyncio.sleep(0.1)
+
+        responses = await asyncio.gather(*pushes, return_exceptions=True)
+        acknowledged = [n for n, response in enumerate(responses)
+                        if isinstance(response, Message) and response.is_ok]
+
+        popped = await connection.request(message_factory.queue_pop_batch_req(
+            sender_addr=follower.connection_address.connection_str,
+            receiver_addr=follower.connection_address.connection_str,
+            sender_id=CLIENT,
+            body={'queue_name': QUEUE, 'max_n': 1000}
+        ))
+        assert popped.is_ok
+        messages = popped.body
+
+        assert acknowledged
+        assert messages == sorted(set(messages))
+        assert set(acknowledged) <= set(messages)
+    finally:
+        if connection is not None:
+            await connection.close()
+
+        await cluster.stop()
+
+
+async def _request(server: BaseServer, request, body) -> Message:
+    connection = Connection(server.connection_address, request_timeout=10)
+
+    try:
+        return await connection.request(request(sender_addr=server.connection_address.connection_str,
+                                                receiver_addr=server.connection_address.connection_str, body=body))
+    finally:
+        await connection.close()
@@ -0,0 +1,86 @@
+"""
+A consumer prefetches items into a buffer bounded in items and bytes, refilled with batched pops once it drops to
+its low-water mark, and gets them in the order they were popped.
+
+    python -m pytest RDQueue/tests
+"""
+import asyncio
+from typing import List
+
+import pytest
+
+from RDQueue.client.prefetch import Prefetcher
+
+
+class _Queue:
+    name = 'prefetched'
+
+    def __init__(self, items: List, error: Exception | None = None):
+        self.items: List = list(items)
+        self.pops: List[int] = []
+        self.error: Exception | None = error
+
+    async def pop_many(self, max_n: int, wait: float = 0) -> List:
+        if not self.items and self.error is not None:
+            raise self.error
+
+        self.pops.append(max_n)
+        popped, self.items = self.items[:max_n], self.items[max_n:]
+
+        if not popped:
+            await asyncio.sleep(wait)
+
+        return popped
+
+
+def test_items_are_got_in_order_and_refilled_below_the_low_water_mark():
+    async def scenario():
+        queue = _Queue(list(range(20)))
+        prefetcher = Prefetcher(queue, prefetch=8, low_water=2, wait=0.01)
+
+        assert [await prefetcher.get() for _ in range(5)] == list(range(5))
+        await asyncio.sleep(0.01)
+        # 3 items left in the buffer, above the low-water mark
+        assert (prefetcher.buffered, queue.pops) == (3, [8])
+
+        assert await prefetcher.get() == 5
+        await asyncio.sleep(0.01)
+        assert prefetcher.buffered <= 8
+        assert queue.pops == [8, 6]
+
+        assert [await prefetcher.get() for _ in range(14)] == list(range(6, 20))
+        await prefetcher.close()
+
+    asyncio.run(scenario())
+
+
+def test_buffer_is_bounded_in_bytes():
+    async def scenario():
+        items = ['x' * 100] * 50
+        queue = _Queue(items)
+        prefetcher = Prefetcher(queue, prefetch=40, max_bytes=1000, wait=0.01)
+
+        await prefetcher.get()
+        await asyncio.sleep(0.01)
+        # the first pop takes a single item of unknown size, the next ones are sized after it
+        assert queue.pops[:2] == [1, 9]
+        assert prefetcher.buffered_bytes <= 1000
+
+        await prefetcher.close()
+        assert prefetcher.buffered == 0
+
+    asyncio.run(scenario())
+
+
+def test_pop_errors_reach_the_consumer():
+    async def scenario():
+        prefetcher = Prefetcher(_Queue(['a'], error=ConnectionError('broker gone')), prefetch=4, wait=0.01)
+
+        assert await prefetcher.get() == 'a'
+
+        with pytest.raises(ConnectionError):
+            await asyncio.wait_for(prefetcher.get(), 1)
+
+        await prefetcher.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,138 @@
+"""
+A producer batches the items pushed to a partition until the first of them lingered long enough or the batch is
+large enough, sends the batches of a partition in order, and bounds the bytes waiting to be acknowledged.
+
+    python -m pytest RDQueue/tests
+"""
+import asyncio
+import itertools
+import random
+from typing import List, Tuple
+
+import pytest
+
+from RDQueue.client.producer import Producer
+from RDQueue.common.exceptions import ProducerBufferFull
+
+
+class _Queue:
+    name = 'produced'
+
+    def __init__(self, partitions: int = 2, delay: float = 0, error: Exception | None = None):
+        self.partitions: List = [None] * partitions
+        self.sent: List[Tuple[int, List]] = []
+        self.delay: float = delay
+        self.error: Exception | None = error
+        self._next_partition = itertools.count()
+
+    async def get_partition_map(self):
+        pass
+
+    def _choose_partition(self, key=None) -> int:
+        return key % len(self.partitions) if key is not None else next(self._next_partition) % len(self.partitions)
+
+    async def _send_batch(self, partition: int, items: List):
+        await asyncio.sleep(random.uniform(0, self.delay))
+
+        if self.error is not None:
+            raise self.error
+
+        self.sent.append((partition, list(items)))
+
+
+def test_items_linger_into_one_batch():
+    async def scenario():
+        queue = _Queue()
+        producer = Producer(queue, linger=0.05, batch_bytes=10 ** 6)
+        futures = [await producer.push(item, key=0) for item in 'abc']
+
+        await asyncio.sleep(0.01)
+        assert queue.sent == []
+
+        assert await asyncio.gather(*futures) == [0, 0, 0]
+        assert queue.sent == [(0, ['a', 'b', 'c'])]
+        assert producer.buffered_bytes == 0
+
+    asyncio.run(scenario())
+
+
+def test_full_batch_is_sent_right_away():
+    async def scenario():
+        queue = _Queue()
+        producer = Producer(queue, linger=10, batch_bytes=3)
+        futures = [await producer.push(item, key=1) for item in 'abcd']
+
+        await asyncio.gather(*futures[:3])
+        assert queue.sent == [(1, ['a', 'b', 'c'])]
+
+        await producer.flush()
+        assert queue.sent == [(1, ['a', 'b', 'c']), (1, ['d'])]
+
+    asyncio.run(scenario())
+
+
+def test_items_without_a_key_stick_to_a_partition_until_its_batch_is_sent():
+    async def scenario():
+        queue = _Queue()
+        producer = Producer(queue, linger=10, batch_bytes=2)
+
+        for item in 'abcd':
+            await producer.push(item)
+
+        await producer.flush()
+        assert sorted(queue.sent) == [(0, ['a', 'b']), (1, ['c', 'd'])]
+
+    asyncio.run(scenario())
+
+
+def test_batches_of_a_partition_are_sent_in_order():
+    async def scenario():
+        queue = _Queue(delay=0.01)
+        producer = Producer(queue, linger=10, batch_bytes=1)
+
+        for item in range(30):
+            await producer.push(str(item % 10), key=item % 2)
+
+        await producer.flush()
+
+        for partition in (0, 1):
+            sent = [items for sent_to, items in queue.sent if sent_to == partition]
+            assert sent == [[str((item * 2 + partition) % 10)] for item in range(15)]
+
+    asyncio.run(scenario())
+
+
+def test_failed_batch_fails_its_futures():
+    async def scenario():
+        producer = Producer(_Queue(error=ConnectionError('broker gone')), linger=0)
+        future = await producer.push('a')
+
+        with pytest.raises(ConnectionError):
+            await future
+
+        assert producer.buffered_bytes == 0
+
+    asyncio.run(scenario())
+
+
+def test_buffer_limit():
+    async def scenario():
+        queue = _Queue(delay=0.05)
+        producer = Producer(queue, linger=0, buffer_bytes=3, block=False)
+
+        with pytest.raises(ProducerBufferFull):
+            await producer.push('abcd')
+
+        await producer.push('abc')
+
+        with pytest.raises(ProducerBufferFull):
+            await producer.push('d')
+
+        # a blocking producer waits for the first batch to be acknowledged
+        producer = Producer(queue, linger=0, buffer_bytes=3)
+        first = await producer.push('abc')
+        await producer.push('d')
+
+        assert first.done()
+
+    asyncio.run(scenario())
@@ -0,0 +1,109 @@
+"""
+Metrics are exposed in the Prometheus text format over HTTP, histograms with cumulative buckets, and gauges
+refreshed by their collectors right before they are read.
+
+    python -m pytest RDQueue/tests
+"""
+import asyncio
+
+import pytest
+
+from RDQueue.common.address import address_factory
+from RDQueue.common.metrics import MetricsRegistry, metrics
+from RDQueue.server.prometheus import CONTENT_TYPE, MetricsEndpoint
+
+
+def test_text_format():
+    registry = MetricsRegistry()
+    registry.counter('requests_total', server='a').inc(3)
+    registry.gauge('queue_depth', queue='say "hi"\n').set(7)
+    histogram = registry.histogram('request_seconds', buckets=(0.1, 1), operation='PUSH')
+
+    for value in (0.05, 0.5, 0.5, 5):
+        histogram.observe(value)
+
+    assert registry.to_prometheus().splitlines() == [
+        '# TYPE queue_depth gauge',
+        'queue_depth{queue="say \\"hi\\"\\n"} 7',
+        '# TYPE request_seconds histogram',
+        'request_seconds_bucket{operation="PUSH",le="0.1"} 1',
+        'request_seconds_bucket{operation="PUSH",le="1"} 3',
+        'request_seconds_bucket{operation="PUSH",le="+Inf"} 4',
+        'request_seconds_sum{operation="PUSH"} 6.05',
+        'request_seconds_count{operation="PUSH"} 4',
+        '# TYPE requests_total counter',
+        'requests_total{server="a"} 3',
+    ]
+
+
+def test_summary_quantiles():
+    registry = MetricsRegistry()
+    summary = registry.summary('latency_seconds')
+
+    for value in range(1, 101):
+        summary.observe(value / 100)
+
+    lines = registry.to_prometheus().splitlines()
+
+    assert 'latency_seconds{quantile="0.5"} 0.51' in lines
+    assert 'latency_seconds{quantile="0.99"} 1.0' in lines
+    assert 'latency_seconds_count 100' in lines
+
+
+def test_collectors_run_before_the_metrics_are_read():
+    registry = MetricsRegistry()
+    depth = registry.gauge('queue_depth', queue='q')
+    reads = []
+
+    def collect():
+        reads.append(1)
+        depth.set(len(reads))
+
+    registry.add_collector(collect)
+    assert 'queue_depth{queue="q"} 1' in registry.to_prometheus()
+    assert registry.collect()['queue_depth'][0]['value'] == 2
+
+    registry.remove_collector(collect)
+    registry.collect()
+    assert len(reads) == 2
+
+
+def test_same_metric_is_returned_for_the_same_name_and_labels():
+    registry = MetricsRegistry()
+
+    assert registry.counter('pushed_total', queue='q', replica='r') is \
+           registry.counter('pushed_total', replica='r', queue='q')
+
+    with pytest.raises(TypeError):
+        registry.gauge('pushed_total', queue='q', replica='r')
+
+
+def test_metrics_are_served_over_http():
+    asyncio.run(_scrape())
+
+
+async def _scrape():
+    metrics.counter('scraped_total', test='prometheus').inc()
+    endpoint = MetricsEndpoint(address_factory.from_str('127.0.0.1:19450'))
+    await endpoint.start()
+
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', 19450)
+        writer.write(b'GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        response = (await asyncio.wait_for(reader.read(), 5)).decode()
+        writer.close()
+
+        head, body = response.split('\r\n\r\n', 1)
+        assert head.startswith('HTTP/1.1 200 OK')
+        assert f'Content-Type: {CONTENT_TYPE}' in head
+        assert f'Content-Length: {len(body.encode())}' in head
+        assert 'scraped_total{test="prometheus"} 1' in body.splitlines()
+
+        reader, writer = await asyncio.open_connection('127.0.0.1', 19450)
+        writer.write(b'POST /metrics HTTP/1.1\r\n\r\n')
+        response = (await asyncio.wait_for(reader.read(), 5)).decode()
+        writer.close()
+
+        assert response.startswith('HTTP/1.1 405 Method Not Allowed')
+    finally:
+        endpoint.stop()
@@ -0,0 +1,117 @@
+"""
+Segments are deleted once every client consumed them or they exceed a retention limit, and the ages they are
+held to are measured with the clock of the brokers rather than the ones of the clients.
+
+    python -m pytest RDQueue/tests
+"""
+import asyncio
+import time
+
+import msgpack
+
+from RDQueue.benchmark.cluster import LocalCluster, apply_settings, cluster_settings
+from RDQueue.common.config import settings
+from RDQueue.common.connection import Connection
+from RDQueue.common.message import message_factory
+from RDQueue.common.partitioning import partition_name
+from RDQueue.server.message_queue import Queue
+from RDQueue.server.storage import SegmentedLog
+
+# a segment of three records of RECORD
+SEGMENT_BYTES = 100
+RECORD = b'x' * 10
+
+
+def _log(tmp_path, segments: int, timestamps=None) -> SegmentedLog:
+    log = SegmentedLog(tmp_path / 'log', segment_bytes=SEGMENT_BYTES)
+
+    for segment in range(segments):
+        log.append([RECORD] * 3, timestamps[segment] if timestamps else 1000)
+
+    return log
+
+
+def test_records_roll_over_to_new_segments(tmp_path):
+    log = _log(tmp_path, 4)
+
+    assert log.end_offset == 12
+    assert len(log._segments) == 4
+    assert log.read_many(0, 20) == [RECORD] * 12
+
+
+def test_no_retention_limit_keeps_every_segment(tmp_path):
+    log = _log(tmp_path, 4)
+
+    assert log.retention_offset(now=10 ** 9) == 0
+    assert log.retention_offset(max_age=None, now=10 ** 9) == 0
+
+
+def test_segments_beyond_the_retention_limits_are_expired(tmp_path):
+    log = _log(tmp_path, 4, timestamps=[100, 200, 300, 400])
+
+    assert log.retention_offset(max_messages=6) == 6
+    assert log.retention_offset(max_bytes=2 * log._segments[0].size) == 6
+    assert log.retention_offset(max_age=150, now=400) == 6
+    # the active segment is never expired
+    assert log.retention_offset(max_age=1, now=10 ** 9) == 9
+
+
+def test_deleting_keeps_the_active_segment(tmp_path):
+    log = _log(tmp_path, 3)
+
+    assert log.delete_before(100) == 6
+    assert log.read_many(6, 10) == [RECORD] * 3
+
+    log.close()
+    reopened = SegmentedLog(tmp_path / 'log', segment_bytes=SEGMENT_BYTES)
+
+    assert (reopened.start_offset, reopened.end_offset) == (6, 9)
+
+
+def test_idle_clients_are_evicted(tmp_path):
+    queue = Queue('retained', 'owner', tmp_path)
+    queue.push_many('idle', ['a', 'b'], timestamp=100)
+    queue.push_many('active', ['c'], timestamp=100)
+    queue.pop('active', timestamp=1000)
+
+    assert queue.apply_retention(now=1050, client_ttl=100)
+    assert queue.available('idle') is None
+    assert queue.available('active') == 2
+
+    queue.close()
+
+
+def test_records_are_stamped_with_the_time_of_the_broker():
+    asyncio.run(_push_from_the_past())
+
+
+async def _push_from_the_past():
+    cluster_config = cluster_settings(brokers=1, base_port=19420)
+    apply_settings(cluster_config)
+    cluster = LocalCluster(cluster_config, in_process=True)
+    await cluster.start()
+    broker = cluster.servers[1]
+    address = broker.connection_address.connection_str
+    connection = Connection(broker.connection_address, request_timeout=10)
+
+    try:
+        created = await connection.request(message_factory.queue_create_req(
+            sender_addr=address, receiver_addr=address, body={'name': 'stamped', 'partitions': 1}))
+        assert created.is_ok
+
+        # a client whose clock is a year late
+        pushed = await connection.request(message_factory.queue_push_req(
+            sender_addr=address, receiver_addr=address, sender_id='late-client', timestamp=time.time() - 3.2e7,
+            body={'queue_name': 'stamped', 'message': 'kept'}))
+        assert pushed.is_ok
+
+        queue = broker._groups[partition_name('stamped', 0)]._get_queue('stamped')
+        timestamps = [timestamp for _, timestamp in queue.read_for_catch_up(0, 1, 1024)]
+
+        assert abs(timestamps[0] - time.time()) < 60
+        assert abs(queue._clients_last_seen['late-client'] - time.time()) < 60
+        assert settings.RETENTION_MAX_AGE is None
+        assert [msgpack.unpackb(payload) for payload, _ in queue.read_for_catch_up(0, 1, 1024)] == ['kept']
+    finally:
+        await connection.close()
+        await cluster.stop()
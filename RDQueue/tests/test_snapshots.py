@@ -0,0 +1,128 @@
+"""
+A replication group is snapshotted on its replication thread, between two commands, into a dump its replication log
+is compacted into, and a group restarted on the same directories is restored from it and applies the commands
+of its journal after it again.
+
+    python -m pytest RDQueue/tests
+"""
+import asyncio
+import pickle
+import threading
+
+import msgpack
+
+from RDQueue.server.message_queue import QueueManager
+from RDQueue.server.replication import ReplicationHub
+
+QUEUE = 'orders'
+QUEUE_INFO = {'owner': 'broker', 'id': 'orders-id', 'partitions': 1, 'owners': []}
+
+
+class _Replica:
+    """
+    A group replicated by a single broker, which elects itself leader.
+    """
+
+    def __init__(self, tmp_path, port: int):
+        self.snapshots = []
+        self.hub = ReplicationHub(f'127.0.0.1:{port}', [])
+        self.hub.start()
+        self.group = QueueManager(f'queue:{QUEUE}', self.hub, [self.hub.address], tmp_path / 'snapshots',
+                                  tmp_path / 'data', {QUEUE: QUEUE_INFO}, on_snapshot=self._on_snapshot)
+        self.group.start()
+
+    def _on_snapshot(self, group: str, duration: float, size: int):
+        self.snapshots.append((threading.current_thread().name, group, size))
+
+    @property
+    def queue(self):
+        return self.group._queues[QUEUE]
+
+    async def push(self, *messages):
+        await self.group.wait_for_leader()
+        await self.group.replicate(self.group.push_group, [(QUEUE, 'client', list(messages), 1000.0)])
+
+    async def pop(self, max_n: int):
+        return await self.group.replicate(self.group.pop_batch, QUEUE, 'client', max_n, 1000.0)
+
+    async def stop(self, snapshot: bool = True):
+        if snapshot:
+            await self.group.snapshot()
+
+        await asyncio.get_running_loop().run_in_executor(None, self.hub.stop)
+
+
+def test_snapshot_is_written_on_the_replication_thread_at_an_applied_command(tmp_path):
+    async def scenario():
+        replica = _Replica(tmp_path, 19430)
+        await replica.push('a', 'b')
+        await replica.pop(1)
+
+        assert await replica.group.snapshot()
+
+        dump_file = tmp_path / 'snapshots' / 'queue%3Aorders.dump'
+        dump = pickle.loads(dump_file.read_bytes())
+        state = dump['queues'][QUEUE]
+        last_applied, _, _ = dump['raft']
+
+        assert last_applied[1] == replica.group.raftLastApplied
+        assert (state['_start_offset'], state['_end_offset']) == (0, 2)
+        assert state['_clients_positions'] == {'client': 1}
+        assert replica.snapshots == [(f'replication-{replica.hub.address}', f'queue:{QUEUE}', dump_file.stat().st_size)]
+
+        await replica.stop()
+
+    asyncio.run(scenario())
+
+
+def test_snapshot_is_skipped_when_nothing_was_applied_since_the_last_one(tmp_path):
+    async def scenario():
+        replica = _Replica(tmp_path, 19431)
+        await replica.push('a')
+
+        assert await replica.group.snapshot()
+        assert await replica.group.snapshot()
+        assert len(replica.snapshots) == 1
+
+        await replica.stop()
+
+    asyncio.run(scenario())
+
+
+def test_group_is_restored_from_its_snapshot(tmp_path):
+    async def scenario():
+        replica = _Replica(tmp_path, 19432)
+        await replica.push('a', 'b', 'c')
+        await replica.pop(1)
+        await replica.stop()
+
+        replica = _Replica(tmp_path, 19432)
+        assert (replica.queue.start_offset, replica.queue.end_offset) == (0, 3)
+
+        await replica.group.wait_for_leader()
+        assert await replica.pop(5) == ['b', 'c']
+
+        await replica.stop()
+
+    asyncio.run(scenario())
+
+
+def test_commands_after_the_snapshot_are_replayed_from_the_journal(tmp_path):
+    async def scenario():
+        replica = _Replica(tmp_path, 19433)
+        await replica.push('a', 'b')
+        assert await replica.group.snapshot()
+        await replica.push('c', 'd', 'e')
+        await replica.pop(2)
+        await replica.stop(snapshot=False)
+
+        # the records after the snapshot are on disk already, the push applied again does not append them twice
+        replica = _Replica(tmp_path, 19433)
+        await replica.group.wait_for_leader()
+        assert await replica.pop(10) == ['c', 'd', 'e']
+        assert replica.queue.read_for_catch_up(0, 10, 1024) == \
+               [(msgpack.packb(message), 1000.0) for message in 'abcde']
+
+        await replica.stop()
+
+    asyncio.run(scenario())
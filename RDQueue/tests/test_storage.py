@@ -0,0 +1,192 @@
+"""
+The segmented log keeps its records across reopens and recovers from a torn write, and a queue restored from a
+snapshot keeps the records appended after it: they are adopted, or replayed by the commands that appended them
+without being appended twice.
+
+    python -m pytest RDQueue/tests
+"""
+import shutil
+
+import msgpack
+
+from RDQueue.server.message_queue import Queue
+from RDQueue.server.storage import RECORD_HEADER, SegmentedLog
+
+# a segment of three records of RECORD
+SEGMENT_BYTES = 100
+RECORD = b'x' * 10
+
+
+def _log(tmp_path, records: int = 0) -> SegmentedLog:
+    log = SegmentedLog(tmp_path / 'log', segment_bytes=SEGMENT_BYTES)
+
+    for i in range(records):
+        log.append([b'%09d' % i + b'x'], 1000 + i)
+
+    return log
+
+
+def _reopen(log: SegmentedLog) -> SegmentedLog:
+    log.sync()
+    log.close()
+    return SegmentedLog(log.directory, segment_bytes=SEGMENT_BYTES)
+
+
+def test_records_are_read_back_in_order(tmp_path):
+    log = _log(tmp_path)
+
+    assert log.append([b'a', b'bb'], 100) == 0
+    assert log.append([b'ccc'], 200) == 2
+    assert log.read(1) == b'bb'
+    assert log.read_many(0, 10) == [b'a', b'bb', b'ccc']
+    assert log.read_timestamped(1, 10, 1024) == [(b'bb', 100), (b'ccc', 200)]
+    # stops once the payloads reach the limit
+    assert log.read_timestamped(0, 10, 2) == [(b'a', 100), (b'bb', 100)]
+
+
+def test_reads_span_segments(tmp_path):
+    log = _log(tmp_path, 8)
+
+    assert len(log._segments) == 3
+    assert log.read_many(2, 4) == [b'%09dx' % i for i in range(2, 6)]
+    assert [timestamp for _, timestamp in log.read_timestamped(5, 2, 1024)] == [1005, 1006]
+
+
+def test_reopened_log_holds_the_same_records(tmp_path):
+    log = _reopen(_log(tmp_path, 8))
+
+    assert (log.start_offset, log.end_offset) == (0, 8)
+    assert log.read_many(0, 10) == [b'%09dx' % i for i in range(8)]
+    assert log.append([b'next'], 2000) == 8
+
+
+def test_torn_record_is_dropped_on_reopen(tmp_path):
+    log = _log(tmp_path, 2)
+    segment = log._segments[-1]
+    # the header of a third record whose payload never made it to the file
+    RECORD_HEADER.pack_into(segment._map, segment.size, 10, 12345, 1002)
+    log = _reopen(log)
+
+    assert log.end_offset == 2
+    assert log.read_many(0, 10) == [b'%09dx' % i for i in range(2)]
+
+
+def test_truncate_and_reset(tmp_path):
+    log = _log(tmp_path, 8)
+
+    log.truncate(4)
+    assert (log.start_offset, log.end_offset) == (0, 4)
+    assert len(log._segments) == 2
+    assert log.append([b'again'], 2000) == 4
+
+    log.reset(20)
+    assert (log.start_offset, log.end_offset) == (20, 20)
+    assert log.append([b'later'], 3000) == 20
+
+    log = _reopen(log)
+    assert (log.start_offset, log.end_offset) == (20, 21)
+
+
+def test_retention_of_the_log_up_to_an_offset(tmp_path):
+    log = _log(tmp_path, 12)
+
+    # the segments of the log as it was with 7 records
+    assert log.retention_offset(max_messages=2, end_offset=7) == 3
+    assert log.retention_offset(max_messages=2) == 9
+    assert log.retention_offset(max_bytes=log._segments[0].size + 1, end_offset=7) == 3
+    assert log.retention_offset(max_age=1, now=10 ** 9, start_offset=3, end_offset=7) == 6
+    assert log.segment_start(100, end_offset=7) == 6
+    assert log.segment_start(100) == 9
+    assert log.segment_start(4) == 3
+
+
+def _queue(tmp_path) -> Queue:
+    return Queue('orders', 'owner', tmp_path, queue_id='orders-id')
+
+
+def _restart(queue: Queue, tmp_path, replay: bool) -> Queue:
+    state = queue.snapshot_state()
+    queue.sync()
+    queue.close()
+    return Queue.from_snapshot_state(state, tmp_path, replay)
+
+
+def test_records_pushed_after_the_snapshot_are_adopted(tmp_path):
+    queue = _queue(tmp_path)
+    queue.push_many('client', ['a', 'b'], 100)
+    state = queue.snapshot_state()
+    queue.push_many('client', ['c', 'd', 'e'], 200)
+    queue.sync()
+    queue.close()
+
+    queue = Queue.from_snapshot_state(state, tmp_path)
+
+    assert queue.end_offset == 5
+    assert queue.pop_many('client', 10) == ['a', 'b', 'c', 'd', 'e']
+    queue.close()
+
+
+def test_records_pushed_after_the_snapshot_are_replayed_once(tmp_path):
+    queue = _queue(tmp_path)
+    queue.push_many('client', ['a', 'b'], 100)
+    state = queue.snapshot_state()
+    queue.push_many('client', ['c', 'd'], 200)
+    queue.push_many('client', ['e'], 300)
+    queue.sync()
+    queue.close()
+
+    queue = Queue.from_snapshot_state(state, tmp_path, replay=True)
+
+    assert (queue.end_offset, queue.replaying) == (2, True)
+    assert queue.pop_many('client', 10) == ['a', 'b']
+
+    queue.push_many('client', ['c', 'd'], 200)
+    queue.push_many('client', ['e'], 300)
+
+    assert (queue.end_offset, queue.replaying) == (5, False)
+    assert queue.pop_many('client', 10) == ['c', 'd', 'e']
+
+    queue.push_many('client', ['f'], 400)
+    queue = _restart(queue, tmp_path, replay=True)
+
+    assert queue.read_for_catch_up(0, 10, 1024) == [(msgpack.packb(message), timestamp) for message, timestamp in
+                                                    zip('abcdef', [100, 100, 200, 200, 300, 400])]
+    queue.close()
+
+
+def test_records_the_replication_log_does_not_hold_are_dropped(tmp_path):
+    queue = _queue(tmp_path)
+    queue.push_many('client', ['a'], 100)
+    state = queue.snapshot_state()
+    queue.push_many('client', ['b', 'c'], 200)
+    queue.sync()
+    queue.close()
+
+    queue = Queue.from_snapshot_state(state, tmp_path, replay=True)
+    queue.push_many('client', ['b', 'x'], 200)
+
+    assert (queue.end_offset, queue.replaying) == (3, False)
+    assert queue.pop_many('client', 10) == ['a', 'b', 'x']
+    queue.close()
+
+
+def test_retention_keeps_the_segments_a_restart_replays_from(tmp_path):
+    queue = _queue(tmp_path)
+    # segments of three records
+    directory = queue._log.directory
+    queue.close()
+    shutil.rmtree(directory)
+    queue._log = SegmentedLog(directory, segment_bytes=SEGMENT_BYTES)
+    queue.push_many('client', [RECORD] * 9, 100)
+    state = queue.snapshot_state()
+    queue.pop_many('client', 7)
+
+    assert queue.apply_retention(now=200)
+    assert (queue.start_offset, queue._log.start_offset) == (6, 0)
+
+    queue.release_segments(state['_start_offset'])
+    assert queue._log.start_offset == 0
+
+    queue.release_segments(queue.snapshot_state()['_start_offset'])
+    assert queue._log.start_offset == 6
+    queue.close()
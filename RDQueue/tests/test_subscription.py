@@ -0,0 +1,113 @@
+"""
+A subscription streams the messages of its partition as they are pushed, and never sends a consumer more messages
+than it granted credits for.
+
+    python -m pytest RDQueue/tests
+"""
+import asyncio
+from typing import List
+
+from RDQueue.common.message import Message, Operation, Status, message_factory
+from RDQueue.common.networking import FrameWriter, receive_message
+from RDQueue.server.subscription import Subscription
+
+
+class _Writer:
+    def __init__(self):
+        self.reader = asyncio.StreamReader()
+        self.closing = False
+
+    def write(self, data: bytes):
+        self.reader.feed_data(data)
+
+    def writelines(self, data):
+        for chunk in data:
+            self.write(chunk)
+
+    async def drain(self):
+        pass
+
+    def is_closing(self) -> bool:
+        return self.closing
+
+
+class _Partition:
+    def __init__(self):
+        self.messages: List = []
+        self.pushed: asyncio.Event = asyncio.Event()
+
+    def push(self, *messages):
+        self.messages.extend(messages)
+        self.pushed.set()
+
+    async def wait_for_messages(self) -> int | None:
+        while not self.messages:
+            self.pushed.clear()
+            await self.pushed.wait()
+
+        return len(self.messages)
+
+    async def pop(self, max_n: int) -> List:
+        popped, self.messages = self.messages[:max_n], self.messages[max_n:]
+        return popped
+
+
+def _subscribe(writer: _Writer, partition: _Partition, credits: int) -> Subscription:
+    request = message_factory.subscribe_req(sender_addr='127.0.0.1:1', receiver_addr='127.0.0.1:2',
+                                            sender_id='consumer', body={'queue_name': 'q', 'credits': credits})
+    subscription = Subscription(request, 'q', FrameWriter(writer), '127.0.0.1:2', credits,
+                                wait_for_messages=partition.wait_for_messages, pop=partition.pop)
+    subscription.start(on_done=lambda _: None)
+    return subscription
+
+
+async def _received(writer: _Writer, count: int) -> List:
+    messages = []
+
+    while len(messages) < count:
+        response: Message = await asyncio.wait_for(receive_message(writer.reader), 1)
+        assert (response.operation, response.status) == (Operation.SUBSCRIBE, Status.SUCCESS)
+        messages.extend(response.body)
+
+    return messages
+
+
+def test_messages_are_streamed_up_to_the_credits():
+    async def scenario():
+        writer, partition = _Writer(), _Partition()
+        subscription = _subscribe(writer, partition, credits=3)
+
+        partition.push(*range(5))
+        assert await _received(writer, 3) == [0, 1, 2]
+
+        await asyncio.sleep(0.05)
+        # the consumer used up its window, the rest stays in the partition
+        assert (subscription.credits, partition.messages) == (0, [3, 4])
+
+        subscription.grant(10)
+        assert await _received(writer, 2) == [3, 4]
+        assert subscription.credits == 8
+
+        partition.push(5)
+        assert await _received(writer, 1) == [5]
+
+        subscription.cancel()
+
+    asyncio.run(scenario())
+
+
+def test_subscription_ends_with_the_connection():
+    async def scenario():
+        writer, partition = _Writer(), _Partition()
+        ended = asyncio.Event()
+        request = message_factory.subscribe_req(sender_addr='127.0.0.1:1', receiver_addr='127.0.0.1:2',
+                                                sender_id='consumer', body={'queue_name': 'q'})
+        subscription = Subscription(request, 'q', FrameWriter(writer), '127.0.0.1:2', 0,
+                                    wait_for_messages=partition.wait_for_messages, pop=partition.pop)
+        subscription.start(on_done=lambda _: ended.set())
+
+        writer.closing = True
+        subscription.grant(1)
+        await asyncio.wait_for(ended.wait(), 1)
+
+    asyncio.run(scenario())